@@ -1,6 +1,28 @@
-from .funicorn import Funicorn
-from .http_api import HttpAPI
-from .stat import Statistic
-from .rpc import ThriftAPIV2, ThriftAPI
+import importlib
 
 __version__ = '1.0.6'
+
+# Submodule of every public name, imported on first access so that the CLI
+# and the workers only load the dependencies they use (Flask, Thrift, ...)
+_LAZY_ATTRS = {
+    'Funicorn': '.funicorn',
+    'HttpAPI': '.http_api',
+    'AsyncHttpAPI': '.async_http_api',
+    'Statistic': '.stat',
+    'ThriftAPI': '.rpc',
+    'ThriftAPIV2': '.rpc',
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,517 @@
+import asyncio
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from io import BytesIO
+from urllib.parse import urlsplit, parse_qs
+
+from werkzeug.formparser import parse_form_data
+
+from .exceptions import NotSupportedInputFile, MaxFileSizeExeeded, InitializationError
+from .exceptions import TooManyHeaders
+from .exceptions import PredictionError, DownloadURLError, WorkerControlError
+from .utils import colored_network_name, split_class_from_path, check_deploy_allowed
+from .utils import npy_bytes_to_ndarray, raw_bytes_to_ndarray, NPY_CONTENT_TYPE
+from .utils import MAX_BODY_SIZE
+from .decode import ImageDecoder
+from .fetch import URLFetcher
+from .serializers import get_serializer, negotiate, negotiate_content_type
+from .serializers import JSON_CONTENT_TYPE
+from .metrics import MetricsRegistry, request_metrics, serialization_metric
+from .metrics import METRICS_CONTENT_TYPE
+from .tracing import TRACE_ID_HEADER
+from .profiler import profile_kwargs, COLLAPSED_CONTENT_TYPE
+from .memory import tracemalloc_kwargs
+from .logger import get_logger
+from .stat import Statistic, STREAM_CONTENT_TYPE, DEFAULT_STREAM_INTERVAL
+from .stat import MIN_STREAM_INTERVAL
+
+__all__ = ['AsyncHttpAPI']
+
+MAX_FILE_SIZE = 5 * 1024 * 1024
+MAX_HEADER_SIZE = 64 * 1024
+MAX_HEADERS = 100
+KEEP_ALIVE_TIMEOUT = 75
+# Deadline to read the headers and the body once the request line arrived
+REQUEST_TIMEOUT = 60
+CONTINUE = b'HTTP/1.1 100 Continue\r\n\r\n'
+
+
+class Request():
+    def __init__(self, method, target, version, headers, body=b''):
+        self.method = method
+        url = urlsplit(target)
+        self.path = url.path
+        self.args = {key: values[0]
+                     for key, values in parse_qs(url.query).items()}
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.trace = None
+
+    @property
+    def content_length(self):
+        return int(self.headers.get('content-length', 0))
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    @property
+    def files(self):
+        '''Multipart files, parsed with werkzeug like Flask does'''
+        environ = {'REQUEST_METHOD': self.method,
+                   'CONTENT_TYPE': self.headers.get('content-type', ''),
+                   'CONTENT_LENGTH': str(len(self.body)),
+                   'wsgi.input': BytesIO(self.body)}
+        _, _, files = parse_form_data(environ)
+        return files
+
+
+class Response():
+    def __init__(self, status, body=b'', content_type='application/json', headers=None):
+        self.status = HTTPStatus(status)
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    def render_head(self, framing, keep_alive=True):
+        head = [f'HTTP/1.1 {self.status.value} {self.status.phrase}',
+                f'Content-Type: {self.content_type}', framing,
+                f'Connection: {"keep-alive" if keep_alive else "close"}']
+        head.extend(f'{key}: {value}' for key, value in self.headers.items())
+        return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+
+    def render(self, keep_alive=True):
+        return self.render_head(f'Content-Length: {len(self.body)}', keep_alive) + self.body
+
+    async def write(self, writer, keep_alive=True):
+        writer.write(self.render(keep_alive))
+        await writer.drain()
+
+
+class StreamingResponse(Response):
+    '''Body sent in chunks as the async iterator `chunks` yields them'''
+
+    def __init__(self, status, chunks, content_type='application/json', headers=None):
+        Response.__init__(self, status, content_type=content_type, headers=headers)
+        self.chunks = chunks
+
+    async def write(self, writer, keep_alive=True):
+        writer.write(self.render_head('Transfer-Encoding: chunked', keep_alive))
+        async for chunk in self.chunks:
+            writer.write(f'{len(chunk):x}\r\n'.encode('latin-1') + chunk + b'\r\n')
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+def json_response(payload, status=HTTPStatus.OK):
+    return Response(status, get_serializer(JSON_CONTENT_TYPE).dumps(payload))
+
+
+def error_response(status, message):
+    return json_response({"error_code": status,
+                          "error_message": message,
+                          "results": []}, status=status)
+
+
+class AsyncHttpAPI(threading.Thread):
+    '''HTTP API served by an asyncio event loop
+
+    Same routes as `HttpAPI`, but requests await their result with
+    `Funicorn.predict_async` instead of blocking one thread each, so
+    concurrency is not capped by a thread count. Only blocking admin
+    actions run in a thread pool of `threads` threads, and image decoding
+    in the pool of `decoder`.
+    '''
+
+    def __init__(self, funicorn_app=None, host='0.0.0.0', port=5001, stat=None, threads=10,
+                 name='HTTP', timeout=1000, backlog=2048, decoder=None, fetcher=None,
+                 fetch_urls=True, preserialize=False, tracer=None, deploy_models=None,
+                 debug=False, register_conn=True):
+        threading.Thread.__init__(self, daemon=True)
+        self.name = name
+        self.host = host
+        self.port = port
+        self.threads = threads
+        self.timeout = timeout
+        self.backlog = backlog
+        # Let workers serialize results to the negotiated response format
+        self.preserialize = preserialize
+        self.funicorn_app = funicorn_app
+        self.stat = stat or Statistic(funicorn_app=funicorn_app)
+        self.metrics = getattr(funicorn_app, 'metrics', None) or MetricsRegistry()
+        self._requests_metric, self._latency_metric = request_metrics(self.metrics)
+        self._serialization_metric = serialization_metric(self.metrics)
+        self.decoder = decoder or ImageDecoder(
+            model_cls=getattr(funicorn_app, 'model_cls', None))
+        # Without a fetcher the url itself is given to the model
+        self.fetcher = (fetcher or URLFetcher(debug=debug)) if fetch_urls else None
+        # Sampled predict requests are traced when a `tracing.Tracer` is given
+        self.tracer = tracer
+        # Model class paths /api/deploy may load, it is disabled when None
+        self.deploy_models = deploy_models
+        self.logger = get_logger(colored_network_name('HTTP'),
+                                 mode='debug' if debug else 'info')
+        self.routes = {}
+        self.init_routes()
+
+        if register_conn and funicorn_app is not None:
+            self.funicorn_app.register_connection(self)
+
+    def route(self, path, methods=('GET',)):
+        def decorator(handler):
+            self.routes[path] = (methods, handler)
+            return handler
+        return decorator
+
+    def negotiated_response(self, request, payload, status=HTTPStatus.OK):
+        '''Encode `payload` in the format negotiated from the Accept header'''
+        start_time = time.time()
+        body, content_type = negotiate(payload, request.headers.get('accept'))
+        self._serialization_metric.observe(time.time() - start_time, stage='frontend')
+        return Response(status, body, content_type=content_type)
+
+    def wire_format(self, request):
+        '''Format workers serialize results to, None to get Python objects'''
+        if not self.preserialize:
+            return None
+        return negotiate_content_type(request.headers.get('accept'))
+
+    async def predict(self, request, data):
+        return await self.funicorn_app.predict_async(
+            data, wire_format=self.wire_format(request), trace=request.trace)
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def init_routes(self):
+        @self.route('/api/predict_img_bytes', methods=('POST',))
+        async def predict_img_bytes(request):
+            self.stat.increment('total_req')
+            if request.content_length > MAX_FILE_SIZE:
+                self.stat.increment('crashes')
+                return error_response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'Request Size Exeeded')
+            # Multipart parsing copies the whole body, keep it off the event loop
+            files = await self.run_blocking(lambda: request.files)
+            if 'img_bytes' not in files:
+                self.stat.increment('crashes')
+                return error_response(HTTPStatus.BAD_REQUEST, 'Wrong request parameter')
+            try:
+                img = await self.decoder.decode_async(files['img_bytes'].read())
+            except NotSupportedInputFile:
+                self.stat.increment('crashes')
+                return error_response(HTTPStatus.BAD_REQUEST, 'Wrong request parameter')
+            except MaxFileSizeExeeded:
+                self.stat.increment('crashes')
+                return error_response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'Image Size Exeeded')
+            results = await self.predict(request, img)
+            if results is None:
+                results = []
+            self.stat.increment('total_res')
+            return self.negotiated_response(request, {"error_code": 0,
+                                                      "error_message": "Successful.",
+                                                      "results": results})
+
+        @self.route('/api/predict_url', methods=('GET', 'POST'))
+        async def predict_url(request):
+            self.stat.increment('total_req')
+            if 'url' not in request.args:
+                self.stat.increment('crashes')
+                return error_response(HTTPStatus.BAD_REQUEST, 'Wrong request parameter')
+            data = request.args['url']
+            if self.fetcher is not None:
+                try:
+                    data = await self.decoder.decode_async(
+                        await self.fetcher.fetch_async(data))
+                except DownloadURLError as e:
+                    self.stat.increment('crashes')
+                    return error_response(e.status_code, e.message)
+                except NotSupportedInputFile:
+                    self.stat.increment('crashes')
+                    return error_response(HTTPStatus.BAD_REQUEST, 'Wrong request parameter')
+                except MaxFileSizeExeeded:
+                    self.stat.increment('crashes')
+                    return error_response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'Image Size Exeeded')
+            results = await self.predict(request, data)
+            self.stat.increment('total_res')
+            return self.negotiated_response(request, {"error_code": HTTPStatus.OK,
+                                                      "error_message": "Successful.",
+                                                      "results": results})
+
+        @self.route('/api/predict_tensor', methods=('POST',))
+        async def predict_tensor(request):
+            self.stat.increment('total_req')
+            try:
+                content_type = request.headers.get('content-type', '').split(';')[0]
+                if content_type == NPY_CONTENT_TYPE:
+                    tensor = npy_bytes_to_ndarray(request.body)
+                else:
+                    tensor = raw_bytes_to_ndarray(request.body, request.headers['x-dtype'],
+                                                  request.headers['x-shape'])
+            except (KeyError, ValueError, TypeError):
+                self.stat.increment('crashes')
+                return error_response(HTTPStatus.BAD_REQUEST, 'Wrong request parameter')
+            results = await self.predict(request, tensor)
+            self.stat.increment('total_res')
+            return self.negotiated_response(request, {"error_code": 0,
+                                                      "error_message": "Successful.",
+                                                      "results": results})
+
+        @self.route('/api/predict_json', methods=('POST',))
+        async def predict_json(request):
+            self.stat.increment('total_req')
+            if 'url' not in request.args:
+                self.stat.increment('crashes')
+                return error_response(HTTPStatus.BAD_REQUEST, 'Wrong request parameter')
+            result = await self.funicorn_app.predict_async(request.args['url'])
+            self.stat.increment('total_res')
+            return self.negotiated_response(request, {'result': result})
+
+        @self.route('/api/status')
+        async def status(request):
+            return json_response(self.stat.info)
+
+        @self.route('/metrics')
+        async def metrics(request):
+            return Response(HTTPStatus.OK, self.metrics.render().encode(),
+                            content_type=METRICS_CONTENT_TYPE)
+
+        @self.route('/api/cli_status')
+        async def cli_status(request):
+            return json_response(self.stat.cli_info)
+
+        @self.route('/api/cli_workers')
+        async def cli_workers(request):
+            return json_response(self.stat.cli_workers_info)
+
+        @self.route('/api/stream_status')
+        async def stream_status(request):
+            try:
+                interval = max(float(request.args.get('interval', DEFAULT_STREAM_INTERVAL)),
+                               MIN_STREAM_INTERVAL)
+            except ValueError:
+                return error_response(HTTPStatus.BAD_REQUEST, 'Wrong request parameter')
+
+            async def events():
+                while True:
+                    yield self.stat.frame()
+                    await asyncio.sleep(interval)
+            return StreamingResponse(HTTPStatus.OK, events(), content_type=STREAM_CONTENT_TYPE,
+                                     headers={'Cache-Control': 'no-cache'})
+
+        @self.route('/')
+        async def index(request):
+            return Response(HTTPStatus.OK, b'Welcome to Funicorn',
+                            content_type='text/html; charset=utf-8')
+
+        def admin_route(path, action, methods=('GET',)):
+            @self.route(path, methods=methods)
+            async def handler(request):
+                try:
+                    return json_response(await self.run_blocking(action, request.args))
+                except PermissionError as e:
+                    return error_response(HTTPStatus.FORBIDDEN, str(e))
+                except (KeyError, ValueError) as e:
+                    # Missing or invalid arguments, or an action not allowed in this state
+                    return error_response(HTTPStatus.BAD_REQUEST, f'Wrong request parameter: {e}')
+
+        @self.route('/api/profile')
+        async def profile(request):
+            try:
+                kwargs = profile_kwargs(request.args)
+            except ValueError as e:
+                return error_response(HTTPStatus.BAD_REQUEST, str(e))
+            try:
+                body = await self.run_blocking(lambda: self.funicorn_app.profile(**kwargs))
+            except WorkerControlError as e:
+                return error_response(HTTPStatus.BAD_REQUEST, str(e))
+            filename = f"funicorn-{kwargs['target']}.collapsed"
+            return Response(HTTPStatus.OK, body.encode(), content_type=COLLAPSED_CONTENT_TYPE,
+                            headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+        @self.route('/api/tracemalloc')
+        async def tracemalloc(request):
+            try:
+                kwargs = tracemalloc_kwargs(request.args)
+                return json_response(await self.run_blocking(
+                    lambda: self.funicorn_app.tracemalloc(**kwargs)))
+            except (WorkerControlError, RuntimeError, ValueError) as e:
+                return error_response(HTTPStatus.BAD_REQUEST, str(e))
+
+        def split_devices(args):
+            gpu_devices = args.get('gpu_devices')
+            return gpu_devices.split(',') if gpu_devices is not None else None
+
+        def deploy_version(args):
+            model_cls = args.get('model_cls')
+            check_deploy_allowed(model_cls, self.deploy_models)
+            if model_cls is not None:
+                pkg, model_cls = split_class_from_path(model_cls)
+            model_init_kwargs = args.get('model_init_kwargs')
+            if model_init_kwargs:
+                model_init_kwargs = dict(kwarg.split(':')
+                                         for kwarg in model_init_kwargs.split(','))
+            return self.funicorn_app.deploy_version(
+                args['version'], model_cls=model_cls,
+                model_init_kwargs=model_init_kwargs,
+                num_workers=args.get('num_workers'),
+                gpu_devices=split_devices(args),
+                traffic=float(args.get('traffic', 0)))
+
+        def shift_traffic(args):
+            if args.get('step') is not None:
+                return self.funicorn_app.rollout_version(
+                    args['version'], step=float(args['step']),
+                    interval=float(args.get('interval', 30)))
+            return self.funicorn_app.shift_traffic(args['version'], float(args['percent']))
+
+        app = self.funicorn_app
+        admin_route('/api/resume', lambda args: app.resume_all_workers())
+        admin_route('/api/idle', lambda args: app.idle_all_workers())
+        admin_route('/api/terminate', lambda args: app.terminate_all_workers())
+        admin_route('/api/restart', lambda args: app.restart_all_workers(
+            rolling=args.get('rolling', 'false').lower() == 'true',
+            wave_size=args.get('wave_size')))
+        admin_route('/api/add_workers', lambda args: app.add_more_workers(
+            args.get('num_workers'), split_devices(args)))
+        admin_route('/api/versions', lambda args: app.versions_info())
+        admin_route('/api/memory', lambda args: app.memory_info())
+        admin_route('/api/deploy', deploy_version, methods=('POST',))
+        admin_route('/api/shift_traffic', shift_traffic)
+        admin_route('/api/rollback', lambda args: app.rollback())
+        admin_route('/api/release', lambda args: app.release_version(args['version']))
+
+    async def dispatch(self, request):
+        start_time = time.time()
+        endpoint = request.path if request.path in self.routes else 'unmatched'
+        if self.tracer is not None and endpoint.startswith('/api/predict'):
+            request.trace = self.tracer.start(request.headers, endpoint)
+        response = await self._dispatch(request)
+        latency = time.time() - start_time
+        self._requests_metric.inc(endpoint=endpoint, code=response.status.value)
+        self._latency_metric.observe(latency, endpoint=endpoint)
+        if endpoint.startswith('/api/predict'):
+            self.stat.record_latency(latency)
+        if request.trace is not None:
+            self.tracer.finish(request.trace, response.status.value)
+            response.headers[TRACE_ID_HEADER] = request.trace.trace_id
+        return response
+
+    async def _dispatch(self, request):
+        methods, handler = self.routes.get(request.path, (None, None))
+        if handler is None:
+            return error_response(HTTPStatus.NOT_FOUND, 'Api Not Found')
+        if request.method not in methods:
+            return error_response(HTTPStatus.METHOD_NOT_ALLOWED, 'Method Not Allowed')
+        try:
+            return await handler(request)
+        except PredictionError as e:
+            self.stat.increment('crashes')
+            return error_response(HTTPStatus.INTERNAL_SERVER_ERROR, f'Prediction failed: {e}')
+        except Exception:
+            self.stat.increment('crashes')
+            self.logger.error(traceback.format_exc())
+            return error_response(HTTPStatus.INTERNAL_SERVER_ERROR, 'Internal server error')
+
+    async def read_request(self, reader, writer):
+        '''Read one request, None when the client closed the connection'''
+        line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+        if not line:
+            return None
+        method, target, version = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        # A slow client must not hold the connection forever
+        return await asyncio.wait_for(
+            self._read_message(reader, writer, Request(method, target, version, {})),
+            REQUEST_TIMEOUT)
+
+    async def _read_message(self, reader, writer, request):
+        '''Read the headers and the body of `request`'''
+        headers = request.headers
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise TooManyHeaders(f'More than {MAX_HEADERS} headers')
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        if not chunked and request.content_length > MAX_BODY_SIZE:
+            raise MaxFileSizeExeeded('Request body too large')
+        if headers.get('expect', '').lower() == '100-continue' and \
+                (chunked or request.content_length):
+            # Clients like curl wait for it before sending the body
+            writer.write(CONTINUE)
+            await writer.drain()
+        if chunked:
+            body = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                body.extend(await reader.readexactly(size))
+                await reader.readexactly(2)
+                if len(body) > MAX_BODY_SIZE:
+                    raise MaxFileSizeExeeded('Request body too large')
+            request.body = bytes(body)
+        elif request.content_length:
+            request.body = await reader.readexactly(request.content_length)
+        return request
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader, writer)
+                except MaxFileSizeExeeded:
+                    response = error_response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                              'Request Size Exeeded')
+                    writer.write(response.render(keep_alive=False))
+                    await writer.drain()
+                    break
+                except TooManyHeaders:
+                    response = error_response(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE,
+                                              'Too Many Headers')
+                    writer.write(response.render(keep_alive=False))
+                    await writer.drain()
+                    break
+                except ValueError:
+                    writer.write(error_response(HTTPStatus.BAD_REQUEST, 'Bad Request')
+                                 .render(keep_alive=False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                response = await self.dispatch(request)
+                await response.write(writer, request.keep_alive)
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection,
+                                            host=self.host, port=self.port,
+                                            backlog=self.backlog,
+                                            limit=MAX_HEADER_SIZE)
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        if self.funicorn_app is None:
+            raise InitializationError(
+                'Cannot start HTTP service. Funicorn app is required when start http service!')
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.logger.info(
+            f'Service is running on http://{self.host}:{self.port}')
+        asyncio.run(self.serve())
@@ -0,0 +1,9 @@
+from .base import Backend
+from .redis_backend import RedisBackend
+
+
+def get_backend(url):
+    '''Build a backend from its url'''
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url=url)
+    raise ValueError(f'Not supported backend url: {url}')
@@ -0,0 +1,42 @@
+class Backend():
+    '''Interface of a task queue / result store shared by frontends and workers
+
+    Frontends call `put_task` and `pop_result`. Workers call `get_tasks`,
+    `set_result` and `ack`, and take over tasks of dead workers with
+    `reclaim_tasks`. Every task is a `(delivery_id, Task)` pair on the worker
+    side, `delivery_id` being what `ack` expects.
+    '''
+
+    def put_task(self, task):
+        raise NotImplementedError
+
+    def get_tasks(self, consumer, count=1, timeout=None):
+        '''Return up to `count` tasks, waiting at most `timeout` seconds'''
+        raise NotImplementedError
+
+    def ack(self, delivery_ids):
+        raise NotImplementedError
+
+    def reclaim_tasks(self, consumer, min_idle_time, count=1):
+        '''Take over tasks not acknowledged for `min_idle_time` seconds'''
+        raise NotImplementedError
+
+    def delivery_counts(self, delivery_ids):
+        '''{delivery_id: number of times it was delivered}, unknown ones left out'''
+        return {}
+
+    def set_result(self, request_id, result):
+        raise NotImplementedError
+
+    def pop_result(self, request_id, timeout=None):
+        '''Return the result of `request_id` or None if it is not ready after `timeout` seconds'''
+        raise NotImplementedError
+
+    def pop_results(self, request_ids):
+        '''{request_id: result} of the results already available among `request_ids`'''
+        results = {request_id: self.pop_result(request_id, timeout=0)
+                   for request_id in request_ids}
+        return {request_id: ret for request_id, ret in results.items() if ret is not None}
+
+    def close(self):
+        pass
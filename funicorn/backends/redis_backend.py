@@ -0,0 +1,127 @@
+import pickle
+
+from .base import Backend
+
+DEFAULT_STREAM = 'funicorn:tasks'
+DEFAULT_GROUP = 'funicorn-workers'
+DEFAULT_RESULT_PREFIX = 'funicorn:result:'
+DEFAULT_RESULT_TTL = 600
+
+
+class RedisBackend(Backend):
+    '''Redis streams backend to feed workers running on many hosts
+
+    Tasks are appended to a stream read through a consumer group: every task
+    is delivered to a single worker and stays pending until acknowledged, so
+    tasks of a dead worker are redelivered with `reclaim_tasks`. Results are
+    pushed into per-request lists to let frontends block on them.
+
+    Parameters
+    ----------
+    url : str
+        Redis url, e.g. redis://localhost:6379/0
+    client : redis.Redis
+        Already built client (or a fakeredis stand-in), `url` is ignored
+    '''
+
+    def __init__(self, url='redis://localhost:6379/0', client=None,
+                 stream=DEFAULT_STREAM, group=DEFAULT_GROUP,
+                 result_prefix=DEFAULT_RESULT_PREFIX,
+                 result_ttl=DEFAULT_RESULT_TTL, maxlen=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError(
+                    'RedisBackend requires `redis`. Install it with `pip install redis`')
+            client = redis.Redis.from_url(url)
+        self.url = url
+        self.client = client
+        self.stream = stream
+        self.group = group
+        self.result_prefix = result_prefix
+        self.result_ttl = result_ttl
+        self.maxlen = maxlen
+        self._create_group()
+
+    def _create_group(self):
+        try:
+            self.client.xgroup_create(self.stream, self.group,
+                                      id='0', mkstream=True)
+        except Exception as e:
+            # The group has been created by another frontend or worker
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def _result_key(self, request_id):
+        return f'{self.result_prefix}{request_id}'
+
+    def put_task(self, task):
+        self.client.xadd(self.stream, {'task': pickle.dumps(task)},
+                         maxlen=self.maxlen, approximate=True)
+
+    def _decode(self, messages):
+        return [(delivery_id, pickle.loads(fields[b'task']))
+                for delivery_id, fields in messages if fields]
+
+    def get_tasks(self, consumer, count=1, timeout=None):
+        block = None if timeout is None else max(1, int(timeout * 1000))
+        response = self.client.xreadgroup(self.group, consumer,
+                                          {self.stream: '>'},
+                                          count=count, block=block)
+        if not response:
+            return []
+        _, messages = response[0]
+        return self._decode(messages)
+
+    def ack(self, delivery_ids):
+        if not delivery_ids:
+            return
+        pipe = self.client.pipeline()
+        pipe.xack(self.stream, self.group, *delivery_ids)
+        pipe.xdel(self.stream, *delivery_ids)
+        pipe.execute()
+
+    def reclaim_tasks(self, consumer, min_idle_time, count=1):
+        response = self.client.xautoclaim(self.stream, self.group, consumer,
+                                          min_idle_time=int(
+                                              min_idle_time * 1000),
+                                          start_id='0-0', count=count)
+        return self._decode(response[1])
+
+    def delivery_counts(self, delivery_ids):
+        pipe = self.client.pipeline(transaction=False)
+        for delivery_id in delivery_ids:
+            pipe.xpending_range(self.stream, self.group, min=delivery_id,
+                                max=delivery_id, count=1)
+        return {delivery_id: pending[0]['times_delivered']
+                for delivery_id, pending in zip(delivery_ids, pipe.execute()) if pending}
+
+    def set_result(self, request_id, result):
+        key = self._result_key(request_id)
+        pipe = self.client.pipeline()
+        pipe.rpush(key, pickle.dumps(result))
+        pipe.expire(key, self.result_ttl)
+        pipe.execute()
+
+    def pop_result(self, request_id, timeout=None):
+        key = self._result_key(request_id)
+        if timeout == 0:
+            value = self.client.lpop(key)
+        else:
+            response = self.client.blpop([key], timeout=timeout or 0)
+            value = response[1] if response else None
+        return None if value is None else pickle.loads(value)
+
+    def pop_results(self, request_ids):
+        # One round trip for all the requests a frontend waits for
+        request_ids = list(request_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for request_id in request_ids:
+            pipe.lpop(self._result_key(request_id))
+        return {request_id: pickle.loads(value)
+                for request_id, value in zip(request_ids, pipe.execute())
+                if value is not None}
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,387 @@
+import base64
+import glob
+import http.client
+import itertools
+import json
+import os
+import random
+import statistics
+import threading
+import time
+import uuid
+from collections import namedtuple
+from urllib.parse import urlencode
+
+from .stat import QuantileSketch
+from .table import print_table
+
+__all__ = ['LoadGenerator', 'HTTPTarget', 'ThriftTarget', 'BenchResult', 'Payload',
+           'image_payloads', 'tensor_payloads', 'url_payloads', 'recorded_payloads',
+           'load_payloads',
+           'LOAD_MODES', 'BENCH_QUANTILES']
+
+LOAD_MODES = ('closed', 'poisson', 'fixed')
+BENCH_QUANTILES = {'p50': 0.5, 'p75': 0.75, 'p90': 0.9, 'p99': 0.99,
+                   'p99.9': 0.999, 'p99.99': 0.9999}
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+# A corrected sample is added per expected interval of a stall, up to this many
+MAX_CORRECTED_SAMPLES = 10000
+
+# One request: `body` is raw bytes, `image` the image bytes sent over Thrift
+Payload = namedtuple('Payload', ['method', 'path', 'headers', 'body', 'image'])
+
+
+def _multipart(field, filename, content):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+            f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+            ).encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+    return {'Content-Type': f'multipart/form-data; boundary={boundary}'}, body
+
+
+def _image_payload(img_bytes, filename='image.jpg'):
+    headers, body = _multipart('img_bytes', filename, img_bytes)
+    return Payload('POST', '/api/predict_img_bytes', headers, body, img_bytes)
+
+
+def image_payloads(path=None, size=(224, 224)):
+    '''Image files of `path`, a file or a directory, or a random image without it'''
+    if path is None:
+        import numpy as np
+        from .utils import img_arr_to_img_bytes
+        img_arr = np.random.randint(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        return [_image_payload(img_arr_to_img_bytes(img_arr, quality=90))]
+    paths = [path] if os.path.isfile(path) else sorted(
+        file_path for file_path in glob.glob(os.path.join(path, '**', '*'), recursive=True)
+        if file_path.lower().endswith(IMAGE_EXTENSIONS))
+    if not paths:
+        raise ValueError(f'No image found in {path}')
+    payloads = []
+    for file_path in paths:
+        with open(file_path, 'rb') as f:
+            payloads.append(_image_payload(f.read(), os.path.basename(file_path)))
+    return payloads
+
+
+def tensor_payloads(shape, dtype='float32', count=8):
+    '''`count` random tensors of `shape`, sent as .npy'''
+    import numpy as np
+    from .utils import ndarray_to_npy_bytes, NPY_CONTENT_TYPE
+    payloads = []
+    for _ in range(count):
+        tensor = np.random.random_sample(shape).astype(dtype)
+        payloads.append(Payload('POST', '/api/predict_tensor',
+                                {'Content-Type': NPY_CONTENT_TYPE},
+                                ndarray_to_npy_bytes(tensor), None))
+    return payloads
+
+
+def url_payloads(path):
+    '''One predict_url request per line of the file `path`'''
+    with open(path) as f:
+        urls = [line.strip() for line in f if line.strip()]
+    if not urls:
+        raise ValueError(f'No url found in {path}')
+    return [Payload('GET', '/api/predict_url?' + urlencode({'url': url}), {}, b'', None)
+            for url in urls]
+
+
+def recorded_payloads(path):
+    '''Requests recorded one JSON object per line
+
+    Every line holds `path` and optionally `method` (POST by default),
+    `headers` and the base64 encoded `body`.
+    '''
+    payloads = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            body = base64.b64decode(record.get('body', ''))
+            headers = record.get('headers') or {}
+            is_image = record['path'].startswith('/api/predict_img_bytes')
+            payloads.append(Payload(record.get('method', 'POST'), record['path'],
+                                    headers, body, None if not is_image else body))
+    if not payloads:
+        raise ValueError(f'No request recorded in {path}')
+    return payloads
+
+
+def load_payloads(images=None, tensor_shape=None, tensor_dtype='float32', urls=None,
+                  recorded=None):
+    '''Payloads of the first source given, a random image by default'''
+    if tensor_shape is not None:
+        if isinstance(tensor_shape, str):
+            tensor_shape = tuple(int(dim) for dim in tensor_shape.split(','))
+        return tensor_payloads(tensor_shape, tensor_dtype)
+    if urls is not None:
+        return url_payloads(urls)
+    if recorded is not None:
+        return recorded_payloads(recorded)
+    return image_payloads(images)
+
+
+class HTTPTarget():
+    '''Keep-alive HTTP connection of one load generator thread'''
+
+    def __init__(self, host, port, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._conn = None
+
+    def send(self, payload):
+        '''Send `payload`, True on a 2xx response'''
+        if self._conn is None:
+            self._conn = http.client.HTTPConnection(self.host, self.port,
+                                                    timeout=self.timeout)
+        try:
+            self._conn.request(payload.method, payload.path, body=payload.body or None,
+                               headers=payload.headers)
+            resp = self._conn.getresponse()
+            resp.read()
+        except Exception:
+            self.close()
+            raise
+        if resp.will_close:
+            self.close()
+        return 200 <= resp.status < 300
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class ThriftTarget():
+    '''Thrift connection of one load generator thread, predict_img_bytes only'''
+
+    def __init__(self, host, port, timeout=10):
+        from .client import ClientRPC
+        self._client_cls = ClientRPC
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._client = None
+
+    def send(self, payload):
+        if payload.image is None:
+            raise ValueError('Only images can be sent over Thrift')
+        if self._client is None:
+            self._client = self._client_cls(self.port, host=self.host,
+                                            timeout_ms=int(self.timeout * 1000))
+        try:
+            self._client.predict_img_bytes(payload.image)
+        except Exception:
+            self.close()
+            raise
+        return True
+
+    def close(self):
+        if self._client is not None and self._client.transport is not None:
+            self._client.transport.close()
+        self._client = None
+
+
+def _sketch(latencies):
+    sketch = QuantileSketch()
+    for latency in latencies:
+        sketch.add(latency)
+    return sketch
+
+
+def _corrected_sketch(latencies, expected_interval):
+    '''Latencies with the samples a stall kept a closed-loop client from sending
+
+    As HdrHistogram's `recordValueWithExpectedInterval`: a response taking
+    `latency` > `expected_interval` hid the requests the client would have
+    sent meanwhile, waiting `latency - k * expected_interval` each, down
+    to `expected_interval`.
+    '''
+    sketch = QuantileSketch()
+    for latency in latencies:
+        sketch.add(latency)
+        if expected_interval <= 0:
+            continue
+        missing = min(int(latency // expected_interval) - 1, MAX_CORRECTED_SAMPLES)
+        for k in range(1, missing + 1):
+            sketch.add(latency - k * expected_interval)
+    return sketch
+
+
+def _summary(sketch):
+    '''Percentiles and log-spaced histogram in milliseconds'''
+    summary = {'count': sketch.count,
+               'mean': round(1000 * sketch.total / sketch.count, 3) if sketch.count else 0}
+    for name, q in BENCH_QUANTILES.items():
+        summary[name] = round(1000 * sketch.quantile(q), 3)
+    summary['max'] = round(1000 * sketch.quantile(1), 3)
+    # [upper bound (ms), count] of every non-empty bucket
+    summary['histogram'] = [[round(1000 * sketch.gamma ** idx, 3), sketch.buckets[idx]]
+                            for idx in sorted(sketch.buckets)]
+    if sketch.zeros:
+        summary['histogram'].insert(0, [0, sketch.zeros])
+    return summary
+
+
+class BenchResult():
+    '''Latencies of a load test, corrected for coordinated omission
+
+    Open-loop latencies are measured from the time a request was scheduled,
+    so a stalled server is charged for the requests queued behind it. The
+    `uncorrected` ones are measured from the time they were actually sent.
+    Closed-loop latencies are corrected with the median latency as the
+    expected interval between the requests of a connection.
+    '''
+
+    def __init__(self, config, duration, latencies, service_times, errors, send_lags):
+        self.config = config
+        self.duration = duration
+        self.errors = errors
+        self.requests = len(latencies)
+        self.throughput = round(self.requests / duration, 2) if duration else 0
+        uncorrected = _sketch(service_times)
+        if config['mode'] == 'closed':
+            expected_interval = statistics.median(service_times) if service_times else 0
+            corrected = _corrected_sketch(service_times, expected_interval)
+        else:
+            expected_interval = None
+            corrected = _sketch(latencies)
+        self.expected_interval = expected_interval
+        self.corrected = _summary(corrected)
+        self.uncorrected = _summary(uncorrected)
+        self.max_send_lag = round(1000 * max(send_lags), 3) if send_lags else 0
+
+    def to_dict(self):
+        return {'config': self.config, 'duration': round(self.duration, 3),
+                'requests': self.requests, 'errors': self.errors,
+                'throughput': self.throughput,
+                'expected_interval_ms': None if self.expected_interval is None
+                else round(1000 * self.expected_interval, 3),
+                'max_send_lag_ms': self.max_send_lag,
+                'latency_ms': {'corrected': self.corrected, 'uncorrected': self.uncorrected}}
+
+    def table(self):
+        config = self.config
+        rate = f" @ {config['rate']} req/s" if config['mode'] != 'closed' else ''
+        lines = [f"> {config['protocol']}://{config['host']}:{config['port']} "
+                 f"{config['mode']}{rate}, {config['connections']} connections, "
+                 f"{config['duration']}s after {config['warmup']}s warmup"]
+        lines.extend(print_table([
+            ['requests', 'errors', 'throughput (req/s)', 'max send lag (ms)'],
+            [self.requests, self.errors, self.throughput, self.max_send_lag]],
+            color=(0, 255, 0)))
+        names = ['mean'] + list(BENCH_QUANTILES) + ['max']
+        rows = [['latency (ms)'] + names]
+        for title, summary in [('corrected', self.corrected),
+                               ('uncorrected', self.uncorrected)]:
+            rows.append([title] + [summary[name] for name in names])
+        lines.extend(print_table(rows, color=(0, 255, 0)))
+        return lines
+
+
+class LoadGenerator():
+    '''Send `payloads` in turn over `connections` threads
+
+    In the closed loop every connection sends its next request as soon as
+    it gets a response. In the open loop requests are scheduled at `rate`
+    per second, evenly (`fixed`) or as a Poisson process (`poisson`),
+    whether or not the previous ones are answered; a request waits for a
+    free connection when all of them are busy. Requests scheduled during
+    the first `warmup` seconds are not recorded.
+    '''
+
+    def __init__(self, target_factory, payloads, connections=10, mode='closed', rate=None,
+                 duration=10, warmup=2, config=None):
+        if mode not in LOAD_MODES:
+            raise ValueError(f'`mode` must be one of {LOAD_MODES}')
+        if mode != 'closed' and not rate:
+            raise ValueError(f'The {mode} mode needs a `rate`')
+        self.target_factory = target_factory
+        self.payloads = payloads
+        self.connections = connections
+        self.mode = mode
+        self.rate = rate
+        self.duration = duration
+        self.warmup = warmup
+        self.config = dict(config or {}, mode=mode, rate=rate, connections=connections,
+                           duration=duration, warmup=warmup)
+
+    def schedule(self):
+        '''Send times of the open loop, in seconds from the start'''
+        total = self.warmup + self.duration
+        if self.mode == 'fixed':
+            return [idx / self.rate for idx in range(int(total * self.rate))]
+        times = []
+        scheduled = random.expovariate(self.rate)
+        while scheduled < total:
+            times.append(scheduled)
+            scheduled += random.expovariate(self.rate)
+        return times
+
+    def _connection(self, conn_idx, start, schedule, counter, records):
+        target = self.target_factory()
+        measure_start = start + self.warmup
+        end = measure_start + self.duration
+        # Connections start at different payloads
+        payloads = itertools.islice(itertools.cycle(self.payloads),
+                                    conn_idx % len(self.payloads), None)
+        latencies, service_times, send_lags = [], [], []
+        errors = 0
+        try:
+            while True:
+                if schedule is None:
+                    scheduled = time.time()
+                    if scheduled >= end:
+                        break
+                else:
+                    idx = next(counter)
+                    if idx >= len(schedule):
+                        break
+                    scheduled = start + schedule[idx]
+                    delay = scheduled - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                sent = time.time()
+                try:
+                    ok = target.send(next(payloads))
+                except Exception:
+                    ok = False
+                done = time.time()
+                if scheduled < measure_start:
+                    continue
+                if not ok:
+                    errors += 1
+                    continue
+                latencies.append(done - scheduled)
+                service_times.append(done - sent)
+                send_lags.append(sent - scheduled)
+        finally:
+            target.close()
+            records.append((latencies, service_times, send_lags, errors))
+
+    def run(self):
+        schedule = None if self.mode == 'closed' else self.schedule()
+        # itertools.count is incremented atomically under the GIL
+        counter = itertools.count()
+        records = []
+        start = time.time() + 0.1
+        threads = [threading.Thread(target=self._connection, daemon=True,
+                                    args=(conn_idx, start, schedule, counter, records))
+                   for conn_idx in range(self.connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latencies, service_times, send_lags = [], [], []
+        errors = 0
+        for record in records:
+            latencies.extend(record[0])
+            service_times.extend(record[1])
+            send_lags.extend(record[2])
+            errors += record[3]
+        # Requests sent in the window may complete after it
+        duration = max(self.duration, time.time() - start - self.warmup)
+        return BenchResult(self.config, duration, latencies, service_times, errors,
+                           send_lags)
@@ -2,13 +2,16 @@ import requests
 from requests.exceptions import ConnectionError
 from ..exceptions import CommandError
 import click
-from ..funicorn import Funicorn
-from ..http_api import HttpAPI
-from ..rpc import ThriftAPI
-from ..stat import Statistic
-from ..table import print_rows_in_table
-from ..utils import get_args_from_class, split_class_from_path
-import importlib
+from ..stat import Statistic, DEFAULT_STREAM_INTERVAL
+from ..logger import configure_logging
+from ..table import print_rows_in_table, print_table
+from ..tracing import Tracer, read_traces, SPAN_NAMES, DEFAULT_TRACE_FILE
+from ..profiler import PROFILE_TARGETS, DEFAULT_PROFILE_DURATION, DEFAULT_SAMPLE_INTERVAL
+from ..memory import TRACEMALLOC_ACTIONS, DEFAULT_TOP
+from ..bench import LoadGenerator, HTTPTarget, ThriftTarget, LOAD_MODES, load_payloads
+from ..tune import Tuner, funicorn_command
+from ..tune import DEFAULT_BATCH_SIZES, DEFAULT_BATCH_TIMEOUTS, DEFAULT_NUM_WORKERS
+import json
 import os
 import sys
 import time
@@ -40,28 +43,103 @@ funicorn_app_options = [
                  default=10, help='Batch timeout (ms)'),
     click.option('--max-queue-size', type=int,
                  default=1000, help='Max queue size'),
+    click.option('--dispatch-mode', type=click.Choice(['direct', 'queue']),
+                 default='direct',
+                 help='Put tasks straight into worker queues or through a dispatcher thread'),
+    click.option('--backend-url', type=str, default=None,
+                 help='Shared task/result backend, e.g. redis://localhost:6379/0 [optional]'),
+    click.option('--model-version', type=str, default='v1',
+                 help='Version name of the served model'),
+    click.option('--restart-wave-size', type=int, default=1,
+                 help='A number of workers replaced at once by rolling restart'),
+    click.option('--max-requests', type=int, default=None,
+                 help='Recycle a worker after this many tasks [optional]'),
+    click.option('--max-requests-jitter', type=int, default=0,
+                 help='Random extra tasks per worker before it is recycled'),
+    click.option('--max-rss', type=float, default=None,
+                 help='Recycle a worker above this resident memory (MB) [optional]'),
     click.option('--http-host', type=str, default='0.0.0.0', help='HTTP host'),
     click.option('--http-port', type=int, default=5000,
                  required=True, help='HTTP port'),
     click.option('--http-threads', type=int, default=10, help='HTTP threads'),
+    click.option('--http-server', type=click.Choice(['waitress', 'asyncio']),
+                 default='waitress',
+                 help='Thread-per-request waitress server or asyncio server'),
+    click.option('--decode-workers', type=int, default=4,
+                 help='Size of the image decoding pool'),
+    click.option('--decode-processes', is_flag=True,
+                 help='Decode images in processes instead of threads'),
+    click.option('--fetch-urls/--no-fetch-urls', default=True,
+                 help='Download and decode predict_url images in the frontend'),
+    click.option('--preserialize', is_flag=True,
+                 help='Serialize results to the response format in the workers'),
+    click.option('--decode-size', type=str, default=None,
+                 help='Decode images near SIZE or WIDTH,HEIGHT, defaults to model_cls.input_size'),
+    click.option('--trace-sample-rate', type=float, default=0,
+                 help='Fraction of predict requests traced, 0 to disable tracing'),
+    click.option('--trace-file', type=str, default=DEFAULT_TRACE_FILE,
+                 help='Rotating file the sampled traces are exported to'),
+    click.option('--deploy-models', type=str, default=None,
+                 help='Model classes /api/deploy may load, separated by commas. '
+                      'Deploying is disabled without it'),
     click.option('--rpc-host', type=str, default='0.0.0.0',
                  help='RPC (Thrift) host'),
     click.option('--rpc-port', type=int, default=None,
                  help='RPC (Thrift) port'),
     click.option('--rpc-threads', type=int, default=10,
                  help='A number of RPC threads'),
+    click.option('--remote-host', type=str, default='127.0.0.1',
+                 help='Host remote workers connect to'),
+    click.option('--remote-port', type=int, default=None,
+                 help='Port remote workers connect to [optional]'),
+    click.option('--remote-authkey', type=str, default=None, envvar='FUNICORN_REMOTE_AUTHKEY',
+                 help='Secret shared with remote workers, prefer the FUNICORN_REMOTE_AUTHKEY variable'),
+    click.option('--remote-version', type=str, default=None,
+                 help='Model version of the remote workers, the active one when they connect by default'),
     click.option('--gpu-devices', type=str, default=None, help='GPU devices'),
     click.option('--debug', type=bool, default=False, help='debug'),
+    click.option('--log-async', is_flag=True, default=False,
+                 help='Write logs from a background thread'),
+    click.option('--log-format', type=click.Choice(['color', 'json']),
+                 default='color', help='Log format'),
+    click.option('--log-rate-limit', type=float, default=None,
+                 help='Max logs per second of each message type'),
+    click.option('--log-sample-rate', type=float, default=None,
+                 help='Fraction of logs kept for each message type'),
+    click.option('--log-dir', type=str, default=None,
+                 help='Directory of per-worker log files'),
     click.argument('model-init-kwargs', nargs=-1),
 ]
 
 
+payload_options = [
+    click.option('--images', type=str, default=None,
+                 help='Image file or directory sent to predict_img_bytes'),
+    click.option('--tensor-shape', type=str, default=None,
+                 help='Random tensors of this shape sent to predict_tensor, e.g. 3,224,224'),
+    click.option('--tensor-dtype', type=str, default='float32', help='Dtype of the tensors'),
+    click.option('--urls', type=str, default=None,
+                 help='File of urls, one per line, sent to predict_url'),
+    click.option('--recorded', type=str, default=None,
+                 help='Recorded requests to replay, one JSON object per line'),
+]
+
+load_options = [
+    click.option('--mode', type=click.Choice(LOAD_MODES), default='closed',
+                 help='Closed loop, or open loop at --rate with Poisson or fixed arrivals'),
+    click.option('--rate', type=float, default=None,
+                 help='Requests per second of the open loop'),
+    click.option('-c', '--connections', type=int, default=10,
+                 help='A number of connections'),
+]
+
+
 def cli_requests(url, method='get', params=None, timeout=1):
     try:
         if method == 'get':
             resp = requests.get(url, params=params, timeout=timeout)
         elif method == 'post':
-            resp = requests.post(url, timeout=timeout)
+            resp = requests.post(url, params=params, timeout=timeout)
         return resp.json()
     except ConnectionError:
         print('Cannot connect to service! Service may not be started or stopped.')
@@ -76,19 +154,90 @@ def add_options(options):
     return _add_options
 
 
+def _rate(current, previous, key, elapsed):
+    return round((current[key] - previous[key]) / elapsed, 2) if previous else 0
+
+
+def dashboard_lines(frame, previous=None):
+    '''Live dashboard of a stats event, rates over the time since the `previous` one'''
+    elapsed = max(frame['time'] - previous['time'], 1e-6) if previous else 1
+    previous_workers = {wrk['wrk_id']: wrk for wrk in (previous or {}).get('workers', [])}
+    lines = [f"funicorn {frame['status']} - up {frame['uptime']}s - "
+             f"{time.strftime('%H:%M:%S', time.localtime(frame['time']))}"]
+    lines.extend(print_table([
+        ['req/s', 'res/s', 'crashes/s', 'queue', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)'],
+        [_rate(frame, previous, 'total_req', elapsed),
+         _rate(frame, previous, 'total_res', elapsed),
+         _rate(frame, previous, 'crashes', elapsed),
+         sum(wrk['queue'] or 0 for wrk in frame['workers']),
+         frame['latency_p50'], frame['latency_p90'], frame['latency_p99']]],
+        color=(0, 255, 0)))
+    rows = [['worker', 'version', 'tasks/s', 'queue', 'utilization', 'batch fill',
+             'p99 model (s)', 'errors/s', 'error %', 'rss (MB)']]
+    for wrk in frame['workers']:
+        last = previous_workers.get(wrk['wrk_id'])
+        tasks = wrk['tasks'] - last['tasks'] if last else 0
+        batches = wrk['batches'] - last['batches'] if last else 0
+        errors = wrk['errors'] - last['errors'] if last else 0
+        rows.append([wrk['wrk_id'], wrk['version'], round(tasks / elapsed, 2), wrk['queue'],
+                     round((wrk['busy_time'] - last['busy_time']) / elapsed, 2) if last else 0,
+                     round(tasks / (batches * wrk['batch_capacity']), 2) if batches else 0,
+                     wrk['p99_model_time'], round(errors / elapsed, 2),
+                     round(100 * errors / tasks, 2) if tasks else 0, wrk['rss_mb']])
+    if len(rows) == 1:
+        rows.append(['-'] * len(rows[0]))
+    lines.extend(print_table(rows, color=(0, 255, 0)))
+    return lines
+
+
+def live_status(host, port, interval=DEFAULT_STREAM_INTERVAL):
+    '''Redraw the dashboard on every event of /api/stream_status'''
+    try:
+        resp = requests.get(f'http://{host}:{port}/api/stream_status',
+                            params={'interval': interval}, stream=True, timeout=10)
+        previous = None
+        # chunk_size=None hands over every event as soon as it is received
+        for line in resp.iter_lines(chunk_size=None):
+            if not line.startswith(b'data:'):
+                continue
+            frame = json.loads(line[5:])
+            print('\033[H\033[J' + '\n'.join(dashboard_lines(frame, previous)), flush=True)
+            previous = frame
+    except (ConnectionError, requests.exceptions.ChunkedEncodingError):
+        print('Cannot connect to service! Service may not be started or stopped.')
+    except KeyboardInterrupt:
+        pass
+    exit()
+
+
 @click.command()
 @add_options(common_options)
 @click.option('--refresh', type=int, default=1, show_default=True,
               help='Refresh time')
-def status(host, port, refresh=1):
+@click.option('--workers', is_flag=True, help='Show the statistics of every worker')
+@click.option('--live', is_flag=True,
+              help='Top-like dashboard streamed over one connection')
+@click.option('--interval', type=float, default=DEFAULT_STREAM_INTERVAL, show_default=True,
+              help='Refresh time (s) of the live dashboard')
+def status(host, port, refresh=1, workers=False, live=False,
+           interval=DEFAULT_STREAM_INTERVAL):
     ''' View dashboard CLI
     '''
+    if live:
+        live_status(host, port, interval)
     if refresh < 1:
         refresh = 1
     is_print_header = True
     url = f'http://{host}:{port}/api/cli_status'
+    if workers:
+        url = f'http://{host}:{port}/api/cli_workers'
     while True:
         try:
+            if workers:
+                # One row per worker, redraw the whole table
+                print('\033[2J\033[H' + '\n'.join(cli_requests(url)))
+                time.sleep(refresh)
+                continue
             stt = cli_requests(url)
             print_rows_in_table(stt, print_headers=is_print_header)
             if is_print_header:
@@ -131,12 +280,17 @@ def worker_resume(host, port):
 
 @click.command()
 @add_options(common_options)
-def worker_restart(host, port):
+@click.option('--rolling', is_flag=True, default=False, show_default=True,
+              help='Replace workers wave by wave without downtime')
+@click.option('--wave-size', type=int, default=None, show_default=True,
+              help='A number of workers replaced at once in rolling mode')
+def worker_restart(host, port, rolling=False, wave_size=None):
     ''' Restart all workers CLI
     '''
     url = f'http://{host}:{port}/api/restart'
     print('> Waiting for restart to complete...')
-    stt = cli_requests(url)
+    params = {'rolling': str(rolling).lower(), 'wave_size': wave_size}
+    stt = cli_requests(url, params=params, timeout=None)
     print('> ' + stt)
 
 
@@ -153,14 +307,335 @@ def add_workers(host, port, num_workers, gpu_devices):
     print('> ' + stt)
 
 
+@click.command()
+@add_options(common_options)
+@click.option('--version', type=str, required=True, help='New model version')
+@click.option('--model-cls', type=str, default=None,
+              help='Model class of the new version [optional]')
+@click.option('--num-workers', type=int, default=None,
+              help='A number of workers of the new version')
+@click.option('--gpu-devices', type=str, default=None, help='GPU devices')
+@click.option('--traffic', type=float, default=0,
+              help='Initial traffic percentage of the new version')
+@click.argument('model-init-kwargs', nargs=-1)
+def deploy_version(host, port, version, model_cls=None, num_workers=None,
+                   gpu_devices=None, traffic=0, model_init_kwargs=None):
+    ''' Load a new model version next to the serving one CLI
+    '''
+    url = f'http://{host}:{port}/api/deploy'
+    print(f'> Deploying model version {version}...')
+    params = {'version': version, 'model_cls': model_cls,
+              'num_workers': num_workers, 'gpu_devices': gpu_devices,
+              'traffic': traffic,
+              'model_init_kwargs': ','.join(model_init_kwargs) or None}
+    stt = cli_requests(url, method='post', params=params, timeout=None)
+    print('> ' + str(stt))
+
+
+@click.command()
+@add_options(common_options)
+@click.option('--version', type=str, required=True, help='Model version')
+@click.option('--percent', type=float, required=True,
+              help='Traffic percentage routed to the version')
+@click.option('--step', type=float, default=None,
+              help='Shift gradually by this percentage [optional]')
+@click.option('--interval', type=float, default=30,
+              help='Seconds between two gradual steps')
+def shift_traffic(host, port, version, percent, step=None, interval=30):
+    ''' Shift traffic between model versions CLI
+    '''
+    url = f'http://{host}:{port}/api/shift_traffic'
+    params = {'version': version, 'percent': percent,
+              'step': step, 'interval': interval}
+    stt = cli_requests(url, params=params)
+    print('> ' + json.dumps(stt))
+
+
+@click.command()
+@add_options(common_options)
+def rollback(host, port):
+    ''' Send all traffic back to the previous model version CLI
+    '''
+    url = f'http://{host}:{port}/api/rollback'
+    stt = cli_requests(url)
+    print('> ' + json.dumps(stt))
+
+
+@click.command()
+@add_options(common_options)
+@click.option('--version', type=str, required=True, help='Model version')
+def release_version(host, port, version):
+    ''' Release the worker pool of a model version CLI
+    '''
+    url = f'http://{host}:{port}/api/release'
+    print(f'> Waiting for model version {version} to drain...')
+    stt = cli_requests(url, params={'version': version}, timeout=None)
+    print('> ' + stt)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@add_options(common_options)
+@click.option('--target', type=click.Choice(PROFILE_TARGETS), default='workers',
+              help='Process(es) to profile')
+@click.option('--worker-id', type=int, default=None, help='Worker to profile with --target worker')
+@click.option('--duration', type=float, default=DEFAULT_PROFILE_DURATION,
+              help='Profiling time (s)')
+@click.option('--interval', type=float, default=DEFAULT_SAMPLE_INTERVAL,
+              help='Time between two stack samples (s)')
+@click.option('--idle', is_flag=True, help='Also sample threads waiting for work')
+@click.option('-o', '--output', type=str, default=None,
+              help='Collapsed stacks file, defaults to funicorn-<target>.collapsed')
+def profile(host, port, target, worker_id=None, duration=DEFAULT_PROFILE_DURATION,
+            interval=DEFAULT_SAMPLE_INTERVAL, idle=False, output=None):
+    ''' Sample the stacks of the frontend or workers CLI
+    '''
+    url = f'http://{host}:{port}/api/profile'
+    params = {'target': target, 'duration': duration, 'interval': interval,
+              'idle': str(idle).lower()}
+    if worker_id is not None:
+        params['worker_id'] = worker_id
+    print(f'> Profiling {target} for {duration}s...')
+    try:
+        resp = requests.get(url, params=params, timeout=duration + 30)
+    except ConnectionError:
+        print('Cannot connect to service! Service may not be started or stopped.')
+        exit()
+    if resp.status_code != 200:
+        print('> ' + resp.json()['error_message'])
+        exit(1)
+    output = output or f'funicorn-{target}.collapsed'
+    with open(output, 'w') as f:
+        f.write(resp.text)
+    print(f'> {len(resp.text.splitlines())} stacks written to {output}, '
+          f'render them with flamegraph.pl or speedscope')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@add_options(common_options)
+@click.option('--action', type=click.Choice(TRACEMALLOC_ACTIONS), default=None,
+              help='Start, snapshot or stop tracemalloc, without it show the queue sizes')
+@click.option('--target', type=click.Choice(PROFILE_TARGETS), default='workers',
+              help='Process(es) running the tracemalloc action')
+@click.option('--worker-id', type=int, default=None, help='Worker with --target worker')
+@click.option('--top', type=int, default=DEFAULT_TOP, help='A number of allocation sites')
+@click.option('--key-type', type=click.Choice(['lineno', 'filename', 'traceback']),
+              default='lineno', help='Group allocations by line, file or traceback')
+def memory(host, port, action=None, target='workers', worker_id=None, top=DEFAULT_TOP,
+           key_type='lineno'):
+    ''' Inspect the memory of the frontend and workers CLI
+    '''
+    if action is None:
+        info = cli_requests(f'http://{host}:{port}/api/memory', timeout=10)
+        print(f"> frontend pid {info['frontend']['pid']}: RSS {info['frontend']['rss_mb']}MB, "
+              f"{info['result_dict']['items']} pending results "
+              f"~{info['result_dict']['bytes'] / 1024:.1f}KB")
+        rows = [['worker', 'pid', 'backlog', 'backlog (KB)', 'avg task (KB)', 'rss (MB)']]
+        for wrk in info['workers']:
+            rows.append([wrk['wrk_id'], wrk['pid'], wrk['backlog'],
+                         round(wrk['backlog_bytes'] / 1024, 1),
+                         round(wrk['avg_task_bytes'] / 1024, 1), wrk['rss_mb']])
+        if len(rows) > 1:
+            print('\n'.join(print_table(rows, color=(0, 255, 0))))
+        return
+    params = {'action': action, 'target': target, 'top': top, 'key_type': key_type}
+    if worker_id is not None:
+        params['worker_id'] = worker_id
+    replies = cli_requests(f'http://{host}:{port}/api/tracemalloc', params=params, timeout=60)
+    if 'error_message' in replies:
+        print('> ' + replies['error_message'])
+        exit(1)
+    for name, info in replies.items():
+        print(f"> {name}: RSS {info['rss_mb']}MB, tracing {info['tracing']}"
+              + (f", traced {info['traced_mb']}MB (peak {info['traced_peak_mb']}MB)"
+                 if info['tracing'] else ''))
+        for title, key, stats in [('top', 'size_kb', info.get('top')),
+                                  ('growth', 'size_diff_kb', info.get('growth'))]:
+            if not stats:
+                continue
+            rows = [[title, 'KB', 'count']]
+            for stat in stats:
+                rows.append([' < '.join(stat['site']), stat[key],
+                             stat.get('count', stat.get('count_diff'))])
+            print('\n'.join(print_table(rows, color=(0, 255, 0))))
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@add_options(common_options)
+@click.option('--protocol', type=click.Choice(['http', 'thrift']), default='http',
+              help='Frontend under test')
+@add_options(load_options)
+@click.option('-d', '--duration', type=float, default=30, help='Measured duration (s)')
+@click.option('--warmup', type=float, default=5, help='Unrecorded load before (s)')
+@add_options(payload_options)
+@click.option('--timeout', type=float, default=10, help='Request timeout (s)')
+@click.option('--json', 'json_output', type=str, default=None,
+              help='Also write the results as JSON to this file, - for stdout')
+def bench(host, port, protocol='http', mode='closed', rate=None, connections=10, duration=30,
+          warmup=5, images=None, tensor_shape=None, tensor_dtype='float32', urls=None,
+          recorded=None, timeout=10, json_output=None):
+    ''' Load test a running service CLI
+
+        Without payload options a random 224x224 JPEG image is sent.\n
+
+        Example:\n
+            funicorn-bench -p 5000 --mode poisson --rate 200 -c 32 --images ./images
+    '''
+    if mode != 'closed' and not rate:
+        raise click.UsageError(f'--rate is required by the {mode} mode')
+    payloads = load_payloads(images, tensor_shape, tensor_dtype, urls, recorded)
+    target_cls = HTTPTarget if protocol == 'http' else ThriftTarget
+    if protocol == 'thrift' and any(payload.image is None for payload in payloads):
+        raise click.UsageError('Only images can be sent over Thrift')
+    generator = LoadGenerator(lambda: target_cls(host, port, timeout), payloads,
+                              connections=connections, mode=mode, rate=rate,
+                              duration=duration, warmup=warmup,
+                              config={'protocol': protocol, 'host': host, 'port': port})
+    result = generator.run()
+    if json_output != '-':
+        print('\n'.join(result.table()))
+    if json_output is not None:
+        output = json.dumps(result.to_dict(), indent=2)
+        if json_output == '-':
+            print(output)
+        else:
+            with open(json_output, 'w') as f:
+                f.write(output)
+
+
+def _split_values(values, value_type=int):
+    return [value_type(value) for value in values.split(',') if value != '']
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--model-cls', type=str, required=True, help='Model class')
+@click.option('--gpu-devices', type=str, default=None, help='GPU devices')
+@click.option('--batch-sizes', type=str, default=','.join(map(str, DEFAULT_BATCH_SIZES)),
+              help='Batch sizes of the grid')
+@click.option('--batch-timeouts', type=str,
+              default=','.join(map(str, DEFAULT_BATCH_TIMEOUTS)),
+              help='Batch timeouts (ms) of the grid')
+@click.option('--num-workers', type=str, default=','.join(map(str, DEFAULT_NUM_WORKERS)),
+              help='Numbers of workers of the grid')
+@click.option('--refine-rounds', type=int, default=1,
+              help='Rounds of refinement around the chosen configuration')
+@click.option('--max-p99', type=float, default=None,
+              help='p99 latency target (ms), the highest throughput otherwise')
+@add_options(load_options)
+@click.option('-d', '--duration', type=float, default=10, help='Measured duration per trial (s)')
+@click.option('--warmup', type=float, default=3, help='Unrecorded load per trial (s)')
+@add_options(payload_options)
+@click.option('--json', 'json_output', type=str, default=None,
+              help='Also write the trials as JSON to this file, - for stdout')
+@click.option('--debug', type=bool, default=False, help='debug')
+@click.argument('model-init-kwargs', nargs=-1)
+def tune(model_cls, gpu_devices=None, batch_sizes=None, batch_timeouts=None, num_workers=None,
+         refine_rounds=1, max_p99=None, mode='closed', rate=None, connections=10, duration=10,
+         warmup=3, images=None, tensor_shape=None, tensor_dtype='float32', urls=None,
+         recorded=None, json_output=None, debug=False, model_init_kwargs=None):
+    ''' Search the batch size, batch timeout and number of workers CLI
+
+        The model is served in-process and loaded with each configuration
+        of a grid, then around the best one. Prints the Pareto frontier of
+        throughput against p99 latency and the funicorn command to serve
+        with the chosen configuration.\n
+
+        Example:\n
+            funicorn-tune --model-cls main.Model --tensor-shape 3,224,224 --max-p99 100
+    '''
+    from ..utils import split_class_from_path
+    if mode != 'closed' and not rate:
+        raise click.UsageError(f'--rate is required by the {mode} mode')
+    model_path = model_cls
+    pkg, model_cls = split_class_from_path(model_cls)
+    if model_init_kwargs:
+        model_init_kwargs = dict(kwarg.split(':') for kwarg in model_init_kwargs)
+    if gpu_devices:
+        gpu_devices = [gpu_id for gpu_id in gpu_devices.split(',') if gpu_id != '']
+    payloads = load_payloads(images, tensor_shape, tensor_dtype, urls, recorded)
+    tuner = Tuner(model_cls, payloads, model_init_kwargs=model_init_kwargs or None,
+                  gpu_devices=gpu_devices, connections=connections, mode=mode, rate=rate,
+                  duration=duration, warmup=warmup, max_p99=max_p99, debug=debug)
+    best = tuner.run(_split_values(batch_sizes), _split_values(batch_timeouts, float),
+                     _split_values(num_workers), refine_rounds=refine_rounds)
+    print('\n'.join(tuner.table()))
+    result = tuner.to_dict()
+    if best is None:
+        print('> No configuration served the load without errors')
+    else:
+        result['command'] = funicorn_command(best, model_path, gpu_devices, model_init_kwargs)
+        print(f"> {best.throughput} req/s with p99 {best.p99}ms:\n{result['command']}")
+    if json_output is not None:
+        output = json.dumps(result, indent=2)
+        if json_output == '-':
+            print(output)
+        else:
+            with open(json_output, 'w') as f:
+                f.write(output)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--file', 'trace_file', type=str, default=DEFAULT_TRACE_FILE,
+              help='Trace file written by funicorn --trace-sample-rate')
+@click.option('--endpoint', type=str, default=None, help='Only the requests of ENDPOINT')
+@click.option('--last', type=int, default=None, help='Only the last N requests')
+@click.option('--trace-id', type=str, default=None,
+              help='Print the stages of one request instead')
+def trace_breakdown(trace_file, endpoint=None, last=None, trace_id=None):
+    ''' Break down the latency of traced requests by stage CLI
+    '''
+    import numpy as np
+    traces = [spans for spans in read_traces(trace_file)
+              if endpoint is None or spans[0]['name'] == endpoint]
+    if trace_id is not None:
+        traces = [spans for spans in traces if spans[0]['traceId'] == trace_id]
+        if not traces:
+            print(f'> Trace {trace_id} not found in {trace_file}')
+            return
+        root, *stages = traces[-1]
+        rows = [['stage', 'start (ms)', 'duration (ms)']]
+        for span in stages:
+            rows.append([span['name'], f"{(span['timestamp'] - root['timestamp']) / 1000:.2f}",
+                         f"{span['duration'] / 1000:.2f}"])
+        rows.append(['total', '0.00', f"{root['duration'] / 1000:.2f}"])
+        print('\n'.join(print_table(rows, color=(0, 255, 0))))
+        return
+    if last is not None:
+        traces = traces[-last:]
+    if not traces:
+        print(f'> No traced requests in {trace_file}')
+        return
+    durations = {}
+    for root, *stages in traces:
+        durations.setdefault('total', []).append(root['duration'] / 1000)
+        for span in stages:
+            durations.setdefault(span['name'], []).append(span['duration'] / 1000)
+    total = np.mean(durations['total'])
+    rows = [['stage', 'requests', 'mean (ms)', 'p50', 'p90', 'p99', 'share']]
+    for name in [name for name in SPAN_NAMES if name in durations] + ['total']:
+        values = np.array(durations[name])
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        # Stages missing from a request count as 0 in the share of the mean
+        share = values.sum() / len(traces) / total if total else 0
+        rows.append([name, len(values), f'{values.mean():.2f}', f'{p50:.2f}',
+                     f'{p90:.2f}', f'{p99:.2f}', f'{share:.1%}'])
+    print(f'> {len(traces)} traced requests')
+    print('\n'.join(print_table(rows, color=(0, 255, 0))))
+
+
 @click.command(context_settings=CONTEXT_SETTINGS)
 @add_options(funicorn_app_options)
 def start(model_cls, funicorn_cls=None, http_cls=None, rpc_cls=None,
           num_workers=1, batch_size=1, batch_timeout=10,
-          max_queue_size=1000,
-          http_host='0.0.0.0', http_port=5000, http_threads=30,
-          rpc_host='0.0.0.0', rpc_port=None, rpc_threads=30,
-          gpu_devices=None, model_init_kwargs=None, debug=False):
+          max_queue_size=1000, dispatch_mode='direct', backend_url=None,
+          model_version='v1', restart_wave_size=1, max_requests=None,
+          max_requests_jitter=0, max_rss=None, http_host='0.0.0.0', http_port=5000, http_threads=30,
+          http_server='waitress', decode_workers=4, decode_processes=False,
+          decode_size=None, fetch_urls=True, preserialize=False,
+          trace_sample_rate=0, trace_file=DEFAULT_TRACE_FILE, deploy_models=None, rpc_host='0.0.0.0', rpc_port=None, rpc_threads=30,
+          remote_host='127.0.0.1', remote_port=None, remote_authkey=None,
+          remote_version=None, gpu_devices=None, model_init_kwargs=None, debug=False,
+          log_async=False, log_format='color', log_rate_limit=None,
+          log_sample_rate=None, log_dir=None):
     """ Welcome to Funicorn CLI.\n
         Funicorn CLI is about to help developers start Deep Learning service in the fastest way!\n
 
@@ -173,7 +648,32 @@ def start(model_cls, funicorn_cls=None, http_cls=None, rpc_cls=None,
             - funicorn-resume: Resume all model workers.\n
             - funicorn-terminate: Terminate all model workers.\n
             - funicorn-status: View the service's dashboard .\n
+            - funicorn-trace: Break down the latency of traced requests by stage.\n
+            - funicorn-profile: Sample the stacks of the frontend or workers.\n
+            - funicorn-memory: Inspect the memory of the frontend and workers.\n
+            - funicorn-bench: Load test the service.\n
+            - funicorn-tune: Search the batch size, batch timeout and number of workers.\n
+            - funicorn-deploy: Load a new model version.\n
+            - funicorn-shift: Shift traffic between model versions.\n
+            - funicorn-rollback: Roll back to the previous model version.\n
+            - funicorn-release: Release an old model version.\n
+            - funicorn-worker: Start workers of a shared backend on another host.\n
+            - funicorn-remote-worker: Start workers pulling tasks from a remote Funicorn.\n
     """
+    from ..funicorn import Funicorn
+    from ..http_api import HttpAPI
+    from ..async_http_api import AsyncHttpAPI
+    from ..decode import ImageDecoder
+    from ..rpc import ThriftAPI
+    from ..backends import get_backend
+    from ..remote import RemoteWorkerServer
+    from ..utils import split_class_from_path
+    if remote_port and not remote_authkey:
+        raise click.UsageError('--remote-port needs --remote-authkey or FUNICORN_REMOTE_AUTHKEY')
+    configure_logging(asynchronous=log_async, fmt=log_format,
+                      rate_limit=log_rate_limit,
+                      sample_rate=log_sample_rate, log_dir=log_dir)
+
     if funicorn_cls is None:
         funicorn_cls = Funicorn
     else:
@@ -194,6 +694,14 @@ def start(model_cls, funicorn_cls=None, http_cls=None, rpc_cls=None,
                                 batch_size=batch_size,
                                 batch_timeout=batch_timeout,
                                 max_queue_size=max_queue_size,
+                                dispatch_mode=dispatch_mode,
+                                backend=get_backend(
+                                    backend_url) if backend_url else None,
+                                model_version=model_version,
+                                restart_wave_size=restart_wave_size,
+                                max_requests=max_requests,
+                                max_requests_jitter=max_requests_jitter,
+                                max_rss=max_rss,
                                 gpu_devices=gpu_devices,
                                 model_init_kwargs=model_init_kwargs,
                                 debug=debug)
@@ -206,13 +714,26 @@ def start(model_cls, funicorn_cls=None, http_cls=None, rpc_cls=None,
     if http_port:
         if http_cls is not None:
             pkg, http_cls = split_class_from_path(http_cls)
-            assert issubclass(http_cls, HttpAPI)
+            assert issubclass(http_cls, (HttpAPI, AsyncHttpAPI))
+        elif http_server == 'asyncio':
+            http_cls = AsyncHttpAPI
         else:
             http_cls = HttpAPI
+        if decode_size:
+            decode_size = tuple(int(dim) for dim in decode_size.split(','))
+            decode_size = decode_size[0] if len(decode_size) == 1 else decode_size
+        decoder = ImageDecoder(target_size=decode_size, model_cls=model_cls,
+                               num_workers=decode_workers,
+                               use_processes=decode_processes)
+        tracer = Tracer(trace_file, sample_rate=trace_sample_rate) \
+            if trace_sample_rate > 0 else None
+        if deploy_models is not None:
+            deploy_models = [path for path in deploy_models.split(',') if path]
         http = http_cls(funicorn_app=funicorn_app, stat=stat,
                         host=http_host, port=http_port,
-                        threads=rpc_threads,
-                        debug=debug)
+                        threads=rpc_threads, decoder=decoder,
+                        fetch_urls=fetch_urls, preserialize=preserialize,
+                        tracer=tracer, deploy_models=deploy_models, debug=debug)
     if rpc_port:
         if rpc_cls is not None:
             pkg, rpc_cls = split_class_from_path(rpc_cls)
@@ -221,6 +742,96 @@ def start(model_cls, funicorn_cls=None, http_cls=None, rpc_cls=None,
             rpc_cls = ThriftAPI
         rpc = rpc_cls(funicorn_app=funicorn_app, stat=stat,
                       host=rpc_host, port=rpc_port,
-                      threads=rpc_threads,
+                      threads=rpc_threads, preserialize=preserialize,
                       debug=debug)
+    if remote_port:
+        remote = RemoteWorkerServer(funicorn_app, host=remote_host,
+                                    port=remote_port, authkey=remote_authkey,
+                                    version=remote_version, debug=debug)
+    funicorn_app.serve()
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--model-cls', type=str, required=True, help='Model class')
+@click.option('--backend-url', type=str, required=True,
+              help='Shared task/result backend, e.g. redis://localhost:6379/0')
+@click.option('--num-workers', type=int, default=1, help='A number of workers')
+@click.option('--batch-size', type=int, default=1, help='Inference batch size')
+@click.option('--batch-timeout', type=float, default=10, help='Batch timeout (ms)')
+@click.option('--gpu-devices', type=str, default=None, help='GPU devices')
+@click.option('--debug', type=bool, default=False, help='debug')
+@click.argument('model-init-kwargs', nargs=-1)
+def backend_worker(model_cls, backend_url, num_workers=1, batch_size=1,
+                   batch_timeout=10, gpu_devices=None, debug=False,
+                   model_init_kwargs=None):
+    """ Start workers consuming tasks of a shared backend.\n
+
+        Example:\n
+            funicorn-worker --model-cls main.Model --backend-url redis://10.0.0.1:6379/0 --num-workers 4
+    """
+    from ..funicorn import Funicorn
+    from ..backends import get_backend
+    from ..utils import split_class_from_path
+    pkg, model_cls = split_class_from_path(model_cls)
+    if model_init_kwargs:
+        model_init_kwargs = dict(kwarg.split(':')
+                                 for kwarg in model_init_kwargs)
+    if gpu_devices:
+        gpu_devices = [
+            gpu_id for gpu_id in gpu_devices.split(',') if gpu_id != '']
+    funicorn_app = Funicorn(model_cls=model_cls,
+                            num_workers=num_workers,
+                            batch_size=batch_size,
+                            batch_timeout=batch_timeout,
+                            gpu_devices=gpu_devices,
+                            backend=get_backend(backend_url),
+                            model_init_kwargs=model_init_kwargs,
+                            debug=debug)
     funicorn_app.serve()
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@add_options(common_options)
+@click.option('--model-cls', type=str, required=True, help='Model class')
+@click.option('--num-workers', type=int, default=1, help='A number of workers')
+@click.option('--batch-size', type=int, default=1, help='Inference batch size')
+@click.option('--prefetch', type=int, default=2,
+              help='A number of batches leased ahead by each worker')
+@click.option('--authkey', type=str, required=True, envvar='FUNICORN_REMOTE_AUTHKEY',
+              help='Secret shared with the server, prefer the FUNICORN_REMOTE_AUTHKEY variable')
+@click.option('--gpu-devices', type=str, default=None, help='GPU devices')
+@click.option('--debug', type=bool, default=False, help='debug')
+@click.argument('model-init-kwargs', nargs=-1)
+def remote_worker(host, port, model_cls, num_workers=1, batch_size=1,
+                  prefetch=2, authkey=None, gpu_devices=None, debug=False,
+                  model_init_kwargs=None):
+    """ Start workers pulling tasks from a Funicorn started with --remote-port.\n
+
+        Example:\n
+            FUNICORN_REMOTE_AUTHKEY=secret funicorn-remote-worker -h 10.0.0.1 -p 5002 --model-cls main.Model --num-workers 4
+    """
+    import multiprocessing as mp
+    from ..remote import RemoteWorker
+    from ..utils import split_class_from_path
+    pkg, model_cls = split_class_from_path(model_cls)
+    if model_init_kwargs:
+        model_init_kwargs = dict(kwarg.split(':')
+                                 for kwarg in model_init_kwargs)
+    if gpu_devices:
+        gpu_devices = [
+            gpu_id for gpu_id in gpu_devices.split(',') if gpu_id != '']
+    wrk = RemoteWorker(model_cls, host, port, prefetch=prefetch, authkey=authkey,
+                       batch_size=batch_size,
+                       model_init_kwargs=model_init_kwargs, debug=debug)
+    processes = []
+    for idx in range(num_workers):
+        gpu_id = gpu_devices[idx % len(gpu_devices)] if gpu_devices else None
+        ps = mp.Process(target=wrk.run, args=(idx, gpu_id), daemon=True,
+                        name=f'funicorn-remote-worker-{idx}')
+        ps.start()
+        processes.append(ps)
+    try:
+        for ps in processes:
+            ps.join()
+    except KeyboardInterrupt:
+        exit()
@@ -1,16 +1,15 @@
 import time
 import sys
-import cv2
 import numpy as np
+import requests
 
-from funicorn.rpc.ttypes import *
-from funicorn.rpc import FunicornService
 from funicorn.utils import (img_bytes_to_img_arr,
                             img_arr_to_img_bytes,
-                            colored_worker_name)
+                            ndarray_to_npy_bytes,
+                            colored_worker_name,
+                            NPY_CONTENT_TYPE, RAW_CONTENT_TYPE)
+from funicorn.serializers import loads, JSON_CONTENT_TYPE
 from funicorn.logger import get_logger
-from thrift.protocol.TBinaryProtocol import TBinaryProtocol
-from thrift.transport import TTransport, TSocket
 
 
 class ClientRPC():
@@ -28,6 +27,10 @@ class ClientRPC():
 
     def get_connection(self):
         '''Get new connection'''
+        # Thrift is only loaded by RPC clients
+        from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+        from thrift.transport import TTransport, TSocket
+        from funicorn.rpc import FunicornService
         socket = TSocket.TSocket(self.host, self.port)
         transport = TTransport.TFramedTransport(socket)
         protocol = TBinaryProtocol(transport)
@@ -65,3 +68,48 @@ class ClientRPC():
     def close(self):
         if self.transport or self.transport.isOpen():
             self.transport.close()
+
+
+class ClientHTTP():
+    '''Simple HTTP Client for Funicorn with a keep-alive session'''
+
+    def __init__(self, port, host='0.0.0.0', timeout_ms=1000, accept=JSON_CONTENT_TYPE,
+                 debug=False):
+        self.url = f'http://{host}:{port}'
+        self.timeout = timeout_ms / 1000
+        self.session = requests.Session()
+        # Preferred response format: json, msgpack or npy
+        self.session.headers['Accept'] = accept
+        self.logger = get_logger(colored_worker_name('CLIENT'),
+                                 mode='debug' if debug else 'info')
+
+    def _post(self, path, **kwargs):
+        resp = self.session.post(f'{self.url}{path}', timeout=self.timeout, **kwargs)
+        resp.raise_for_status()
+        return loads(resp.content, resp.headers.get('Content-Type'))
+
+    def predict_tensor(self, tensor, raw=False):
+        '''Send a decoded tensor, as .npy or as raw bytes with dtype/shape headers'''
+        tensor = np.asarray(tensor)
+        if raw:
+            tensor = np.ascontiguousarray(tensor)
+            headers = {'Content-Type': RAW_CONTENT_TYPE,
+                       'X-Dtype': tensor.dtype.str,
+                       'X-Shape': ','.join(str(dim) for dim in tensor.shape)}
+            data = tensor.tobytes()
+        else:
+            headers = {'Content-Type': NPY_CONTENT_TYPE}
+            data = ndarray_to_npy_bytes(tensor)
+        return self._post('/api/predict_tensor', data=data, headers=headers)
+
+    def predict_img_bytes(self, img_bytes):
+        return self._post('/api/predict_img_bytes', files={'img_bytes': img_bytes})
+
+    def predict_img_arr(self, img_arr):
+        return self.predict_img_bytes(img_arr_to_img_bytes(img_arr))
+
+    def predict_url(self, url):
+        return self._post('/api/predict_url', params={'url': url})
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,113 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from .exceptions import NotSupportedInputFile, MaxFileSizeExeeded
+
+__all__ = ['ImageDecoder', 'read_image_header', 'decode_image']
+
+ALLOWED_FORMATS = ('JPEG', 'PNG', 'BMP', 'WEBP', 'TIFF')
+MAX_PIXELS = 50 * 1000 * 1000
+DEFAULT_DECODE_WORKERS = 4
+
+# Scale factors OpenCV can apply while decoding, largest first
+CV2_REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8),
+                     (4, cv2.IMREAD_REDUCED_COLOR_4),
+                     (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+
+def _as_size(target_size):
+    if target_size is None:
+        return None
+    if isinstance(target_size, int):
+        return target_size, target_size
+    return tuple(target_size)
+
+
+def read_image_header(img_bytes, max_pixels=MAX_PIXELS):
+    '''Open an image reading only its header, rejecting unsupported or oversized images'''
+    try:
+        img = Image.open(BytesIO(img_bytes))
+    except Exception:
+        raise NotSupportedInputFile("Wrong input file type, only accept image")
+    if img.format not in ALLOWED_FORMATS:
+        raise NotSupportedInputFile(f"Image format {img.format} is not supported")
+    width, height = img.size
+    if width * height > max_pixels:
+        raise MaxFileSizeExeeded(
+            f"Image of {width}x{height} pixels is larger than {max_pixels} pixels")
+    return img
+
+
+def _reduced_flag(size, target_size):
+    width, height = size
+    for factor, flag in CV2_REDUCED_FLAGS:
+        if width // factor >= target_size[0] and height // factor >= target_size[1]:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def decode_image(img_bytes, target_size=None, backend='pil', max_pixels=MAX_PIXELS):
+    '''Decode an image at the smallest scale still covering `target_size`
+
+    The `pil` backend returns an RGB PIL Image like the HTTP APIs always did,
+    the `cv2` backend a BGR ndarray like `img_bytes_to_img_arr`. Only JPEG
+    can be decoded at a reduced scale, other formats are decoded in full.
+    '''
+    if isinstance(img_bytes, memoryview):
+        img_bytes = img_bytes.tobytes()
+    img = read_image_header(img_bytes, max_pixels=max_pixels)
+    target_size = _as_size(target_size)
+    try:
+        if backend == 'cv2':
+            flag = cv2.IMREAD_COLOR
+            if target_size is not None and img.format == 'JPEG':
+                flag = _reduced_flag(img.size, target_size)
+            img_arr = cv2.imdecode(np.frombuffer(img_bytes, dtype=np.uint8), flag)
+            if img_arr is None:
+                raise ValueError('cv2 cannot decode the image')
+            return img_arr
+        if target_size is not None:
+            # Let libjpeg do the downscaling, a no-op for other formats
+            img.draft('RGB', target_size)
+        return img.convert('RGB')
+    except Exception:
+        raise NotSupportedInputFile("Wrong input file type, only accept image")
+
+
+class ImageDecoder():
+    '''Decode uploaded images on a pool, near the input size of the model
+
+    `target_size` defaults to the `input_size` attribute of `model_cls`, as
+    an int or a (width, height) tuple. Without it images are decoded at full
+    resolution. Decoding releases the GIL, so threads scale across cores;
+    set `use_processes` to also move header parsing and conversions off the
+    frontend process.
+    '''
+
+    def __init__(self, target_size=None, model_cls=None, num_workers=DEFAULT_DECODE_WORKERS,
+                 use_processes=False, backend='pil', max_pixels=MAX_PIXELS):
+        if target_size is None and model_cls is not None:
+            target_size = getattr(model_cls, 'input_size', None)
+        self.target_size = _as_size(target_size)
+        self.backend = backend
+        self.max_pixels = max_pixels
+        executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self._executor = executor_cls(max_workers=num_workers)
+
+    def submit(self, img_bytes):
+        return self._executor.submit(decode_image, img_bytes, self.target_size,
+                                     self.backend, self.max_pixels)
+
+    def decode(self, img_bytes):
+        return self.submit(img_bytes).result()
+
+    async def decode_async(self, img_bytes):
+        return await asyncio.wrap_future(self.submit(img_bytes))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -23,6 +23,10 @@ class MaxFileSizeExeeded(Exception):
     pass
 
 
+class TooManyHeaders(Exception):
+    pass
+
+
 class NotSupportedInputFile(Exception):
     pass
 
@@ -30,4 +34,24 @@ class InitializationError(Exception):
     pass
 
 class CommandError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class PredictionError(Exception):
+    '''Raised to the caller whose input failed inside a worker'''
+
+    def __init__(self, error_type, message, traceback=None):
+        Exception.__init__(self, f'{error_type}: {message}')
+        self.error_type = error_type
+        self.message = message
+        self.traceback = traceback
+
+
+class WorkerControlError(Exception):
+    '''Raised when a worker cannot run an admin command'''
+    pass
+
+
+class AuthenticationError(ConnectionError):
+    '''Raised when a remote peer does not know the shared authkey'''
+    pass
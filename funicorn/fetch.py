@@ -0,0 +1,276 @@
+import asyncio
+import ssl
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from http import HTTPStatus
+from urllib.parse import urlsplit, urljoin
+
+from .exceptions import DownloadURLError
+from .logger import get_logger
+from .utils import colored_network_name
+
+__all__ = ['URLFetcher', 'LRUCache']
+
+MAX_DOWNLOAD_SIZE = 5 * 1024 * 1024
+MAX_CONNECTIONS_PER_HOST = 8
+MAX_CONCURRENCY = 64
+MAX_REDIRECTS = 5
+DEFAULT_TIMEOUT = 10
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+DEFAULT_CACHE_TTL = 60
+USER_AGENT = 'funicorn-fetcher'
+
+CacheEntry = namedtuple('CacheEntry', ['etag', 'body', 'fetched_at'])
+
+
+class LRUCache():
+    '''Downloaded bodies by url, evicting the least recently used beyond `max_size` bytes'''
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def put(self, url, etag, body):
+        if len(body) > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(url, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self._entries[url] = CacheEntry(etag, body, time.time())
+            self.size += len(body)
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.body)
+
+
+class _Response():
+    def __init__(self, status, headers, body, reusable):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.reusable = reusable
+
+
+class _HostPool():
+    '''Idle keep-alive connections to one (scheme, host, port)'''
+
+    def __init__(self, max_connections):
+        self.idle = []
+        self.semaphore = asyncio.Semaphore(max_connections)
+
+
+class URLFetcher():
+    '''Download urls on a dedicated asyncio event loop
+
+    Connections are kept alive and pooled per host, with at most
+    `max_connections_per_host` to a host and `max_concurrency` downloads in
+    total. Bodies larger than `max_size` are rejected. Downloaded bodies are
+    kept in an LRU cache: an entry younger than `cache_ttl` seconds is
+    served as is, an older one is revalidated with its ETag.
+    '''
+
+    def __init__(self, max_connections_per_host=MAX_CONNECTIONS_PER_HOST,
+                 max_concurrency=MAX_CONCURRENCY, max_size=MAX_DOWNLOAD_SIZE,
+                 timeout=DEFAULT_TIMEOUT, cache_size=DEFAULT_CACHE_SIZE,
+                 cache_ttl=DEFAULT_CACHE_TTL, debug=False):
+        self.max_connections_per_host = max_connections_per_host
+        self.max_concurrency = max_concurrency
+        self.max_size = max_size
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache = LRUCache(cache_size) if cache_size else None
+        self.logger = get_logger(colored_network_name('FETCH'),
+                                 mode='debug' if debug else 'info')
+        self._ssl_context = ssl.create_default_context()
+        self._pools = {}
+        self._loop = None
+        self._semaphore = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                threading.Thread(target=self._loop.run_forever,
+                                 daemon=True).start()
+        return self._loop
+
+    def fetch(self, url):
+        '''Download `url` from any thread and return its body'''
+        return self._submit(url).result()
+
+    async def fetch_async(self, url):
+        '''Download `url` from any event loop and return its body'''
+        return await asyncio.wrap_future(self._submit(url))
+
+    def _submit(self, url):
+        return asyncio.run_coroutine_threadsafe(self._fetch(url), self._ensure_loop())
+
+    async def _fetch(self, url):
+        entry = self.cache.get(url) if self.cache is not None else None
+        if entry is not None and time.time() - entry.fetched_at < self.cache_ttl:
+            return entry.body
+        headers = {}
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        try:
+            async with self._semaphore:
+                resp, _ = await asyncio.wait_for(self._get(url, headers),
+                                                   timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise DownloadURLError(f'Timed out downloading {url}',
+                                   status_code=HTTPStatus.GATEWAY_TIMEOUT)
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            raise DownloadURLError(f'Cannot download {url}: {e}',
+                                   status_code=HTTPStatus.BAD_GATEWAY)
+        if resp.status == HTTPStatus.NOT_MODIFIED and entry is not None:
+            self.cache.put(url, entry.etag, entry.body)
+            return entry.body
+        if resp.status != HTTPStatus.OK:
+            raise DownloadURLError(f'Cannot download {url}: HTTP {resp.status}',
+                                   status_code=HTTPStatus.BAD_GATEWAY)
+        if self.cache is not None and 'no-store' not in resp.headers.get('cache-control', ''):
+            self.cache.put(url, resp.headers.get('etag'), resp.body)
+        return resp.body
+
+    async def _get(self, url, headers):
+        for _ in range(MAX_REDIRECTS + 1):
+            resp = await self._request(url, headers)
+            if resp.status in (301, 302, 303, 307, 308) and 'location' in resp.headers:
+                url = urljoin(url, resp.headers['location'])
+                continue
+            return resp, url
+        raise ValueError('Too many redirects')
+
+    async def _request(self, url, headers):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise DownloadURLError(f'Unsupported url {url}',
+                                   status_code=HTTPStatus.BAD_REQUEST)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = _HostPool(self.max_connections_per_host)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        head = [f'GET {target} HTTP/1.1', f'Host: {parts.netloc}',
+                f'User-Agent: {USER_AGENT}', 'Accept-Encoding: identity']
+        head.extend(f'{name}: {value}' for name, value in headers.items())
+        request = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+
+        async with pool.semaphore:
+            while pool.idle:
+                # A pooled connection may have been closed by the server meanwhile
+                reader, writer = pool.idle.pop()
+                try:
+                    resp = await self._exchange(reader, writer, request)
+                except (OSError, asyncio.IncompleteReadError):
+                    writer.close()
+                    continue
+                except BaseException:
+                    writer.close()
+                    raise
+                return self._recycle(pool, reader, writer, resp)
+            reader, writer = await asyncio.open_connection(
+                parts.hostname, port,
+                ssl=self._ssl_context if parts.scheme == 'https' else None)
+            try:
+                resp = await self._exchange(reader, writer, request)
+            except BaseException:
+                writer.close()
+                raise
+            return self._recycle(pool, reader, writer, resp)
+
+    def _recycle(self, pool, reader, writer, resp):
+        if resp.reusable and len(pool.idle) < self.max_connections_per_host:
+            pool.idle.append((reader, writer))
+        else:
+            writer.close()
+        return resp
+
+    async def _exchange(self, reader, writer, request):
+        writer.write(request)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('Connection closed by peer')
+        version, status = status_line.decode('latin-1').split(' ', 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        status = int(status)
+        reusable = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+        if status in (HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED) or 100 <= status < 200:
+            body = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = await self._read_chunked(reader)
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            self._check_size(length)
+            body = await reader.readexactly(length)
+        else:
+            body = await self._read_until_eof(reader)
+            reusable = False
+        return _Response(status, headers, body, reusable)
+
+    def _check_size(self, size):
+        if size > self.max_size:
+            raise DownloadURLError(
+                f'Downloaded file is larger than {self.max_size / 1024 ** 2:0.2f}MB',
+                status_code=HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+    async def _read_chunked(self, reader):
+        body = bytearray()
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # Skip trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return bytes(body)
+            self._check_size(len(body) + size)
+            body.extend(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    async def _read_until_eof(self, reader):
+        body = bytearray()
+        while True:
+            chunk = await reader.read(64 * 1024)
+            if not chunk:
+                return bytes(body)
+            self._check_size(len(body) + len(chunk))
+            body.extend(chunk)
+
+    def close(self):
+        if self._loop is None:
+            return
+
+        def close_connections():
+            for pool in self._pools.values():
+                for _, writer in pool.idle:
+                    writer.close()
+            self._pools.clear()
+            self._loop.stop()
+        self._loop.call_soon_threadsafe(close_connections)
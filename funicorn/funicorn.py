@@ -1,41 +1,82 @@
 import os
+import socket
 import multiprocessing as mp
-from random import randint
+from random import randint, choices
 import threading
-from collections import namedtuple
+from collections import namedtuple, deque
 import uuid
 import time
 import json
 import traceback
-from queue import Empty
+from queue import Empty, Full
 from queue import Queue
-from .exceptions import LengthEqualtyError
-from .utils import img_bytes_to_img_arr, get_args_from_class
-from .logger import get_logger
+from .exceptions import LengthEqualtyError, InitializationError, PredictionError
+from .exceptions import WorkerControlError
+from .utils import img_bytes_to_img_arr, get_args_from_class, get_size_bounded
+from .logger import get_logger, add_process_sink, AsyncQueueHandler
 from .utils import colored_worker_name, colored_funicorn_name, colored_network_name
 from .mqueue import Queue as MQueue
+from .serializers import encode_result
+from .metrics import MetricsRegistry, BATCH_SIZE_BUCKETS, serialization_metric
+from .stat import WorkerStats
+from .profiler import profile_samples, merge_collapsed, PROFILE_TARGETS
+from .profiler import DEFAULT_PROFILE_DURATION, DEFAULT_SAMPLE_INTERVAL
+from .memory import tracemalloc_command
+from .tracing import DISPATCHED, DEQUEUED, BATCH_START, MODEL_END, RESULT_SENT
+from .tracing import SUBMITTED, RESULT_RECEIVED
 import pickle
 
 MAX_QUEUE_SIZE = 1000
 RESULT_TIMEOUT = 0.0001
+# Longest pause of the result collector between polls of pending results
+MAX_RESULT_BACKOFF = 0.005
 DEFAULT_TIMEOUT = 500
 WORKER_TIMEOUT = 5
+WORKER_READY_TIMEOUT = 600
+WORKER_TERMINATE_TIMEOUT = 20000
+WORKER_POLL_TIMEOUT = 0.5
+RECLAIM_INTERVAL = 5
+RECLAIM_MIN_IDLE_TIME = 30
+# Tasks still unacknowledged after this many deliveries fail instead of
+# crashing workers forever
+MAX_DELIVERIES = 3
 DEFAULT_BATCH_TIMEOUT = 0.01
+DEFAULT_MODEL_VERSION = 'v1'
+DISPATCH_MODES = ['direct', 'queue']
+METRICS_QUEUE_SIZE = 10000
+RSS_SAMPLE_INTERVAL = 5
+WORKER_CHECK_INTERVAL = 10
+RECYCLE_REASONS = ['max_requests', 'max_rss']
+CONTROL_TIMEOUT = 30
+TASK_SIZE_SAMPLE_EVERY = 32
+RESULT_SIZE_SAMPLE = 16
 
 
 __all__ = ['Funicorn']
-Task = namedtuple('Task', ['request_id', 'data'])
+# `wire_format` is the content type the worker serializes the result to,
+# None to send back the Python object. `trace` is the stage timestamp
+# vector of a sampled request, see `tracing.STAGES`
+Task = namedtuple('Task', ['request_id', 'data', 'wire_format', 'submit_time', 'trace'],
+                  defaults=[None, None, None])
+# Result of a traced task, with the stages recorded by the worker
+TracedResult = namedtuple('TracedResult', ['result', 'timestamps'])
+# Admin commands run in the frontend or, through their control queue, in workers
+ADMIN_COMMANDS = {'profile': profile_samples, 'tracemalloc': tracemalloc_command}
+ErrorResult = namedtuple('ErrorResult', ['request_id', 'error_type',
+                                         'error_message', 'traceback'])
 WorkerInfo = namedtuple('WorkerInfo', ['wrk', 'wrk_id', 'pid', 'gpu_id',
                                        'ps_status', 'queue',
                                        'ready_event',
-                                       'terminate_event'])
+                                       'terminate_event',
+                                       'version', 'stats', 'control'],
+                        defaults=[None, None])
 
 
 class BaseWorker():
     def __init__(self, model_cls, result_dict=None,
                  batch_size=1, batch_timeout=DEFAULT_BATCH_TIMEOUT,
                  ready_event=None, terminate_event=None, model_init_kwargs=None,
-                 debug=False):
+                 warmup_data=None, metrics_queue=None, debug=False):
 
         self._worker_id = None
         self._model_init_kwargs = model_init_kwargs or {}
@@ -48,6 +89,16 @@ class BaseWorker():
         self._terminate_event = terminate_event
         self._pid = os.getpid()
         self._model = None
+        self._warmup_data = warmup_data
+        self._metrics_queue = metrics_queue
+        self._stats = None
+        self._process = None
+        self._next_rss_sample = 0
+        self._num_received = 0
+        self._serialize_time = 0
+        self._batch_errors = 0
+        # Admin commands the parent can run in the worker process
+        self._control_commands = dict(ADMIN_COMMANDS)
         self._debug = debug
         self.logger = get_logger(colored_worker_name(
             'BASE-WORKER'), mode='debug' if self._debug else 'info')
@@ -58,10 +109,22 @@ class BaseWorker():
     def _send_response(self, request_id, result):
         raise NotImplementedError
 
+    def _backlog(self):
+        '''Number of tasks already assigned to this worker'''
+        return self._wrk_queue.qsize()
+
     def _init_environ(self):
         # INFO messages are not printed
         os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1'
 
+    def _warmup(self):
+        '''Run the configured warmup batch once before reporting ready'''
+        if self._warmup_data is None:
+            return
+        start_time = time.time()
+        self._model.predict(self._warmup_data)
+        self.logger.info(f'Warmup finished in {time.time() - start_time:.3f}s')
+
     def run_once(self):
         # Get data from queue
         batch = []
@@ -72,34 +135,131 @@ class BaseWorker():
             except TimeoutError:
                 break
             else:
+                if task.trace is not None:
+                    task.trace[DEQUEUED] = time.time()
+                self._sample_task_size(task)
                 batch.append(task)
         if not batch:
             return 0
 
         batch_size = len(batch)
-        model_input = [task.data for task in batch]
         # Model predict
+        self._serialize_time = 0
+        self._batch_errors = 0
         start_model_time = time.time()
-        results = self._model.predict(model_input)
+        for task in batch:
+            if task.trace is not None:
+                task.trace[BATCH_START] = start_model_time
+        self._predict_batch(batch)
         end_model_time = time.time()
-        assert isinstance(results, list), ValueError(
-            '`results` must be a list but receive `{}` which is not valid'.format(results))
-        assert len(results) == len(batch), LengthEqualtyError(
-            'Length of result and batch must be equal')
-        for (task, result) in zip(batch, results):
-            self._send_response(task.request_id, result)
+        model_time = end_model_time - start_model_time - self._serialize_time
+        self._report_metrics(batch, start_model_time, model_time)
+        if self._stats is not None:
+            self._stats.record_batch(batch_size, model_time, self._serialize_time,
+                                     self._batch_errors)
         self.logger.debug(
             f'Inference with batch_size: {batch_size} - inference-time: {time.time() - start_time} - model-time: {end_model_time - start_model_time}')
         # Return None or something to notify number of data in queue
         return batch_size
 
+    def _sample_rss(self):
+        '''Publish the RSS and the dropped log records of the worker every RSS_SAMPLE_INTERVAL seconds'''
+        now = time.time()
+        if self._stats is None or now < self._next_rss_sample:
+            return
+        self._next_rss_sample = now + RSS_SAMPLE_INTERVAL
+        self._stats.record_dropped_logs(AsyncQueueHandler.dropped)
+        if self._process is not None:
+            self._stats.record_rss(self._process.memory_info().rss)
+
+    def _sample_task_size(self, task):
+        '''Measure one task out of TASK_SIZE_SAMPLE_EVERY, to size the queue backlog'''
+        if self._stats is not None and self._num_received % TASK_SIZE_SAMPLE_EVERY == 0:
+            self._stats.record_task_size(get_size_bounded(task.data))
+        self._num_received += 1
+
+    def _report_metrics(self, batch, start_model_time, model_time):
+        '''Hand the metrics of a batch to the parent, dropped while nobody scrapes them'''
+        if self._metrics_queue is None:
+            return
+        queue_waits = [start_model_time - task.submit_time for task in batch
+                       if task.submit_time is not None]
+        try:
+            self._metrics_queue.put_nowait((self._worker_id, len(batch), model_time,
+                                            self._serialize_time, queue_waits))
+        except Full:
+            pass
+
+    def _predict_batch(self, batch):
+        '''Predict a batch and send every result back
+
+        When the batch fails it is bisected until the failing inputs are
+        isolated, so that they get an `ErrorResult` while the other requests
+        of the batch still succeed.
+        '''
+        try:
+            results = self._model.predict([task.data for task in batch])
+            if not isinstance(results, list):
+                raise ValueError(
+                    '`results` must be a list but receive `{}` which is not valid'.format(results))
+            if len(results) != len(batch):
+                raise LengthEqualtyError(
+                    'Length of result and batch must be equal')
+        except Exception as e:
+            if len(batch) == 1:
+                task = batch[0]
+                self._batch_errors += 1
+                self.logger.error(
+                    f'Failed to predict request_id {task.request_id}: {e!r}')
+                self._send_response(task.request_id, ErrorResult(
+                    request_id=task.request_id,
+                    error_type=type(e).__name__,
+                    error_message=str(e),
+                    traceback=traceback.format_exc()))
+                return
+            self.logger.debug(
+                f'Batch of {len(batch)} failed, bisect it to isolate bad inputs')
+            middle = len(batch) // 2
+            self._predict_batch(batch[:middle])
+            self._predict_batch(batch[middle:])
+        else:
+            end_model_time = time.time()
+            for (task, result) in zip(batch, results):
+                if task.wire_format is not None:
+                    start_time = time.time()
+                    result = encode_result(result, task.wire_format)
+                    self._serialize_time += time.time() - start_time
+                if task.trace is not None:
+                    task.trace[MODEL_END] = end_model_time
+                    task.trace[RESULT_SENT] = time.time()
+                    result = TracedResult(result, task.trace)
+                self._send_response(task.request_id, result)
+
+    def _serve_control(self, control_queue):
+        '''Run the admin commands of the parent next to the inference loop
+
+        Replies go through the result dict, under the id of the command.
+        '''
+        while True:
+            command_id, command, kwargs = control_queue.get()
+            try:
+                result = self._control_commands[command](**kwargs)
+            except Exception as e:
+                self.logger.error(f'Failed to run command {command}: {e!r}')
+                result = ErrorResult(request_id=command_id,
+                                     error_type=type(e).__name__,
+                                     error_message=str(e),
+                                     traceback=traceback.format_exc())
+            self._result_dict[command_id] = result
+
     def run(self):
         '''Loop into a queue'''
         while True:
             try:
                 self.logger.debug('Process new data!')
                 handled = self.run_once()
-                if self._ready_event and not self._ready_event.is_set() and (self._wrk_queue.qsize() == 0):
+                self._sample_rss()
+                if self._ready_event and not self._ready_event.is_set() and (self._backlog() == 0):
                     self.logger.info('All jobs have been done. Terminated')
                     self._terminate_event.set()
                     break
@@ -111,8 +271,11 @@ class BaseWorker():
 
 class Worker(BaseWorker):
     def _recv_request(self):
+        # Never block forever so that a draining worker can notice it
+        # has been asked to stop
+        timeout = self.batch_timeout or WORKER_POLL_TIMEOUT
         try:
-            task = self._wrk_queue.get(timeout=self.batch_timeout)
+            task = self._wrk_queue.get(timeout=timeout)
         except Empty:
             raise TimeoutError
         else:
@@ -121,22 +284,34 @@ class Worker(BaseWorker):
     def _send_response(self, request_id, result):
         self._result_dict[request_id] = result
 
-    def run(self, worker_id=None, gpu_id=None, ready_event=None, terminate_event=None, wrk_queue=None):
+    def run(self, worker_id=None, gpu_id=None, ready_event=None, terminate_event=None, wrk_queue=None,
+            stats=None, control_queue=None):
         ''' Init process parameters
             Every param initialized here are seperable among processes
         '''
+        import psutil
         self.logger = get_logger(
             colored_worker_name(f'WORKER-{worker_id}'), mode='debug' if self._debug else 'info')
+        add_process_sink(self.logger, f'worker-{worker_id}')
         self._init_environ()
         self._wrk_queue = wrk_queue
         self._worker_id = worker_id
         self._pid = os.getpid()
+        self._process = psutil.Process(self._pid)
         worker_args = get_args_from_class(self._model_cls)
         if 'gpu_id' in worker_args:
             self._model_init_kwargs.update({'gpu_id': gpu_id})
         device = f'GPU-{gpu_id}' if gpu_id else 'CPU'
         self.logger.info(f'Initializing Worker in {device}')
         self._model = self._model_cls(**self._model_init_kwargs)
+        self._warmup()
+        if stats is not None:
+            self._stats = stats
+            self._stats.start()
+            self._sample_rss()
+        if control_queue is not None:
+            threading.Thread(target=self._serve_control, args=(control_queue,),
+                             daemon=True).start()
 
         if ready_event:
             self._ready_event = ready_event
@@ -148,13 +323,95 @@ class Worker(BaseWorker):
         super().run()
 
 
+class BackendWorker(Worker):
+    '''Worker pulling tasks from a shared `Backend` instead of a local queue
+
+    Tasks are acknowledged once their result is stored. Tasks left
+    unacknowledged by dead workers for `min_idle_time` seconds are taken
+    over every `reclaim_interval` seconds, unless `max_deliveries` workers
+    already got them: those get an `ErrorResult` and are acknowledged.
+    '''
+
+    def __init__(self, model_cls, backend, reclaim_interval=RECLAIM_INTERVAL,
+                 min_idle_time=RECLAIM_MIN_IDLE_TIME, max_deliveries=MAX_DELIVERIES,
+                 **kwargs):
+        Worker.__init__(self, model_cls, **kwargs)
+        self._backend = backend
+        self.reclaim_interval = reclaim_interval
+        self.min_idle_time = min_idle_time
+        self.max_deliveries = max_deliveries
+        self._consumer = None
+        self._pending = deque()
+        self._delivery_ids = {}
+        self._last_reclaim = 0
+
+    def _backlog(self):
+        return len(self._pending)
+
+    def _fetch_tasks(self):
+        now = time.time()
+        if now - self._last_reclaim > self.reclaim_interval:
+            self._last_reclaim = now
+            reclaimed = self._backend.reclaim_tasks(
+                self._consumer, self.min_idle_time, count=self.batch_size)
+            if reclaimed:
+                self.logger.info(
+                    f'Reclaimed {len(reclaimed)} tasks of dead workers')
+                reclaimed = self._fail_undeliverable(reclaimed)
+            self._pending.extend(reclaimed)
+        if not self._pending:
+            self._pending.extend(self._backend.get_tasks(
+                self._consumer, count=self.batch_size,
+                timeout=self.batch_timeout or WORKER_POLL_TIMEOUT))
+
+    def _fail_undeliverable(self, tasks):
+        '''Fail the reclaimed tasks which workers already got `max_deliveries` times'''
+        counts = self._backend.delivery_counts([delivery_id for delivery_id, _ in tasks])
+        kept = []
+        for delivery_id, task in tasks:
+            # The count includes the delivery of this reclaim
+            if counts.get(delivery_id, 0) <= self.max_deliveries:
+                kept.append((delivery_id, task))
+                continue
+            self.logger.error(f'Give up request_id {task.request_id}: workers stopped '
+                              f'{self.max_deliveries} times while processing it')
+            self._backend.set_result(task.request_id, ErrorResult(
+                request_id=task.request_id,
+                error_type='DeliveryLimitExceeded',
+                error_message=f'Workers stopped {self.max_deliveries} times '
+                              f'while processing this input',
+                traceback=None))
+            self._backend.ack([delivery_id])
+        return kept
+
+    def _recv_request(self):
+        if not self._pending:
+            self._fetch_tasks()
+        if not self._pending:
+            raise TimeoutError
+        delivery_id, task = self._pending.popleft()
+        self._delivery_ids[task.request_id] = delivery_id
+        return task
+
+    def _send_response(self, request_id, result):
+        self._backend.set_result(request_id, result)
+        self._backend.ack([self._delivery_ids.pop(request_id)])
+
+    def run(self, worker_id=None, *args, **kwargs):
+        self._consumer = f'{socket.gethostname()}-{os.getpid()}-{worker_id}'
+        super().run(worker_id, *args, **kwargs)
+
+
 class Funicorn():
     '''Lightweight Deep Learning Inference Framework'''
 
     def __init__(self, model_cls, num_workers=1, batch_size=1, batch_timeout=10,
                  max_queue_size=1000,
                  gpu_devices=None,
-                 model_init_kwargs=None, debug=False, timeout=5000):
+                 model_init_kwargs=None, warmup_data=None,
+                 restart_wave_size=1, model_version=DEFAULT_MODEL_VERSION,
+                 dispatch_mode='direct', backend=None, max_requests=None,
+                 max_requests_jitter=0, max_rss=None, debug=False, timeout=5000):
         self.model_cls = model_cls
         self.logger = get_logger(
             colored_funicorn_name(), mode='debug' if debug else 'info')
@@ -162,8 +419,32 @@ class Funicorn():
         self.timeout = timeout
         self.debug = debug
         self._lock = threading.Lock()
+        # Dispatches between the choice of a worker queue and the end of
+        # their put, per queue, so that a removed worker is only emptied
+        # once nothing is still on its way into its queue
+        self._inflight = {}
+        self._inflight_cond = threading.Condition(self._lock)
         self.gpu_devices = gpu_devices
         self.num_workers = num_workers
+        self.restart_wave_size = restart_wave_size
+        # Workers are recycled after `max_requests` (plus a random jitter of
+        # up to `max_requests_jitter`) tasks, or above `max_rss` MB
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.max_rss = max_rss
+        self.recycles = {reason: 0 for reason in RECYCLE_REASONS}
+        self._request_limits = {}
+        # Held while workers are being replaced by a restart or a recycle
+        self._replace_lock = threading.Lock()
+        assert dispatch_mode in DISPATCH_MODES, \
+            f'`dispatch_mode` must be one of {DISPATCH_MODES}'
+        # direct: frontends put tasks straight into the chosen worker queue
+        # queue: tasks go through `_input_queue` and the dispatcher thread
+        self.dispatch_mode = dispatch_mode
+        self._shutdown_event = threading.Event()
+        # Tasks and results go through `backend` (e.g. Redis) when it is set
+        # so that workers can run on other hosts
+        self._backend = backend
 
         self._input_queue = MQueue()
         self._result_dict = mp.Manager().dict()
@@ -171,15 +452,108 @@ class Funicorn():
             batch_timeout = None
         elif batch_timeout is not None:
             batch_timeout = batch_timeout/1000
-        self._wrk = Worker(self.model_cls, self._result_dict,
-                           batch_size=batch_size, batch_timeout=batch_timeout,
-                           model_init_kwargs=model_init_kwargs, debug=self.debug)
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._warmup_data = warmup_data
+        self.metrics = MetricsRegistry()
+        self._metrics_queue = mp.Queue(METRICS_QUEUE_SIZE)
+        self._init_metrics()
+        self._wrk = self._build_worker(self.model_cls, model_init_kwargs)
+        # Every model version owns a worker template and a traffic percentage
+        self.active_version = model_version
+        self._previous_version = None
+        self._versions = {model_version: self._wrk}
+        self._traffic = {model_version: 100}
+        # Set to stop the running rollout, if any
+        self._rollout_cancel = threading.Event()
 
         self.pid = os.getpid()
         # self._init_stat()
         self.idle_event = mp.Event()
         self.wrk_ps = []
+        # External pools (e.g. remote workers) are dispatched to like local
+        # workers, but their lifecycle is not managed here
+        self.worker_pools = []
         self.connection_apps = {}
+        # Futures of `predict_async` callers, resolved by the result collector
+        self._waiters = {}
+        self._waiters_lock = threading.Lock()
+        # Signaled on every new waiter, the collector sleeps on it when idle
+        self._waiters_cond = threading.Condition(self._waiters_lock)
+        self._collector = None
+
+    def _build_worker(self, model_cls, model_init_kwargs):
+        kwargs = dict(result_dict=self._result_dict,
+                      batch_size=self._batch_size,
+                      batch_timeout=self._batch_timeout,
+                      model_init_kwargs=model_init_kwargs,
+                      warmup_data=self._warmup_data,
+                      metrics_queue=self._metrics_queue, debug=self.debug)
+        if self._backend is not None:
+            return BackendWorker(model_cls, self._backend, **kwargs)
+        return Worker(model_cls, **kwargs)
+
+    def _init_metrics(self):
+        self._queue_wait_metric = self.metrics.histogram(
+            'funicorn_queue_wait_seconds',
+            'Time from submission until the batch of a task starts', ['worker'])
+        self._batch_size_metric = self.metrics.histogram(
+            'funicorn_batch_size', 'Number of tasks per batch', ['worker'],
+            buckets=BATCH_SIZE_BUCKETS)
+        self._model_time_metric = self.metrics.histogram(
+            'funicorn_model_duration_seconds', 'Model time per batch', ['worker'])
+        self._serialization_metric = serialization_metric(self.metrics)
+        self._workers_metric = self.metrics.gauge(
+            'funicorn_workers', 'Registered workers', ['version'])
+        self._pending_metric = self.metrics.gauge(
+            'funicorn_pending_async_requests', 'Requests awaited by predict_async')
+        self._rss_metric = self.metrics.gauge(
+            'funicorn_worker_rss_bytes', 'Resident memory of the workers', ['worker'])
+        self._recycles_metric = self.metrics.counter(
+            'funicorn_worker_recycles_total', 'Workers recycled', ['reason'])
+        self._dropped_logs_metric = self.metrics.gauge(
+            'funicorn_dropped_log_records', 'Log records dropped by a full log queue', ['process'])
+        # Workers with label sets in the per-worker metrics
+        self._metric_workers = set()
+        self.metrics.add_collector(self._collect_metrics)
+
+    def _collect_metrics(self):
+        '''Drain the metrics sent by the workers and refresh the gauges'''
+        while True:
+            try:
+                worker_id, batch_size, model_time, serialize_time, queue_waits = \
+                    self._metrics_queue.get_nowait()
+            except Empty:
+                break
+            self._batch_size_metric.observe(batch_size, worker=worker_id)
+            self._model_time_metric.observe(model_time, worker=worker_id)
+            if serialize_time:
+                self._serialization_metric.observe(serialize_time, stage='worker')
+            for queue_wait in queue_waits:
+                self._queue_wait_metric.observe(queue_wait, worker=worker_id)
+            self._metric_workers.add(str(worker_id))
+        with self._lock:
+            versions = [worker_info.version for worker_info in self.wrk_ps]
+            workers = [worker_info for worker_info in self.wrk_ps
+                       if worker_info.stats is not None]
+            worker_ids = {str(worker_info.wrk_id)
+                          for worker_info in self.wrk_ps + self.worker_pools}
+        # Label sets of exited workers (restarted, recycled, released or
+        # disconnected) must not accumulate
+        for worker_id in self._metric_workers - worker_ids:
+            for metric in (self._batch_size_metric, self._model_time_metric,
+                           self._queue_wait_metric):
+                metric.remove(worker=worker_id)
+        self._metric_workers &= worker_ids
+        self._rss_metric.replace({(worker_info.wrk_id,): worker_info.stats['rss']
+                                  for worker_info in workers})
+        dropped_logs = {(str(worker_info.wrk_id),): worker_info.stats['dropped_logs']
+                        for worker_info in workers}
+        dropped_logs[('main',)] = AsyncQueueHandler.dropped
+        self._dropped_logs_metric.replace(dropped_logs)
+        self._workers_metric.replace({(version,): versions.count(version)
+                                      for version in self._versions})
+        self._pending_metric.set(len(self._waiters))
 
     def register_connection(self, connection):
         self.logger.info(
@@ -187,7 +561,7 @@ class Funicorn():
         self.connection_apps[connection.name] = connection
 
     def get_worker_pids(self):
-        return [wrk.pid for wrk in self.wrk_ps]
+        return [wrk.pid for wrk in self.wrk_ps if wrk.pid is not None]
 
     def _init_connections(self):
         for conn_name, conn in self.connection_apps.items():
@@ -202,7 +576,8 @@ class Funicorn():
                 self.logger.warning(
                     'Cannot start workers because num workers is set to 0!')
             else:
-                self.add_worker(self.num_workers, self.gpu_devices)
+                self.add_worker(self.num_workers, self.gpu_devices,
+                                version=self.active_version)
 
     def _wait_for_worker(self, timeout=WORKER_TIMEOUT):
         # wait for all workers finishing init
@@ -222,21 +597,160 @@ class Funicorn():
             task = self._input_queue.get()
             self.logger.debug(
                 f'Get data from input queue: {self._input_queue}')
+            self._dispatch(task)
+
+    def _dispatch(self, task):
+        if task.trace is not None:
+            task.trace[DISPATCHED] = time.time()
+        worker_queue = self._select_worker_queue()
+        try:
+            worker_queue.put(task)
+        finally:
+            with self._inflight_cond:
+                self._inflight[worker_queue] -= 1
+                if not self._inflight[worker_queue]:
+                    del self._inflight[worker_queue]
+                    self._inflight_cond.notify_all()
+
+    def _submit(self, task):
+        if self._backend is not None:
+            self._backend.put_task(task)
+        elif self.dispatch_mode == 'direct':
+            self._dispatch(task)
+        else:
+            self._input_queue.put(task)
+
+    def _select_worker_queue(self):
+        '''Pick the queue of a running worker, waiting while none is registered
+
+        The model version is drawn according to the traffic percentages, then
+        a worker of this version is picked randomly. The queue is counted in
+        `_inflight` until `_dispatch` has put its task.
+        '''
+        while True:
             with self._lock:
-                input_queue = self.wrk_ps[randint(
-                    0, len(self.wrk_ps) - 1)].queue
-            input_queue.put(task)
-
-    def predict(self, data, asynchronous=False):
-        '''Main function to predict data'''
-        request_id = str(uuid.uuid4())
-        self._input_queue.put(Task(request_id=request_id, data=data))
-        self.logger.info(
+                workers = self.wrk_ps + self.worker_pools if self.worker_pools else self.wrk_ps
+                if workers:
+                    worker_queue = self._select_worker(workers).queue
+                    self._inflight[worker_queue] = self._inflight.get(worker_queue, 0) + 1
+                    return worker_queue
+            time.sleep(RESULT_TIMEOUT)
+
+    def _select_worker(self, workers):
+        if len(self._traffic) > 1:
+            versions = [version for version, percent in self._traffic.items()
+                        if percent > 0]
+            version = choices(
+                versions, [self._traffic[v] for v in versions])[0]
+            version_workers = [worker_info for worker_info in workers
+                               if worker_info.version == version]
+            # Fall back to any worker while the chosen version has none
+            workers = version_workers or workers
+        return workers[randint(0, len(workers) - 1)]
+
+    def _new_task(self, data, wire_format, trace):
+        submit_time = time.time()
+        timestamps = None
+        if trace is not None:
+            trace.mark(SUBMITTED, submit_time)
+            timestamps = trace.timestamps
+        return Task(request_id=str(uuid.uuid4()), data=data, wire_format=wire_format,
+                    submit_time=submit_time, trace=timestamps)
+
+    @staticmethod
+    def _untrace(ret, trace=None):
+        '''Unwrap a `TracedResult`, merging the worker stages into `trace`'''
+        if isinstance(ret, TracedResult):
+            if trace is not None:
+                trace.merge(ret.timestamps)
+            ret = ret.result
+        if trace is not None:
+            trace.mark(RESULT_RECEIVED)
+        return ret
+
+    def predict(self, data, asynchronous=False, wire_format=None, trace=None):
+        '''Main function to predict data
+
+        With a `wire_format` content type the worker returns the result
+        already serialized, as an `EncodedResult`. A `tracing.Trace` gets the
+        timestamps of every stage the request goes through.
+        '''
+        task = self._new_task(data, wire_format, trace)
+        request_id = task.request_id
+        self._submit(task)
+        self.logger.debug(
             f'Received data with request_id: {request_id}')
         if asynchronous:
             return request_id
         else:
-            return self.get_result(request_id)
+            return self.get_result(request_id, trace=trace)
+
+    async def predict_async(self, data, wire_format=None, trace=None):
+        '''Predict data from an asyncio event loop without holding a thread
+
+        A single collector thread polls the results of all pending requests
+        and resolves their futures on the caller's loop.
+        '''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        task = self._new_task(data, wire_format, trace)
+        request_id = task.request_id
+        with self._waiters_cond:
+            self._waiters[request_id] = (loop, future)
+            self._waiters_cond.notify()
+            if self._collector is None:
+                self._collector = threading.Thread(
+                    target=self._collect_results, daemon=True)
+                self._collector.start()
+        self._submit(task)
+        self.logger.debug(
+            f'Received data with request_id: {request_id}')
+        return self._untrace(await future, trace)
+
+    def _poll_results(self, request_ids):
+        '''Pop the results which are ready among `request_ids`'''
+        if self._backend is not None:
+            return self._backend.pop_results(request_ids)
+        ready = request_ids.intersection(self._result_dict.keys())
+        return {request_id: self._result_dict.pop(request_id)
+                for request_id in ready}
+
+    @staticmethod
+    def _resolve(future, ret):
+        if future.done():
+            return
+        if isinstance(ret, ErrorResult):
+            future.set_exception(PredictionError(ret.error_type, ret.error_message,
+                                                 traceback=ret.traceback))
+        else:
+            future.set_result(ret)
+
+    def _collect_results(self):
+        '''Resolve the futures of `predict_async`
+
+        Blocks while nobody waits, and polls with an exponential backoff from
+        RESULT_TIMEOUT to MAX_RESULT_BACKOFF while results are pending. A new
+        waiter restarts the backoff.
+        '''
+        delay = RESULT_TIMEOUT
+        while True:
+            with self._waiters_cond:
+                while not self._waiters:
+                    self._waiters_cond.wait()
+                request_ids = set(self._waiters)
+            results = self._poll_results(request_ids)
+            if not results:
+                with self._waiters_cond:
+                    notified = self._waiters_cond.wait(delay)
+                delay = RESULT_TIMEOUT if notified else min(delay * 2, MAX_RESULT_BACKOFF)
+                continue
+            delay = RESULT_TIMEOUT
+            with self._waiters_lock:
+                waiters = [(self._waiters.pop(request_id), ret)
+                           for request_id, ret in results.items()]
+            for (loop, future), ret in waiters:
+                loop.call_soon_threadsafe(self._resolve, future, ret)
 
     @property
     def input_queue(self):
@@ -247,14 +761,21 @@ class Funicorn():
     def result_dict(self):
         return self._result_dict
 
-    def get_result(self, request_id):
+    def get_result(self, request_id, trace=None):
         ret = None
         while True:
-            ret = self._result_dict.pop(request_id, None)
+            if self._backend is not None:
+                ret = self._backend.pop_result(request_id)
+            else:
+                ret = self._result_dict.pop(request_id, None)
             if ret is not None:
                 break
             time.sleep(RESULT_TIMEOUT)
         self.logger.debug(f'Sent result of request_id to client: {request_id}')
+        ret = self._untrace(ret, trace)
+        if isinstance(ret, ErrorResult):
+            raise PredictionError(ret.error_type, ret.error_message,
+                                  traceback=ret.traceback)
         return ret
 
     def add_more_workers(self, num_workers, gpu_devices):
@@ -262,37 +783,226 @@ class Funicorn():
         device = 'CPU' if gpu_devices is None else gpu_devices
         self.logger.info(f'Add {num_workers} workers in {device}')
         self.num_workers += num_workers
-        self.add_worker(num_workers, gpu_devices)
+        self.add_worker(num_workers, gpu_devices, version=self.active_version)
         return 'Added more workers!'
 
-    def add_worker(self, num_workers, gpu_devices):
+    def _spawn_worker(self, gpu_id=None, version=None):
+        '''Start a worker process without registering it for dispatching'''
+        version = version or self.active_version
+        ready_event = mp.Event()
+        terminate_event = mp.Event()
+        wrk_queue = MQueue()  # mp.Queue()
+        worker_id = randint(0, 999999)
+        stats = WorkerStats(batch_capacity=self._batch_size)
+        control_queue = mp.Queue()
+        args = (worker_id, gpu_id, ready_event,
+                terminate_event, wrk_queue, stats, control_queue)
+        wrk = mp.Process(target=self._versions[version].run, args=args,
+                         daemon=True,
+                         name=f'funicorn-worker-{worker_id}')
+        wrk.start()
+        return WorkerInfo(wrk=wrk,
+                          wrk_id=worker_id,
+                          pid=wrk.pid,
+                          gpu_id=gpu_id,
+                          ps_status='unknown',
+                          queue=wrk_queue,
+                          ready_event=ready_event,
+                          terminate_event=terminate_event,
+                          version=version,
+                          stats=stats,
+                          control=control_queue)
+
+    def workers_stats(self):
+        '''Statistics of every worker, read from their shared memory blocks'''
+        with self._lock:
+            workers = list(self.wrk_ps)
+        return [dict(wrk_id=worker_info.wrk_id, pid=worker_info.pid,
+                     version=worker_info.version, queue=worker_info.queue.qsize(),
+                     **worker_info.stats.snapshot())
+                for worker_info in workers if worker_info.stats is not None]
+
+    def _send_control(self, workers, command, **kwargs):
+        '''Ask every worker to run an admin command, {command id: worker}'''
+        pending = {}
+        for worker_info in workers:
+            if worker_info.control is None:
+                continue
+            command_id = f'control-{uuid.uuid4()}'
+            worker_info.control.put((command_id, command, kwargs))
+            pending[command_id] = worker_info
+        return pending
+
+    def _wait_control(self, pending, timeout):
+        '''Replies of the commands sent by `_send_control`, {worker: reply}'''
+        replies = {}
+        error = None
+        deadline = time.time() + timeout
+        while pending and time.time() < deadline:
+            for command_id in pending.keys() & self._result_dict.keys():
+                ret = self._result_dict.pop(command_id)
+                worker_info = pending.pop(command_id)
+                if isinstance(ret, ErrorResult):
+                    # Keep collecting the replies of the other workers, so
+                    # that they do not stay in the result dict
+                    error = error or WorkerControlError(
+                        f'Worker {worker_info.wrk_id} failed: {ret.error_type}: {ret.error_message}')
+                    continue
+                replies[worker_info] = ret
+            time.sleep(RESULT_TIMEOUT)
+        if pending:
+            # Late replies must not stay in the result dict forever
+            for command_id in pending:
+                self._result_dict.pop(command_id, None)
+        if error is not None:
+            raise error
+        if pending:
+            raise WorkerControlError(
+                f'No reply from workers {[w.wrk_id for w in pending.values()]} in {timeout}s')
+        return replies
+
+    def _control_targets(self, worker_id=None):
+        '''Local workers accepting admin commands, only `worker_id` if given'''
+        with self._lock:
+            workers = [worker_info for worker_info in self.wrk_ps
+                       if worker_info.control is not None]
+        if worker_id is not None:
+            workers = [worker_info for worker_info in workers
+                       if worker_info.wrk_id == int(worker_id)]
+            if not workers:
+                raise WorkerControlError(f'Worker {worker_id} not found')
+        return workers
+
+    def control_workers(self, command, worker_id=None, timeout=WORKER_TIMEOUT, **kwargs):
+        '''Run an admin command in one worker or in all of them, {wrk_id: reply}'''
+        pending = self._send_control(self._control_targets(worker_id), command, **kwargs)
+        replies = self._wait_control(pending, timeout)
+        return {worker_info.wrk_id: ret for worker_info, ret in replies.items()}
+
+    def _run_admin_command(self, command, target, worker_id=None, timeout=CONTROL_TIMEOUT,
+                           **kwargs):
+        '''Run an admin command in the frontend and/or workers at the same time
+
+        `target` is one of PROFILE_TARGETS. Returns {process name: reply}.
+        '''
+        assert target in PROFILE_TARGETS, f'`target` must be one of {PROFILE_TARGETS}'
+        if target == 'worker' and worker_id is None:
+            raise WorkerControlError('`worker_id` is required to target a worker')
+        pending = {}
+        if target != 'frontend':
+            workers = self._control_targets(worker_id if target == 'worker' else None)
+            pending = self._send_control(workers, command, **kwargs)
+        replies = {}
+        if target in ('frontend', 'all'):
+            replies[f'frontend-{self.pid}'] = ADMIN_COMMANDS[command](**kwargs)
+        for worker_info, ret in self._wait_control(pending, timeout).items():
+            replies[f'worker-{worker_info.wrk_id}'] = ret
+        return replies
+
+    def profile(self, target='workers', worker_id=None, duration=DEFAULT_PROFILE_DURATION,
+                interval=DEFAULT_SAMPLE_INTERVAL, include_idle=False):
+        '''Sample the stacks of the frontend, a worker or all workers for `duration` seconds
+
+        All the targets are profiled at the same time. Returns their merged
+        stacks in collapsed-stack format, each rooted at its process.
+        '''
+        duration = float(duration)
+        profiles = self._run_admin_command(
+            'profile', target, worker_id, timeout=duration + WORKER_TIMEOUT,
+            duration=duration, interval=float(interval), include_idle=include_idle)
+        return merge_collapsed(profiles)
+
+    def tracemalloc(self, action='snapshot', target='workers', worker_id=None, **kwargs):
+        '''Start tracemalloc, take a snapshot or stop it in the frontend and/or workers
+
+        A snapshot lists the top allocation sites of every process, and their
+        growth since its previous snapshot. See `memory.tracemalloc_command`.
+        '''
+        return self._run_admin_command('tracemalloc', target, worker_id,
+                                       action=action, **kwargs)
+
+    def memory_info(self):
+        '''Memory held by pending results and queued tasks, estimated at a bounded cost
+
+        The result dict is sized from a sample of its values, the backlog of
+        a worker from the average size of the tasks it received.
+        '''
+        request_ids = list(self._result_dict.keys())
+        sizes = []
+        for request_id in request_ids[::max(1, len(request_ids) // RESULT_SIZE_SAMPLE)]:
+            ret = self._result_dict.get(request_id)
+            if ret is not None:
+                sizes.append(get_size_bounded(ret))
+        result_bytes = int(sum(sizes) / len(sizes) * len(request_ids)) if sizes else 0
+        with self._lock:
+            workers = list(self.wrk_ps)
+        workers_info = []
+        for worker_info in workers:
+            if worker_info.stats is None:
+                continue
+            backlog = worker_info.queue.qsize()
+            workers_info.append({'wrk_id': worker_info.wrk_id, 'pid': worker_info.pid,
+                                 'backlog': backlog,
+                                 'backlog_bytes': int(backlog * worker_info.stats['task_bytes']),
+                                 'avg_task_bytes': int(worker_info.stats['task_bytes']),
+                                 'rss_mb': round(worker_info.stats['rss'] / 1024 ** 2, 1)})
+        import psutil
+        rss = psutil.Process(self.pid).memory_info().rss
+        return {'frontend': {'pid': self.pid, 'rss_mb': round(rss / 1024 ** 2, 1)},
+                'result_dict': {'items': len(request_ids), 'bytes': result_bytes},
+                'workers': workers_info}
+
+    def add_worker(self, num_workers, gpu_devices, version=None):
         for idx in range(num_workers):
-            ready_event = mp.Event()
-            terminate_event = mp.Event()
-            args = (ready_event, terminate_event)
             if gpu_devices is not None:
                 gpu_id = gpu_devices[idx % len(gpu_devices)]
             else:
                 gpu_id = None
-            wrk_queue = MQueue()  # mp.Queue()
-            worker_id = randint(0, 999999)
-            args = (worker_id, gpu_id, ready_event,
-                    terminate_event, wrk_queue)
-            wrk = mp.Process(target=self._wrk.run, args=args,
-                             daemon=True,
-                             name=f'funicorn-worker-{worker_id}')
-            wrk.start()
-            worker_info = WorkerInfo(wrk=wrk,
-                                     wrk_id=worker_id,
-                                     pid=wrk.pid,
-                                     gpu_id=gpu_id,
-                                     ps_status='unknown',
-                                     queue=wrk_queue,
-                                     ready_event=ready_event,
-                                     terminate_event=terminate_event)
+            worker_info = self._spawn_worker(gpu_id, version)
             with self._lock:
                 self.wrk_ps.append(worker_info)
 
+    def add_worker_pool(self, worker_info):
+        '''Register an external pool (e.g. remote workers) for dispatching'''
+        with self._lock:
+            self.worker_pools.append(worker_info)
+
+    def remove_worker_pool(self, worker_info):
+        with self._lock:
+            if worker_info in self.worker_pools:
+                self.worker_pools.remove(worker_info)
+        self._wait_dispatches(worker_info)
+        self._redispatch_leftovers(worker_info)
+
+    def _drain_worker(self, worker_info, timeout=WORKER_TERMINATE_TIMEOUT):
+        '''Stop dispatching to a worker and wait until it finishes its queue'''
+        with self._lock:
+            if worker_info in self.wrk_ps:
+                self.wrk_ps.remove(worker_info)
+        worker_info.ready_event.clear()
+        is_terminated = worker_info.terminate_event.wait(timeout)
+        if is_terminated:
+            worker_info.wrk.join(WORKER_TIMEOUT)
+            self._wait_dispatches(worker_info)
+            self._redispatch_leftovers(worker_info)
+        return is_terminated
+
+    def _wait_dispatches(self, worker_info):
+        '''Wait until the dispatches which picked a removed worker put their task'''
+        with self._inflight_cond:
+            self._inflight_cond.wait_for(lambda: worker_info.queue not in self._inflight)
+
+    def _redispatch_leftovers(self, worker_info):
+        '''Hand tasks which raced into a stopped worker's queue back to the pool'''
+        # A task just put may still be on its way through the feeder thread
+        # of a multiprocessing queue, so wait for the counted ones
+        while worker_info.queue.qsize() > 0:
+            try:
+                task = worker_info.queue.get(timeout=WORKER_POLL_TIMEOUT)
+            except Empty:
+                break
+            self._dispatch(task)
+
     def terminate_all_workers(self):
         '''Terminate all workers'''
         if len(self.wrk_ps) == 0:
@@ -301,15 +1011,21 @@ class Funicorn():
             self.logger.info(
                 'Received TERMINATE signal. All workers will be killed soon when they finish their jobs')
 
-        for worker_info in self.wrk_ps:
+        with self._lock:
+            running_workers = list(self.wrk_ps)
+            self.wrk_ps.clear()
+        for worker_info in running_workers:
             worker_info.ready_event.clear()
 
         terminate_workers = []
-        for (i, worker_info) in enumerate(self.wrk_ps):
-            is_terminated = worker_info.terminate_event.wait(20000)
+        for worker_info in running_workers:
+            is_terminated = worker_info.terminate_event.wait(
+                WORKER_TERMINATE_TIMEOUT)
             if is_terminated:
-                self.wrk_ps.remove(worker_info)
                 terminate_workers.append(worker_info)
+            else:
+                with self._lock:
+                    self.wrk_ps.append(worker_info)
         return f'Processes will be killed: {", ".join([str(worker_info.pid) for worker_info in terminate_workers])} and there is/are {len(self.wrk_ps)} left'
 
     def idle_all_workers(self):
@@ -325,7 +1041,9 @@ class Funicorn():
         self.idle_event.clear()
         return 'All workers are resuming!'
 
-    def restart_all_workers(self):
+    def restart_all_workers(self, rolling=False, wave_size=None):
+        if rolling:
+            return self.rolling_restart_workers(wave_size)
         self.idle_all_workers()
         self.terminate_all_workers()
         self.logger.info('RESTART all workers')
@@ -334,9 +1052,302 @@ class Funicorn():
         self.resume_all_workers()
         return 'All workers are restarted!'
 
+    def rolling_restart_workers(self, wave_size=None):
+        '''Replace workers wave by wave without dropping serving capacity
+
+        Every worker of a wave gets a replacement on the same device first.
+        Old workers are only drained once all replacements reported ready
+        (after warmup, if configured).
+        '''
+        wave_size = max(1, int(wave_size or self.restart_wave_size))
+        with self._lock:
+            old_workers = list(self.wrk_ps)
+        self.logger.info(
+            f'ROLLING RESTART {len(old_workers)} workers with wave size {wave_size}')
+
+        num_restarted = 0
+        with self._replace_lock:
+            for start in range(0, len(old_workers), wave_size):
+                wave = old_workers[start:start + wave_size]
+                if not self._replace_workers(wave):
+                    self.logger.error('Stop rolling restart')
+                    break
+                num_restarted += len(wave)
+                self.logger.info(
+                    f'Replaced {num_restarted}/{len(old_workers)} workers')
+        return f'{num_restarted}/{len(old_workers)} workers are restarted!'
+
+    def _replace_workers(self, workers):
+        '''Hand the work of `workers` over to new ones on the same devices
+
+        The replacements are registered once all of them reported ready,
+        only then the old workers are drained.
+        '''
+        new_workers = [self._spawn_worker(worker_info.gpu_id,
+                                          worker_info.version)
+                       for worker_info in workers]
+        failed = [worker_info for worker_info in new_workers
+                  if not worker_info.ready_event.wait(WORKER_READY_TIMEOUT)]
+        if failed:
+            self.logger.error(
+                f'{len(failed)} replacement workers cannot start')
+            for worker_info in new_workers:
+                worker_info.wrk.terminate()
+            return False
+        with self._lock:
+            self.wrk_ps.extend(new_workers)
+        for worker_info in workers:
+            self._drain_worker(worker_info)
+            self._request_limits.pop(worker_info.wrk_id, None)
+        return True
+
+    def reconfigure(self, batch_size=None, batch_timeout=None, num_workers=None):
+        '''Hand the work over to workers with another batching configuration
+
+        `batch_timeout` is in milliseconds, as in the constructor. Workers are
+        replaced by ready ones as in a rolling restart, then workers are
+        added or drained down to `num_workers`. Serving never stops.
+        '''
+        with self._replace_lock:
+            if batch_size is not None:
+                self._batch_size = int(batch_size)
+            if batch_timeout is not None:
+                self._batch_timeout = batch_timeout / 1000
+            if self._batch_size == 1:
+                self._batch_timeout = None
+            elif self._batch_timeout is None:
+                self._batch_timeout = DEFAULT_BATCH_TIMEOUT
+            for wrk in self._versions.values():
+                wrk.batch_size = self._batch_size
+                wrk.batch_timeout = self._batch_timeout
+            with self._lock:
+                workers = [worker_info for worker_info in self.wrk_ps
+                           if worker_info.stats is not None]
+            num_workers = len(workers) if num_workers is None else int(num_workers)
+            self.logger.info(
+                f'RECONFIGURE {num_workers} workers with batch size {self._batch_size} '
+                f'and batch timeout {1000 * (self._batch_timeout or 0):g}ms')
+            if workers[:num_workers] and not self._replace_workers(workers[:num_workers]):
+                return False
+            for worker_info in workers[num_workers:]:
+                self._drain_worker(worker_info)
+            new_workers = []
+            for idx in range(len(workers), num_workers):
+                gpu_id = self.gpu_devices[idx % len(self.gpu_devices)] \
+                    if self.gpu_devices else None
+                new_workers.append(self._spawn_worker(gpu_id))
+            if not all(worker_info.ready_event.wait(WORKER_READY_TIMEOUT)
+                       for worker_info in new_workers):
+                self.logger.error('Added workers cannot start')
+                for worker_info in new_workers:
+                    worker_info.wrk.terminate()
+                return False
+            with self._lock:
+                self.wrk_ps.extend(new_workers)
+            self.num_workers = num_workers
+        return True
+
+    def deploy_version(self, version, model_cls=None, model_init_kwargs=None,
+                       num_workers=None, gpu_devices=None, traffic=0):
+        '''Load a new model version into a fresh worker pool
+
+        The current pool keeps serving; the new pool only receives the given
+        traffic percentage once all of its workers are ready.
+        '''
+        if version in self._versions:
+            raise ValueError(f'Model version `{version}` is already deployed')
+        num_workers = int(num_workers or self.num_workers)
+        gpu_devices = gpu_devices if gpu_devices is not None else self.gpu_devices
+        self.logger.info(
+            f'Deploy model version {version} with {num_workers} workers')
+        self._versions[version] = self._build_worker(
+            model_cls or self.model_cls,
+            model_init_kwargs or self._model_init_kwargs)
+        new_workers = []
+        for idx in range(num_workers):
+            gpu_id = gpu_devices[idx % len(gpu_devices)] \
+                if gpu_devices is not None else None
+            new_workers.append(self._spawn_worker(gpu_id, version))
+        if not all(worker_info.ready_event.wait(WORKER_READY_TIMEOUT)
+                   for worker_info in new_workers):
+            for worker_info in new_workers:
+                worker_info.wrk.terminate()
+            del self._versions[version]
+            raise InitializationError(
+                f'Workers of model version `{version}` cannot start')
+        with self._lock:
+            self.wrk_ps.extend(new_workers)
+            self._traffic[version] = 0
+        if traffic:
+            self.shift_traffic(version, traffic)
+        return f'Model version {version} is deployed with {num_workers} workers!'
+
+    def shift_traffic(self, version, percent):
+        '''Route `percent` of the traffic to `version`, stopping any running rollout
+
+        The remaining traffic is split among the other versions in proportion
+        to their current share. The version left with 100% becomes active, and
+        a shift leaving the active version at 0% without promoting another one
+        is rejected.
+        '''
+        self._rollout_cancel.set()
+        self._shift_traffic(version, percent)
+        return self.versions_info()
+
+    def _shift_traffic(self, version, percent, cancel_event=None):
+        '''Returns False if `cancel_event` was set before the traffic was shifted'''
+        if version not in self._versions:
+            raise ValueError(f'Model version `{version}` is not deployed')
+        percent = min(max(float(percent), 0), 100)
+        with self._lock:
+            if cancel_event is not None and cancel_event.is_set():
+                return False
+            others = {v: p for v, p in self._traffic.items() if v != version}
+            others_total = sum(others.values())
+            if percent < 100 and others_total == 0 and version == self.active_version:
+                raise ValueError(f'No other model version can take {100 - percent}% '
+                                 f'of the traffic from `{version}`')
+            traffic = {version: percent}
+            for v, p in others.items():
+                if others_total > 0:
+                    traffic[v] = (100 - percent) * p / others_total
+                else:
+                    traffic[v] = (100 - percent) if v == self.active_version else 0
+            active_version = version if percent == 100 else self.active_version
+            if traffic.get(active_version, 0) == 0:
+                # Shifting all the traffic away from the active version
+                # promotes the version taking all of it
+                promoted = [v for v, p in traffic.items() if p >= 100]
+                if not promoted:
+                    raise ValueError(f'Model version `{active_version}` is active, '
+                                     f'no other version takes all of its traffic')
+                active_version = promoted[0]
+            if (percent > 0 and version != self.active_version) or \
+                    active_version != self.active_version:
+                # Where a rollback sends the traffic, during and after the rollout
+                self._previous_version = self.active_version
+            self.active_version = active_version
+            self._traffic = traffic
+        self.logger.info(f'Shift {percent}% of traffic to model version {version}')
+        return True
+
+    def rollout_version(self, version, step=10, interval=30):
+        '''Shift traffic to `version` gradually by `step` percent every `interval` seconds
+
+        The rollout stops at a manual shift, a rollback, a release or
+        another rollout.
+        '''
+        if version not in self._versions:
+            raise ValueError(f'Model version `{version}` is not deployed')
+        if version == self.active_version:
+            raise ValueError(f'Model version `{version}` is already active')
+        self._rollout_cancel.set()
+        cancel_event = self._rollout_cancel = threading.Event()
+        with self._lock:
+            self._previous_version = self.active_version
+
+        def _rollout():
+            percent = self._traffic.get(version, 0)
+            while percent < 100 and not cancel_event.is_set():
+                percent = min(100, percent + step)
+                try:
+                    if not self._shift_traffic(version, percent, cancel_event):
+                        break
+                except ValueError as e:
+                    self.logger.error(f'Stop rollout of model version {version}: {e}')
+                    break
+                if percent < 100:
+                    cancel_event.wait(interval)
+
+        threading.Thread(target=_rollout, daemon=True).start()
+        return f'Rolling out model version {version} by {step}% every {interval}s'
+
+    def rollback(self):
+        '''Send all traffic back to the previous model version if its pool is still alive'''
+        previous_version = self._previous_version
+        if previous_version not in self._versions:
+            raise ValueError('There is no previous model version to roll back to')
+        return self.shift_traffic(previous_version, 100)
+
+    def release_version(self, version):
+        '''Stop routing to `version` and release its pool once its queues drain'''
+        if version not in self._versions:
+            raise ValueError(f'Model version `{version}` is not deployed')
+        if version == self.active_version:
+            raise ValueError(f'Cannot release the active model version `{version}`')
+        # Stops a rollout of `version` too
+        self.shift_traffic(version, 0)
+        with self._lock:
+            workers = [worker_info for worker_info in self.wrk_ps
+                       if worker_info.version == version]
+        for worker_info in workers:
+            self._drain_worker(worker_info)
+        with self._lock:
+            del self._versions[version]
+            del self._traffic[version]
+        if self._previous_version == version:
+            self._previous_version = None
+        return f'Model version {version} is released!'
+
+    def versions_info(self):
+        with self._lock:
+            num_workers = {version: 0 for version in self._versions}
+            for worker_info in self.wrk_ps:
+                num_workers[worker_info.version] += 1
+            return {version: {'traffic': round(self._traffic.get(version, 0), 2),
+                              'num_workers': num_workers[version],
+                              'active': version == self.active_version}
+                    for version in self._versions}
+
+    def _recycle_reason(self, worker_info):
+        '''Why a worker must be recycled, None while it is within its limits'''
+        if self.max_requests:
+            # The jitter keeps workers started together from recycling together
+            limit = self._request_limits.setdefault(
+                worker_info.wrk_id,
+                self.max_requests + randint(0, self.max_requests_jitter or 0))
+            if worker_info.stats['tasks'] >= limit:
+                return 'max_requests'
+        if self.max_rss and worker_info.stats['rss'] > self.max_rss * 1024 ** 2:
+            return 'max_rss'
+        return None
+
     def check_all_worker(self):
-        '''Check status of all workers. Restart them if necessary'''
-        pass
+        '''Check status of all workers. Recycle the ones over their limits
+
+        At most `restart_wave_size` workers are recycled per check so that
+        the serving capacity holds.
+        '''
+        with self._lock:
+            workers = [worker_info for worker_info in self.wrk_ps
+                       if worker_info.stats is not None]
+        expired = [(worker_info, reason) for worker_info in workers
+                   for reason in [self._recycle_reason(worker_info)] if reason]
+        for worker_info, reason in expired[:max(1, self.restart_wave_size)]:
+            self.recycle_worker(worker_info, reason)
+
+    def recycle_worker(self, worker_info, reason):
+        '''Replace a worker by a fresh process once the replacement is ready'''
+        with self._replace_lock:
+            with self._lock:
+                if worker_info not in self.wrk_ps:
+                    return False
+            stats = worker_info.stats.snapshot()
+            self.logger.info(
+                f"Recycle {colored_worker_name(f'WORKER-{worker_info.wrk_id}')} ({reason}): "
+                f"{stats['tasks']} tasks, RSS {stats['rss_mb']}MB")
+            if not self._replace_workers([worker_info]):
+                return False
+        self.recycles[reason] += 1
+        self._recycles_metric.inc(reason=reason)
+        return True
+
+    def _monitor_workers(self):
+        while not self._shutdown_event.wait(WORKER_CHECK_INTERVAL):
+            try:
+                self.check_all_worker()
+            except Exception:
+                self.logger.error(traceback.format_exc())
 
     def _recheck_all_modules(self):
         if len(self.connection_apps) == 0 and not self.model_cls:
@@ -349,7 +1360,12 @@ class Funicorn():
             self._wait_for_worker()
             self._init_connections()
             self._recheck_all_modules()
-            self._start_task_distributations()
+            if self.max_requests or self.max_rss:
+                threading.Thread(target=self._monitor_workers, daemon=True).start()
+            if self.dispatch_mode == 'queue' and self._backend is None:
+                self._start_task_distributations()
+            else:
+                self._shutdown_event.wait()
         except KeyboardInterrupt:
             exit()
         except Exception as e:
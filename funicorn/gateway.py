@@ -0,0 +1,292 @@
+import bisect
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+from thrift.transport import TTransport, TSocket
+
+from .rpc import FunicornService
+from .logger import get_logger
+from .utils import colored_network_name
+
+__all__ = ['ConsistentHashRing', 'HttpNode', 'ThriftNode', 'Gateway']
+
+DEFAULT_REPLICAS = 100
+DEFAULT_POOL_SIZE = 10
+HEALTH_CHECK_INTERVAL = 2
+MAX_FAILURES = 3
+
+
+def _hash(key):
+    return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+
+class ConsistentHashRing():
+    '''Map keys to nodes so that adding/removing a node only moves ~1/N keys'''
+
+    def __init__(self, nodes=None, replicas=DEFAULT_REPLICAS):
+        self.replicas = replicas
+        self._hashes = []
+        self._nodes = {}
+        for node in nodes or []:
+            self.add(node)
+
+    def __len__(self):
+        return len(set(self._nodes.values()))
+
+    def add(self, node):
+        for idx in range(self.replicas):
+            point = _hash(f'{node}#{idx}')
+            if point not in self._nodes:
+                bisect.insort(self._hashes, point)
+            self._nodes[point] = node
+
+    def remove(self, node):
+        for idx in range(self.replicas):
+            point = _hash(f'{node}#{idx}')
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                self._hashes.remove(point)
+
+    def get_nodes(self, key, n=1):
+        '''Return up to `n` distinct nodes, the owner of `key` first'''
+        if not self._hashes:
+            return []
+        nodes = []
+        start = bisect.bisect(self._hashes, _hash(key))
+        for idx in range(len(self._hashes)):
+            node = self._nodes[self._hashes[(start + idx) % len(self._hashes)]]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == n:
+                    break
+        return nodes
+
+    def get(self, key):
+        nodes = self.get_nodes(key)
+        return nodes[0] if nodes else None
+
+
+class HttpNode():
+    '''Funicorn backend reached through its HTTP API with pooled keep-alive connections'''
+    # Errors meaning the backend could not be reached, rather than a rejected request
+    transport_errors = (requests.ConnectionError, requests.Timeout)
+
+    def __init__(self, url, pool_size=DEFAULT_POOL_SIZE, timeout=10):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __str__(self):
+        return self.url
+
+    def request(self, method, *args, **kwargs):
+        '''Call `/api/<method>`, `files` are sent as multipart and the rest as query params'''
+        files = kwargs.pop('files', None)
+        if method == 'predict_img_bytes' and args:
+            files = {'img_bytes': args[0]}
+        elif method == 'predict_url' and args:
+            kwargs['url'] = args[0]
+        http_method = 'post' if files else 'get'
+        resp = self.session.request(http_method, f'{self.url}/api/{method}',
+                                    params=kwargs, files=files,
+                                    timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+    def check(self):
+        self.session.get(f'{self.url}/api/status',
+                         timeout=self.timeout).raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+class ThriftNode():
+    '''Thrift backend with a pool of persistent framed connections
+
+    `service` is the generated Thrift service module, FunicornService by
+    default. Health checks call its `ping`.
+    '''
+    transport_errors = (TTransport.TTransportException, OSError)
+
+    def __init__(self, url, pool_size=DEFAULT_POOL_SIZE, service=FunicornService,
+                 timeout=10):
+        self.url = url
+        host, port = url.split('://')[-1].rsplit(':', 1)
+        self.host = host
+        self.port = int(port)
+        self.pool_size = pool_size
+        self.service = service
+        self.timeout = timeout
+        self._pool = queue.LifoQueue()
+
+    def __str__(self):
+        return self.url
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            socket = TSocket.TSocket(self.host, self.port)
+            socket.setTimeout(self.timeout * 1000)
+            transport = TTransport.TFramedTransport(socket)
+            client = self.service.Client(TBinaryProtocol(transport))
+            transport.open()
+            return client, transport
+
+    def _release(self, connection):
+        if self._pool.qsize() < self.pool_size:
+            self._pool.put(connection)
+        else:
+            connection[1].close()
+
+    def request(self, method, *args, **kwargs):
+        client, transport = connection = self._acquire()
+        try:
+            result = getattr(client, method)(*args, **kwargs)
+        except Exception:
+            # Never give a broken connection back to the pool
+            transport.close()
+            raise
+        self._release(connection)
+        return result
+
+    def check(self):
+        self.request('ping')
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait()[1].close()
+            except queue.Empty:
+                break
+
+
+class Gateway():
+    '''Fan requests out across several Funicorn instances
+
+    Requests are routed by consistent hashing on a key for cache locality.
+    Backends failing `max_failures` health checks or calls in a row are
+    ejected from the ring and added back once a health check passes again.
+    Only transport errors (refused, reset, timed out) fail a call over to the
+    next backend; errors returned by a backend are raised to the caller.
+
+    Parameters
+    ----------
+    backends : list
+        Urls like http://10.0.0.1:5000 or thrift://10.0.0.2:5001
+    thrift_service : module
+        Generated Thrift service module of the thrift backends
+    '''
+
+    def __init__(self, backends, replicas=DEFAULT_REPLICAS, pool_size=DEFAULT_POOL_SIZE,
+                 thrift_service=FunicornService,
+                 health_interval=HEALTH_CHECK_INTERVAL, max_failures=MAX_FAILURES,
+                 max_parallel=None, debug=False):
+        self.logger = get_logger(colored_network_name('GATEWAY'),
+                                 mode='debug' if debug else 'info')
+        self.nodes = {}
+        for url in backends:
+            if url.startswith('thrift://'):
+                self.nodes[url] = ThriftNode(url, pool_size=pool_size,
+                                             service=thrift_service)
+            else:
+                self.nodes[url] = HttpNode(url, pool_size=pool_size)
+        self.ring = ConsistentHashRing(self.nodes, replicas=replicas)
+        self.max_failures = max_failures
+        self.health_interval = health_interval
+        self._failures = {url: 0 for url in self.nodes}
+        self._ejected = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_parallel or max(4, len(self.nodes)))
+        self._health_thread = threading.Thread(
+            target=self._health_check_loop, daemon=True)
+        self._health_thread.start()
+
+    @property
+    def healthy_nodes(self):
+        return [url for url in self.nodes if url not in self._ejected]
+
+    def _on_failure(self, url):
+        with self._lock:
+            self._failures[url] += 1
+            if self._failures[url] >= self.max_failures and url not in self._ejected:
+                self._ejected.add(url)
+                self.ring.remove(url)
+                self.logger.warning(f'Eject unhealthy backend {url}')
+
+    def _on_success(self, url):
+        with self._lock:
+            self._failures[url] = 0
+            if url in self._ejected:
+                self._ejected.remove(url)
+                self.ring.add(url)
+                self.logger.info(f'Backend {url} is healthy again')
+
+    def _health_check_loop(self):
+        while True:
+            for url, node in self.nodes.items():
+                try:
+                    node.check()
+                except Exception:
+                    self._on_failure(url)
+                else:
+                    self._on_success(url)
+            time.sleep(self.health_interval)
+
+    def route(self, key):
+        '''Return the url of the backend owning `key`'''
+        with self._lock:
+            return self.ring.get(key)
+
+    def call(self, key, method, *args, retries=1, **kwargs):
+        '''Call `method` on the backend owning `key`, failing over to the next ones'''
+        with self._lock:
+            urls = self.ring.get_nodes(key, n=retries + 1)
+        if not urls:
+            raise ConnectionError('No healthy backend available')
+        for idx, url in enumerate(urls):
+            node = self.nodes[url]
+            try:
+                result = node.request(method, *args, **kwargs)
+            except node.transport_errors:
+                self._on_failure(url)
+                self.logger.warning(f'Call {method} to {url} failed')
+                if idx == len(urls) - 1:
+                    raise
+            else:
+                return result
+
+    def scatter_gather(self, method, *args, urls=None, timeout=None, **kwargs):
+        '''Call `method` on several backends in parallel
+
+        Returns a dict of url to result, or to the raised exception.
+        '''
+        urls = urls or self.healthy_nodes
+        futures = {self._executor.submit(self.nodes[url].request, method, *args, **kwargs): url
+                   for url in urls}
+        done, not_done = wait(futures, timeout=timeout)
+        results = {}
+        for future in done:
+            url = futures[future]
+            exc = future.exception()
+            results[url] = exc if exc is not None else future.result()
+        for future in not_done:
+            results[futures[future]] = TimeoutError(
+                f'{method} timed out after {timeout}s')
+        return results
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        for node in self.nodes.values():
+            node.close()
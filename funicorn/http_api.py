@@ -1,7 +1,6 @@
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify, g
 from waitress import serve
 import threading
-from PIL import Image
 import numpy as np
 import time
 from collections import namedtuple
@@ -9,10 +8,21 @@ from http import HTTPStatus
 import traceback
 
 from .exceptions import NotSupportedInputFile, MaxFileSizeExeeded, InitializationError
-from .exceptions import DownloadURLError
-from .utils import colored_network_name, check_all_ps_status
+from .exceptions import DownloadURLError, PredictionError, WorkerControlError
+from .utils import colored_network_name, check_all_ps_status, split_class_from_path
+from .utils import check_deploy_allowed
+from .utils import npy_bytes_to_ndarray, raw_bytes_to_ndarray, NPY_CONTENT_TYPE
+from .utils import MAX_BODY_SIZE
+from .decode import ImageDecoder
+from .fetch import URLFetcher
+from .serializers import negotiate, negotiate_content_type
+from .metrics import MetricsRegistry, request_metrics, serialization_metric
+from .metrics import METRICS_CONTENT_TYPE
+from .tracing import TRACE_ID_HEADER
+from .profiler import profile_kwargs, COLLAPSED_CONTENT_TYPE
+from .memory import tracemalloc_kwargs
 from .logger import get_logger
-from .stat import Statistic
+from .stat import Statistic, STREAM_CONTENT_TYPE, DEFAULT_STREAM_INTERVAL
 from enum import Enum
 
 
@@ -21,21 +31,56 @@ class ResponseStatus(Enum):
 
 
 class HttpAPI(threading.Thread):
-    def __init__(self, funicorn_app=None, host='0.0.0.0', port=5001, stat=None, threads=40, name='HTTP', timeout=1000, debug=False, register_conn=True):
+    def __init__(self, funicorn_app=None, host='0.0.0.0', port=5001, stat=None, threads=40, name='HTTP', timeout=1000, decoder=None, fetcher=None, fetch_urls=True, preserialize=False,
+                 tracer=None, deploy_models=None, max_streams=None, debug=False, register_conn=True):
         threading.Thread.__init__(self, daemon=True)
         self.name = name
         self.host = host
         self.port = port
         self.threads = threads
         self.timeout = timeout
+        # Let workers serialize results to the negotiated response format
+        self.preserialize = preserialize
         self.funicorn_app = funicorn_app
         self.stat = stat or Statistic(funicorn_app=funicorn_app)
+        self.metrics = getattr(funicorn_app, 'metrics', None) or MetricsRegistry()
+        self._requests_metric, self._latency_metric = request_metrics(self.metrics)
+        self._serialization_metric = serialization_metric(self.metrics)
+        self.decoder = decoder or ImageDecoder(
+            model_cls=getattr(funicorn_app, 'model_cls', None))
+        # Without a fetcher the url itself is given to the model
+        self.fetcher = (fetcher or URLFetcher(debug=debug)) if fetch_urls else None
+        # Sampled predict requests are traced when a `tracing.Tracer` is given
+        self.tracer = tracer
+        # Model class paths /api/deploy may load, it is disabled when None
+        self.deploy_models = deploy_models
+        # Every /api/stream_status connection holds a waitress thread, at most
+        # a quarter of them by default so that dashboards cannot starve predictions
+        self.max_streams = max_streams if max_streams is not None else max(1, threads // 4)
+        self._streams = threading.BoundedSemaphore(self.max_streams)
         self.logger = get_logger(colored_network_name('HTTP'),
                                  mode='debug' if debug else 'info')
 
         if register_conn and funicorn_app is not None:
             self.funicorn_app.register_connection(self)
 
+    def wire_format(self):
+        '''Format workers serialize results to, None to get Python objects'''
+        if not self.preserialize:
+            return None
+        return negotiate_content_type(request.headers.get('Accept'))
+
+    def predict(self, data):
+        return self.funicorn_app.predict(data, wire_format=self.wire_format(),
+                                         trace=g.get('trace'))
+
+    def make_response(self, payload, status=HTTPStatus.OK):
+        '''Encode `payload` in the format negotiated from the Accept header'''
+        start_time = time.time()
+        body, content_type = negotiate(payload, request.headers.get('Accept'))
+        self._serialization_metric.observe(time.time() - start_time, stage='frontend')
+        return Response(body, status=status, content_type=content_type)
+
     def init_exception(self, app):
         @app.errorhandler(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
         def max_file_size_exeeded(error):
@@ -74,6 +119,16 @@ class HttpAPI(threading.Thread):
                 "error_message": error.message,
                 "results": []
             })
+            resp.status_code = error.status_code
+            return resp
+
+        @app.errorhandler(PredictionError)
+        def prediction_error(error):
+            resp = jsonify({
+                "error_code": HTTPStatus.INTERNAL_SERVER_ERROR,
+                "error_message": f'Prediction failed: {error}',
+                "results": []
+            })
             resp.status_code = HTTPStatus.INTERNAL_SERVER_ERROR
             return resp
 
@@ -92,20 +147,32 @@ class HttpAPI(threading.Thread):
         app = Flask(__name__)
         app = self.init_exception(app)
 
+        @app.before_request
+        def start_timer():
+            g.start_time = time.time()
+            g.trace = None
+            if self.tracer is not None and request.url_rule is not None \
+                    and request.url_rule.rule.startswith('/api/predict'):
+                g.trace = self.tracer.start(request.headers, request.url_rule.rule)
+
+        @app.after_request
+        def record_request(response):
+            endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+            latency = time.time() - g.start_time
+            self._requests_metric.inc(endpoint=endpoint, code=response.status_code)
+            self._latency_metric.observe(latency, endpoint=endpoint)
+            if endpoint.startswith('/api/predict'):
+                self.stat.record_latency(latency)
+            if g.get('trace') is not None:
+                self.tracer.finish(g.trace, response.status_code)
+                response.headers[TRACE_ID_HEADER] = g.trace.trace_id
+            return response
+
         def check_request_size(request, max_size=5 * 1024 * 1024):
-            if request.content_length > max_size:
+            if (request.content_length or 0) > max_size:
                 raise MaxFileSizeExeeded(
                     "Input file size too large, limit is {:0.2f}MB".format(max_size/(1024**2)))
 
-        def convert_bytes_to_img_arr(img_bytes):
-            try:
-                img = Image.open(img_bytes).convert("RGB")
-                # img = np.array(img, np.uint8)
-                return img
-            except:
-                raise NotSupportedInputFile(
-                    "Wrong input file type, only accept image")
-
         @app.route("/api/predict_img_bytes", methods=['POST'])
         def predict_img_bytes():
             final_res = []
@@ -114,19 +181,18 @@ class HttpAPI(threading.Thread):
                 check_request_size(request)
                 if 'img_bytes' in request.files:
                     img_bytes = request.files['img_bytes']
-                    img = convert_bytes_to_img_arr(img_bytes)
-                    results = self.funicorn_app.predict_img_bytes(img)
+                    img = self.decoder.decode(img_bytes.read())
+                    results = self.predict(img)
                     if results is ResponseStatus.CANNOT_DOWNLOAD_URL:
                         abort(DownloadURLError)
                     else:
                         final_res = results
                     final_res = final_res if len(final_res) != 0 else []
-                    resp = jsonify({
+                    resp = self.make_response({
                         "error_code": 0,
                         "error_message": "Successful.",
                         "results": final_res
                     })
-                    resp.status_code = HTTPStatus.OK
                     self.stat.increment('total_res')
                     return resp
                 else:
@@ -141,23 +207,63 @@ class HttpAPI(threading.Thread):
                 self.stat.increment('crashes')
                 abort(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
 
+            except PredictionError:
+                self.stat.increment('crashes')
+                raise
+
             except Exception as e:
                 self.stat.increment('crashes')
                 self.logger.error(traceback.format_exc())
                 abort(HTTPStatus.INTERNAL_SERVER_ERROR)
 
+        @app.route('/api/predict_tensor', methods=['POST'])
+        def predict_tensor():
+            '''Predict a tensor sent as .npy or as raw bytes with X-Dtype/X-Shape headers'''
+            try:
+                self.stat.increment('total_req')
+                check_request_size(request, MAX_BODY_SIZE)
+                # Bounded read, a chunked body has no Content-Length
+                body = request.stream.read(MAX_BODY_SIZE + 1)
+                if len(body) > MAX_BODY_SIZE:
+                    raise MaxFileSizeExeeded('Request body too large')
+                if request.mimetype == NPY_CONTENT_TYPE:
+                    tensor = npy_bytes_to_ndarray(body)
+                else:
+                    tensor = raw_bytes_to_ndarray(body, request.headers['X-Dtype'],
+                                                  request.headers['X-Shape'])
+            except MaxFileSizeExeeded:
+                self.stat.increment('crashes')
+                abort(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            except (KeyError, ValueError, TypeError):
+                self.stat.increment('crashes')
+                abort(HTTPStatus.BAD_REQUEST)
+            results = self.predict(tensor)
+            resp = self.make_response({
+                "error_code": 0,
+                "error_message": "Successful.",
+                "results": results
+            })
+            self.stat.increment('total_res')
+            return resp
+
         @app.route('/api/predict_json', methods=['POST'])
         def predict_json():
-            self.stat.increment('num_req')
+            self.stat.increment('total_req')
+            if 'url' not in request.args:
+                self.stat.increment('crashes')
+                abort(HTTPStatus.BAD_REQUEST)
             try:
-                url = request.args['url']
-                result = self.funicorn_app.predict(url)
-                self.stat.increment('num_res')
-                self.logger.info(f'result is: {result}')
+                result = self.funicorn_app.predict(request.args['url'])
+            except PredictionError:
+                self.stat.increment('crashes')
+                raise
             except Exception as e:
-                return jsonify({'result': e})
-            else:
-                return jsonify({'result': result})
+                self.stat.increment('crashes')
+                self.logger.error(traceback.format_exc())
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+            self.stat.increment('total_res')
+            self.logger.debug(f'result is: {result}')
+            return self.make_response({'result': result})
 
         @app.route('/api/status', methods=['GET'])
         def status():
@@ -170,6 +276,10 @@ class HttpAPI(threading.Thread):
             else:
                 return resp
 
+        @app.route('/metrics', methods=['GET'])
+        def metrics():
+            return Response(self.metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
         @app.route('/api/cli_status', methods=['GET'])
         def cli_status():
             try:
@@ -181,6 +291,95 @@ class HttpAPI(threading.Thread):
             else:
                 return resp
 
+        @app.route('/api/cli_workers', methods=['GET'])
+        def cli_workers():
+            try:
+                resp = jsonify(self.stat.cli_workers_info)
+                resp.status_code = HTTPStatus.OK
+            except Exception as e:
+                self.logger.error(traceback.format_exc())
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+            else:
+                return resp
+
+        @app.route('/api/stream_status', methods=['GET'])
+        def stream_status():
+            '''Statistics as server-sent events, over one connection'''
+            try:
+                interval = float(request.args.get('interval', DEFAULT_STREAM_INTERVAL))
+            except ValueError:
+                abort(HTTPStatus.BAD_REQUEST)
+            if not self._streams.acquire(blocking=False):
+                resp = jsonify({
+                    "error_code": HTTPStatus.SERVICE_UNAVAILABLE,
+                    "error_message": f'Too many status streams (max {self.max_streams})',
+                    "results": []
+                })
+                resp.status_code = HTTPStatus.SERVICE_UNAVAILABLE
+                return resp
+            resp = Response(self.stat.stream(interval), content_type=STREAM_CONTENT_TYPE,
+                            headers={'Cache-Control': 'no-cache'})
+            # Called when the client disconnects
+            resp.call_on_close(self._streams.release)
+            return resp
+
+        @app.route('/api/profile', methods=['GET'])
+        def profile():
+            '''Profile the frontend or workers for `duration` seconds, as collapsed stacks'''
+            try:
+                kwargs = profile_kwargs(request.args)
+                body = self.funicorn_app.profile(**kwargs)
+            except ValueError as e:
+                abort(HTTPStatus.BAD_REQUEST)
+            except WorkerControlError as e:
+                resp = jsonify({
+                    "error_code": HTTPStatus.BAD_REQUEST,
+                    "error_message": str(e),
+                    "results": []
+                })
+                resp.status_code = HTTPStatus.BAD_REQUEST
+                return resp
+            except Exception as e:
+                self.logger.error(traceback.format_exc())
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+            filename = f"funicorn-{kwargs['target']}.collapsed"
+            return Response(body, content_type=COLLAPSED_CONTENT_TYPE,
+                            headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+        @app.route('/api/memory', methods=['GET'])
+        def memory():
+            try:
+                resp = jsonify(self.funicorn_app.memory_info())
+                resp.status_code = HTTPStatus.OK
+            except Exception as e:
+                self.logger.error(traceback.format_exc())
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+            else:
+                return resp
+
+        @app.route('/api/tracemalloc', methods=['GET'])
+        def tracemalloc():
+            '''Start, snapshot or stop tracemalloc in the frontend or workers'''
+            try:
+                resp = jsonify(self.funicorn_app.tracemalloc(
+                    **tracemalloc_kwargs(request.args)))
+                resp.status_code = HTTPStatus.OK
+            except ValueError as e:
+                abort(HTTPStatus.BAD_REQUEST)
+            except (WorkerControlError, RuntimeError) as e:
+                resp = jsonify({
+                    "error_code": HTTPStatus.BAD_REQUEST,
+                    "error_message": str(e),
+                    "results": []
+                })
+                resp.status_code = HTTPStatus.BAD_REQUEST
+                return resp
+            except Exception as e:
+                self.logger.error(traceback.format_exc())
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+            else:
+                return resp
+
         @app.route('/api/resume', methods=['GET'])
         def resume_all_workers():
             try:
@@ -220,7 +419,10 @@ class HttpAPI(threading.Thread):
         @app.route('/api/restart', methods=['GET'])
         def restart_all_workers():
             try:
-                ps_stt = self.funicorn_app.restart_all_workers()
+                rolling = request.args.get('rolling', 'false').lower() == 'true'
+                wave_size = request.args.get('wave_size')
+                ps_stt = self.funicorn_app.restart_all_workers(
+                    rolling=rolling, wave_size=wave_size)
                 resp = jsonify(ps_stt)
                 resp.status_code = HTTPStatus.OK
             except Exception as e:
@@ -246,6 +448,103 @@ class HttpAPI(threading.Thread):
             else:
                 return resp
 
+        @app.route('/api/versions', methods=['GET'])
+        def versions():
+            try:
+                resp = jsonify(self.funicorn_app.versions_info())
+                resp.status_code = HTTPStatus.OK
+            except Exception as e:
+                self.logger.error(traceback.format_exc())
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+            else:
+                return resp
+
+        @app.route('/api/deploy', methods=['POST'])
+        def deploy_version():
+            try:
+                version = request.args['version']
+                model_cls = request.args.get('model_cls')
+                check_deploy_allowed(model_cls, self.deploy_models)
+                if model_cls is not None:
+                    pkg, model_cls = split_class_from_path(model_cls)
+                model_init_kwargs = request.args.get('model_init_kwargs')
+                if model_init_kwargs:
+                    model_init_kwargs = dict(kwarg.split(':')
+                                             for kwarg in model_init_kwargs.split(','))
+                gpu_devices = request.args.get('gpu_devices')
+                gpu_devices = gpu_devices.split(',') \
+                    if gpu_devices is not None else None
+                ps_stt = self.funicorn_app.deploy_version(
+                    version, model_cls=model_cls,
+                    model_init_kwargs=model_init_kwargs,
+                    num_workers=request.args.get('num_workers'),
+                    gpu_devices=gpu_devices,
+                    traffic=float(request.args.get('traffic', 0)))
+                resp = jsonify(ps_stt)
+                resp.status_code = HTTPStatus.OK
+            except PermissionError as e:
+                resp = jsonify({"error_code": HTTPStatus.FORBIDDEN,
+                                "error_message": str(e)})
+                resp.status_code = HTTPStatus.FORBIDDEN
+                return resp
+            except (KeyError, ValueError) as e:
+                abort(HTTPStatus.BAD_REQUEST)
+            except Exception as e:
+                self.logger.error(traceback.format_exc())
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+            else:
+                return resp
+
+        @app.route('/api/shift_traffic', methods=['GET'])
+        def shift_traffic():
+            try:
+                version = request.args['version']
+                percent = float(request.args['percent'])
+                step = request.args.get('step')
+                if step is not None:
+                    ps_stt = self.funicorn_app.rollout_version(
+                        version, step=float(step),
+                        interval=float(request.args.get('interval', 30)))
+                else:
+                    ps_stt = self.funicorn_app.shift_traffic(version, percent)
+                resp = jsonify(ps_stt)
+                resp.status_code = HTTPStatus.OK
+            except (KeyError, ValueError) as e:
+                abort(HTTPStatus.BAD_REQUEST)
+            except Exception as e:
+                self.logger.error(traceback.format_exc())
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+            else:
+                return resp
+
+        @app.route('/api/rollback', methods=['GET'])
+        def rollback():
+            try:
+                resp = jsonify(self.funicorn_app.rollback())
+                resp.status_code = HTTPStatus.OK
+            except ValueError as e:
+                abort(HTTPStatus.BAD_REQUEST)
+            except Exception as e:
+                self.logger.error(traceback.format_exc())
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+            else:
+                return resp
+
+        @app.route('/api/release', methods=['GET'])
+        def release_version():
+            try:
+                ps_stt = self.funicorn_app.release_version(
+                    request.args['version'])
+                resp = jsonify(ps_stt)
+                resp.status_code = HTTPStatus.OK
+            except (KeyError, ValueError) as e:
+                abort(HTTPStatus.BAD_REQUEST)
+            except Exception as e:
+                self.logger.error(traceback.format_exc())
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+            else:
+                return resp
+
         @app.route('/api/predict_url', methods=['POST', 'GET'])
         def predict_url():
             final_res = []
@@ -253,18 +552,21 @@ class HttpAPI(threading.Thread):
                 self.stat.increment('total_req')
                 if 'url' in request.args:
                     url = request.args['url']
-                    results = self.funicorn_app.predict(url)
+                    if self.fetcher is not None:
+                        data = self.decoder.decode(self.fetcher.fetch(url))
+                    else:
+                        data = url
+                    results = self.predict(data)
                     if results is ResponseStatus.CANNOT_DOWNLOAD_URL:
                         raise DownloadURLError(
                             message='Cannot download data from url!')
                     else:
                         final_res = results
-                    resp = jsonify({
+                    resp = self.make_response({
                         "error_code": HTTPStatus.OK,
                         "error_message": "Successful.",
                         "results": final_res
                     })
-                    resp.status_code = HTTPStatus.OK
                     self.stat.increment('total_res')
                     return resp
                 else:
@@ -279,6 +581,10 @@ class HttpAPI(threading.Thread):
                 self.stat.increment('crashes')
                 abort(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
 
+            except (PredictionError, DownloadURLError):
+                self.stat.increment('crashes')
+                raise
+
             # except Exception as e:
             #     self.stat.increment('crashes')
             #     self.logger.error(traceback.format_exc())
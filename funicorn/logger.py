@@ -1,7 +1,16 @@
+import atexit
 import logging
+import logging.handlers
+import multiprocessing.util
 import uuid
-from logging import Formatter
+import json
 import os
+import queue
+import random
+import re
+import threading
+import time
+from logging import Formatter
 
 #--------------------- Logger ---------------------#
 
@@ -27,18 +36,253 @@ class ColoredFormatter(Formatter):
         colored_levelname = ('{0}{1}m{2}{3}').format(
             PREFIX, seq, levelname, SUFFIX)
         record.levelname = colored_levelname
-        return Formatter.format(self, record)
+        try:
+            return Formatter.format(self, record)
+        finally:
+            # Other sinks of the same record must not see the colors
+            record.levelname = levelname
+
+
+#--------------------- Structured / Non-blocking logging ---------------------#
+
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+LOG_QUEUE_SIZE = 10000
+LOG_PATTERN = '%(asctime)s | %(levelname)-8s | %(name)s: %(message)s'
+# Attributes of every LogRecord, anything else was passed through `extra`
+RECORD_ATTRS = set(logging.LogRecord(
+    '', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+_CONFIG = {
+    'asynchronous': False,
+    'fmt': 'color',
+    'rate_limit': None,
+    'sample_rate': None,
+    'log_dir': None,
+}
+_LOGGERS = []
+
+
+class JSONFormatter(Formatter):
+    '''Format records as one JSON object per line'''
+
+    def format(self, record):
+        payload = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'name': ANSI_ESCAPE.sub('', record.name),
+            'pid': record.process,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRS:
+                payload[key] = value
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exc'] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    '''Rate limit and/or sample records per message type
+
+    A message type is the `msg_type` passed through `extra`, or the call site
+    of the record otherwise. Warnings and errors are never dropped.
+    '''
+
+    def __init__(self, rate_limit=None, sample_rate=None):
+        logging.Filter.__init__(self)
+        self.rate_limit = rate_limit
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        self._buckets = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rate is not None and random.random() >= self.sample_rate:
+            self.dropped += 1
+            return False
+        if self.rate_limit is not None:
+            key = getattr(record, 'msg_type', None) or \
+                (record.name, record.pathname, record.lineno)
+            now = time.monotonic()
+            tokens, last = self._buckets.get(key, (self.rate_limit, now))
+            tokens = min(self.rate_limit, tokens +
+                         (now - last) * self.rate_limit)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self.dropped += 1
+                return False
+            self._buckets[key] = (tokens - 1, now)
+        return True
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room instead of failing when the queue is full, so that
+        # the records queued before `stop` are all written
+        self.queue.put(self._sentinel)
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    '''Hand records to a background writer thread without blocking
+
+    Every process owns its queue and writer thread. They are (re)created
+    lazily, so forked workers get their own writer. Records are dropped
+    when the queue is full instead of blocking the caller, and counted in
+    `dropped`, except warnings and errors which wait for room. The queue is
+    flushed when the process exits.
+    '''
+    _pid = None
+    _queue = None
+    _listener = None
+    _sinks = []
+    _lock = threading.Lock()
+    dropped = 0
+
+    def __init__(self):
+        logging.handlers.QueueHandler.__init__(self, None)
+
+    @classmethod
+    def _ensure_listener(cls):
+        if cls._pid == os.getpid():
+            return cls._queue
+        with cls._lock:
+            if cls._pid != os.getpid():
+                cls._queue = queue.Queue(LOG_QUEUE_SIZE)
+                cls._sinks = [_build_stream_handler()]
+                cls._listener = _QueueListener(
+                    cls._queue, *cls._sinks, respect_handler_level=False)
+                cls._listener.start()
+                cls._pid = os.getpid()
+                # atexit does not run in multiprocessing children, they leave
+                # through os._exit after running their finalizers
+                atexit.register(cls.flush)
+                multiprocessing.util.Finalize(None, cls.flush, exitpriority=0)
+        return cls._queue
+
+    @classmethod
+    def flush(cls):
+        '''Write the records still queued and stop the writer thread'''
+        with cls._lock:
+            if cls._pid != os.getpid() or cls._listener._thread is None:
+                return
+            cls._listener.stop()
+
+    @classmethod
+    def add_sink(cls, handler):
+        cls._ensure_listener()
+        with cls._lock:
+            cls._listener.stop()
+            cls._sinks.append(handler)
+            cls._listener.handlers = tuple(cls._sinks)
+            cls._listener.start()
+
+    def prepare(self, record):
+        # Render the message on the caller side so that arguments are not
+        # mutated before the writer thread formats them, but keep formatting
+        # of the whole line in the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_text = record.exc_text or (
+            logging.Formatter().formatException(record.exc_info) if record.exc_info else None)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        # Like RateLimitFilter, warnings and errors are never dropped
+        if record.levelno >= logging.WARNING:
+            self._ensure_listener().put(record)
+            return
+        try:
+            self._ensure_listener().put_nowait(record)
+        except queue.Full:
+            AsyncQueueHandler.dropped += 1
+
+
+def _reset_async_lock():
+    AsyncQueueHandler._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_async_lock)
+
+
+def _build_formatter():
+    if _CONFIG['fmt'] == 'json':
+        return JSONFormatter()
+    return ColoredFormatter(LOG_PATTERN)
+
+
+def _build_stream_handler():
+    handler = logging.StreamHandler()
+    handler.setFormatter(_build_formatter())
+    return handler
+
+
+def _install_handlers(logger):
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for log_filter in list(logger.filters):
+        logger.removeFilter(log_filter)
+    if _CONFIG['asynchronous']:
+        logger.addHandler(AsyncQueueHandler())
+    else:
+        logger.addHandler(_build_stream_handler())
+    if _CONFIG['rate_limit'] is not None or _CONFIG['sample_rate'] is not None:
+        logger.addFilter(RateLimitFilter(rate_limit=_CONFIG['rate_limit'],
+                                         sample_rate=_CONFIG['sample_rate']))
+
+
+def configure_logging(asynchronous=False, fmt='color', rate_limit=None,
+                      sample_rate=None, log_dir=None):
+    '''Configure every logger created by `get_logger`
+
+    Parameters
+    ----------
+    asynchronous : bool
+        Write records from a background thread through a bounded queue
+    fmt : str
+        `color` for the human readable format, `json` for one JSON object per line
+    rate_limit : float
+        Max records per second for each message type (below WARNING)
+    sample_rate : float
+        Fraction of records kept for each message type (below WARNING)
+    log_dir : str
+        Directory of the per-process file sinks opened by workers
+    '''
+    assert fmt in ['color', 'json']
+    _CONFIG.update({'asynchronous': asynchronous, 'fmt': fmt,
+                    'rate_limit': rate_limit, 'sample_rate': sample_rate,
+                    'log_dir': log_dir})
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    for logger in _LOGGERS:
+        _install_handlers(logger)
+
+
+def add_process_sink(logger, sink_name):
+    '''Write the records of the current process into `<log_dir>/<sink_name>-<pid>.log`'''
+    if not _CONFIG['log_dir']:
+        return None
+    file_path = os.path.join(_CONFIG['log_dir'],
+                             f'{sink_name}-{os.getpid()}.log')
+    handler = logging.FileHandler(file_path)
+    handler.setFormatter(JSONFormatter() if _CONFIG['fmt'] == 'json'
+                         else Formatter(LOG_PATTERN))
+    if _CONFIG['asynchronous']:
+        AsyncQueueHandler.add_sink(handler)
+    else:
+        logger.addHandler(handler)
+    return file_path
 
 
 def get_logger(name=f'logger-{str(uuid.uuid4())}', mode='debug'):
     logger = logging.getLogger(name)
     # https://stackoverflow.com/questions/17745914/python-logging-module-is-printing-lines-multiple-times
     if not logger.hasHandlers():
-        handler = logging.StreamHandler()
-        formatter = ColoredFormatter(
-            '%(asctime)s | %(levelname)-8s | %(name)s: %(message)s')
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        _install_handlers(logger)
+        _LOGGERS.append(logger)
         logger.setLevel(logging.DEBUG if mode == 'debug' else logging.INFO)
     return logger
 
@@ -0,0 +1,112 @@
+import os
+import threading
+import tracemalloc
+
+from .profiler import PROFILE_TARGETS
+
+__all__ = ['MemoryTracker', 'tracemalloc_command', 'tracemalloc_kwargs',
+           'TRACEMALLOC_ACTIONS']
+
+DEFAULT_NFRAMES = 10
+DEFAULT_TOP = 20
+TRACEMALLOC_ACTIONS = ('start', 'snapshot', 'stop')
+KEY_TYPES = ('lineno', 'filename', 'traceback')
+
+# Allocations of the tracing machinery itself
+_SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+]
+
+
+def _stat_site(stat):
+    return [str(frame) for frame in stat.traceback]
+
+
+class MemoryTracker():
+    '''tracemalloc snapshots of the current process
+
+    Every snapshot is compared to the previous one, so that calling
+    `snapshot` periodically shows which allocation sites keep growing.
+    '''
+
+    def __init__(self):
+        self._previous = None
+        self._lock = threading.Lock()
+
+    def start(self, nframes=DEFAULT_NFRAMES):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(int(nframes))
+            self._previous = None
+        return self.status()
+
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self._previous = None
+        return self.status()
+
+    def status(self):
+        import psutil
+        info = {'pid': os.getpid(),
+                'rss_mb': round(psutil.Process().memory_info().rss / 1024 ** 2, 1),
+                'tracing': tracemalloc.is_tracing()}
+        if info['tracing']:
+            current, peak = tracemalloc.get_traced_memory()
+            info.update(traced_mb=round(current / 1024 ** 2, 2),
+                        traced_peak_mb=round(peak / 1024 ** 2, 2),
+                        nframes=tracemalloc.get_traceback_limit())
+        return info
+
+    def snapshot(self, top=DEFAULT_TOP, key_type='lineno'):
+        '''Top allocation sites, and their growth since the previous snapshot'''
+        if key_type not in KEY_TYPES:
+            raise ValueError(f'`key_type` must be one of {KEY_TYPES}')
+        if not tracemalloc.is_tracing():
+            raise RuntimeError('tracemalloc is not started')
+        top = int(top)
+        with self._lock:
+            snapshot = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+            previous, self._previous = self._previous, snapshot
+        info = self.status()
+        info['top'] = [{'site': _stat_site(stat), 'size_kb': round(stat.size / 1024, 1),
+                        'count': stat.count}
+                       for stat in snapshot.statistics(key_type)[:top]]
+        if previous is not None:
+            info['growth'] = [{'site': _stat_site(stat),
+                               'size_kb': round(stat.size / 1024, 1),
+                               'size_diff_kb': round(stat.size_diff / 1024, 1),
+                               'count_diff': stat.count_diff}
+                              for stat in snapshot.compare_to(previous, key_type)[:top]
+                              if stat.size_diff]
+        return info
+
+
+_tracker = MemoryTracker()
+
+
+def tracemalloc_command(action='snapshot', nframes=DEFAULT_NFRAMES, top=DEFAULT_TOP,
+                        key_type='lineno'):
+    '''Run a tracemalloc action in the current process, the admin command of workers'''
+    if action == 'start':
+        return _tracker.start(nframes)
+    if action == 'stop':
+        return _tracker.stop()
+    if action == 'snapshot':
+        return _tracker.snapshot(top, key_type)
+    raise ValueError(f'`action` must be one of {TRACEMALLOC_ACTIONS}')
+
+
+def tracemalloc_kwargs(args):
+    '''Arguments of `Funicorn.tracemalloc` from the query string of /api/tracemalloc'''
+    action, target = args.get('action', 'snapshot'), args.get('target', 'workers')
+    if action not in TRACEMALLOC_ACTIONS or target not in PROFILE_TARGETS:
+        raise ValueError(f'Unknown action {action} or target {target}')
+    return dict(action=action, target=target,
+                worker_id=args.get('worker_id'),
+                nframes=int(args.get('nframes', DEFAULT_NFRAMES)),
+                top=int(args.get('top', DEFAULT_TOP)),
+                key_type=args.get('key_type', 'lineno'))
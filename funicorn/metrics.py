@@ -0,0 +1,230 @@
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+__all__ = ['MetricsRegistry', 'Counter', 'Gauge', 'Histogram',
+           'request_metrics', 'serialization_metric',
+           'LATENCY_BUCKETS', 'BATCH_SIZE_BUCKETS', 'METRICS_CONTENT_TYPE']
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric():
+    '''Base of sharded metrics
+
+    Every thread records into its own shard, a dict only this thread
+    writes, so the hot path takes no lock. Shards are merged on scrape.
+    '''
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _snapshots(self):
+        with self._shards_lock:
+            shards = list(self._shards)
+        # Copying a dict is atomic under the GIL
+        return [shard.copy() for shard in shards]
+
+    def remove(self, **labels):
+        '''Drop the values of a label set, e.g. of a worker which exited'''
+        key = self._key(labels)
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            shard.pop(key, None)
+
+    def collect(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.metric_type}']
+        lines.extend(self.collect())
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, value=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def values(self):
+        totals = {}
+        for shard in self._snapshots():
+            for key, value in shard.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def collect(self):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in sorted(self.values().items())]
+
+
+class Gauge(_Metric):
+    '''Last value wins, set rarely (usually by a collector on scrape)'''
+    metric_type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        _Metric.__init__(self, *args, **kwargs)
+        self._values = {}
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def replace(self, values):
+        '''Set all the values at once, {label values tuple: value}'''
+        self._values = dict(values)
+
+    def remove(self, **labels):
+        self._values.pop(self._key(labels), None)
+
+    def collect(self):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in sorted(self._values.copy().items())]
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        entry = shard.get(key)
+        if entry is None:
+            # Bucket counts (the last one is +Inf), then the sum
+            entry = shard[key] = [[0] * (len(self.buckets) + 1), 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def values(self):
+        '''Merged (bucket counts, sum) per label values'''
+        merged = {}
+        for shard in self._snapshots():
+            for key, (counts, total) in shard.items():
+                if key not in merged:
+                    merged[key] = [[0] * len(counts), 0]
+                merged[key][0] = [a + b for a, b in zip(merged[key][0], counts)]
+                merged[key][1] += total
+        return merged
+
+    def collect(self):
+        lines = []
+        for key, (counts, total) in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f'{self.name}_bucket'
+                             f'{_format_labels(self.labelnames, key, le)} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry():
+    '''Named metrics rendered in the Prometheus text format
+
+    `collectors` are called before every scrape, to refresh gauges or to
+    pull metrics recorded in other processes.
+    '''
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, metric_cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_cls(name, *args, **kwargs)
+            elif not isinstance(metric, metric_cls):
+                raise ValueError(f'Metric {name} is already a {metric.metric_type}')
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames,
+                                   buckets=buckets)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            collector()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def request_metrics(registry):
+    '''Request counter and end-to-end latency histogram shared by the frontends'''
+    requests = registry.counter('funicorn_requests_total',
+                                'Requests handled by the frontends',
+                                ['endpoint', 'code'])
+    latency = registry.histogram('funicorn_request_duration_seconds',
+                                 'End-to-end latency of the requests',
+                                 ['endpoint'])
+    return requests, latency
+
+
+def serialization_metric(registry):
+    return registry.histogram('funicorn_serialization_duration_seconds',
+                              'Time spent serializing results', ['stage'])
@@ -0,0 +1,130 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+__all__ = ['SamplingProfiler', 'profile_samples', 'profile_kwargs', 'to_collapsed',
+           'merge_collapsed', 'PROFILE_TARGETS', 'COLLAPSED_CONTENT_TYPE']
+
+DEFAULT_PROFILE_DURATION = 10
+MAX_PROFILE_DURATION = 300
+DEFAULT_SAMPLE_INTERVAL = 0.01
+PROFILE_TARGETS = ('frontend', 'worker', 'workers', 'all')
+COLLAPSED_CONTENT_TYPE = 'text/plain; charset=utf-8'
+
+# Innermost Python frames of a thread blocked waiting for work
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('selectors.py', 'select'),
+    ('queue.py', 'get'),
+    ('connection.py', '_poll'),
+    ('connection.py', 'wait'),
+    ('connection.py', '_recv'),
+    ('socket.py', 'accept'),
+    ('socket.py', 'readinto'),
+    ('wasyncore.py', 'poll'),
+}
+
+
+def _short_path(path):
+    '''`path` relative to the longest sys.path entry containing it'''
+    best = ''
+    for entry in sys.path:
+        if entry and path.startswith(entry) and len(entry) > len(best):
+            best = entry
+    return os.path.relpath(path, best) if best else path
+
+
+class SamplingProfiler():
+    '''Sample the stacks of every thread of this process from a background thread
+
+    Stacks are read with `sys._current_frames`, so the sampled threads run
+    untouched. Threads waiting in the usual blocking calls are left out
+    unless `include_idle` is set.
+    '''
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL, include_idle=False, exclude=()):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.samples = Counter()
+        self.num_samples = 0
+        self._exclude = set(exclude)
+        self._labels = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = \
+                f'{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})'
+        return label
+
+    @staticmethod
+    def _is_idle(frame):
+        code = frame.f_code
+        return (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
+
+    def _sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident in self._exclude or (not self.include_idle and self._is_idle(frame)):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f'thread-{ident}'))
+            self.samples[';'.join(reversed(stack))] += 1
+        self.num_samples += 1
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='funicorn-profiler')
+        self._thread.start()
+        self._exclude.add(self._thread.ident)
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+        return dict(self.samples)
+
+
+def profile_samples(duration=DEFAULT_PROFILE_DURATION, interval=DEFAULT_SAMPLE_INTERVAL,
+                    include_idle=False):
+    '''Profile this process for `duration` seconds, {collapsed stack: count}'''
+    duration = min(float(duration), MAX_PROFILE_DURATION)
+    profiler = SamplingProfiler(float(interval), include_idle,
+                                exclude=[threading.get_ident()]).start()
+    time.sleep(duration)
+    return profiler.stop()
+
+
+def to_collapsed(samples, root=None):
+    '''Samples in the collapsed-stack format read by flamegraph.pl and speedscope'''
+    prefix = f'{root};' if root else ''
+    return ''.join(f'{prefix}{stack} {count}\n'
+                   for stack, count in sorted(samples.items()))
+
+
+def merge_collapsed(profiles):
+    '''Merge {process name: samples} into one profile, rooted at the process names'''
+    return ''.join(to_collapsed(samples, root) for root, samples in profiles.items())
+
+
+def profile_kwargs(args):
+    '''Arguments of `Funicorn.profile` from the query string of /api/profile'''
+    target = args.get('target', 'workers')
+    if target not in PROFILE_TARGETS:
+        raise ValueError(f'`target` must be one of {PROFILE_TARGETS}')
+    return dict(target=target, worker_id=args.get('worker_id'),
+                duration=float(args.get('duration', DEFAULT_PROFILE_DURATION)),
+                interval=float(args.get('interval', DEFAULT_SAMPLE_INTERVAL)),
+                include_idle=args.get('idle', 'false').lower() == 'true')
@@ -0,0 +1,373 @@
+import hashlib
+import hmac
+import os
+import pickle
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from itertools import count
+
+from .exceptions import AuthenticationError
+from .funicorn import Worker, WorkerInfo
+from .logger import get_logger
+from .utils import colored_network_name
+
+__all__ = ['RemoteWorkerServer', 'RemoteWorker']
+
+HEADER = struct.Struct('!I')
+SEQUENCE = struct.Struct('!Q')
+NONCE_SIZE = 32
+DIGEST_SIZE = hashlib.sha256().digest_size
+HANDSHAKE_TIMEOUT = 10
+AUTHKEY_ENV = 'FUNICORN_REMOTE_AUTHKEY'
+DEFAULT_LEASE_TIMEOUT = 30
+DEFAULT_LEASE_WAIT = 0.5
+DEFAULT_PREFETCH = 2
+RECONNECT_INTERVAL = 1
+
+# Messages are pickled tuples, the first item being the message type
+#   worker -> server: ('hello', worker_name)
+#                     ('lease', credits)
+#                     ('results', lease_id, [(request_id, result), ...])
+#   server -> worker: ('tasks', lease_id, [Task, ...])
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('Connection closed by peer')
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _digest(key, *parts):
+    return hmac.new(key, b''.join(parts), hashlib.sha256).digest()
+
+
+def _authkey(authkey):
+    authkey = authkey or os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise ValueError(f'Remote workers need a shared authkey, set {AUTHKEY_ENV}')
+    return authkey.encode() if isinstance(authkey, str) else bytes(authkey)
+
+
+class Channel():
+    '''Length-prefixed pickled messages authenticated with HMAC-SHA256
+
+    Both ends prove they know the shared `authkey` with a challenge-response
+    handshake before any message is read. Every message then carries the
+    HMAC of its sequence number and payload, under a key derived from both
+    challenges, which is checked before the payload is unpickled.
+    '''
+
+    def __init__(self, sock, key):
+        self.sock = sock
+        self._key = key
+        self._sent = count()
+        self._received = count()
+
+    @classmethod
+    def accept(cls, sock, authkey):
+        '''Server side of the handshake'''
+        server_nonce = os.urandom(NONCE_SIZE)
+        sock.sendall(server_nonce)
+        worker_nonce = _recv_exactly(sock, NONCE_SIZE)
+        digest = _recv_exactly(sock, DIGEST_SIZE)
+        if not hmac.compare_digest(digest, _digest(authkey, b'worker', server_nonce,
+                                                   worker_nonce)):
+            raise AuthenticationError('Wrong authkey')
+        sock.sendall(_digest(authkey, b'server', worker_nonce, server_nonce))
+        return cls(sock, _digest(authkey, b'session', server_nonce, worker_nonce))
+
+    @classmethod
+    def connect(cls, sock, authkey):
+        '''Worker side of the handshake'''
+        server_nonce = _recv_exactly(sock, NONCE_SIZE)
+        worker_nonce = os.urandom(NONCE_SIZE)
+        sock.sendall(worker_nonce + _digest(authkey, b'worker', server_nonce, worker_nonce))
+        digest = _recv_exactly(sock, DIGEST_SIZE)
+        if not hmac.compare_digest(digest, _digest(authkey, b'server', worker_nonce,
+                                                   server_nonce)):
+            raise AuthenticationError('The server does not know the authkey')
+        return cls(sock, _digest(authkey, b'session', server_nonce, worker_nonce))
+
+    def send(self, message):
+        payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = _digest(self._key, SEQUENCE.pack(next(self._sent)), payload)
+        self.sock.sendall(HEADER.pack(len(payload)) + digest + payload)
+
+    def recv(self):
+        size, = HEADER.unpack(_recv_exactly(self.sock, HEADER.size))
+        digest = _recv_exactly(self.sock, DIGEST_SIZE)
+        payload = _recv_exactly(self.sock, size)
+        expected = _digest(self._key, SEQUENCE.pack(next(self._received)), payload)
+        if not hmac.compare_digest(digest, expected):
+            raise AuthenticationError('Message with a wrong digest')
+        return pickle.loads(payload)
+
+
+class Lease():
+    def __init__(self, lease_id, tasks, timeout, conn_id):
+        self.lease_id = lease_id
+        self.tasks = {task.request_id: task for task in tasks}
+        self.deadline = time.time() + timeout
+        self.conn_id = conn_id
+
+
+class RemoteWorkerServer(threading.Thread):
+    '''Serve tasks to remote workers pulling them over TCP
+
+    Remote workers lease batches of tasks sized by the credits they send, so
+    fast hosts take more work. Tasks of a lease which is not completed before
+    `lease_timeout` seconds, or whose worker disconnects, are leased again.
+    While at least one remote worker is connected the server is registered
+    in the worker pool of `funicorn_app` like a local worker. Workers must
+    know `authkey`, which defaults to the FUNICORN_REMOTE_AUTHKEY variable.
+
+    Remote workers run their own model, so `deploy_version` does not touch
+    them. The pool takes part in traffic shifting as a worker of `version`:
+    it gets the traffic percentage of this version, and no traffic once
+    another version takes 100% (unless no worker of that version is
+    running). Without `version`, the pool joins the active version of the
+    app at the time its first worker connects.
+    '''
+
+    def __init__(self, funicorn_app, host='127.0.0.1', port=5002, name='REMOTE',
+                 lease_timeout=DEFAULT_LEASE_TIMEOUT, lease_wait=DEFAULT_LEASE_WAIT,
+                 authkey=None, version=None, debug=False):
+        threading.Thread.__init__(self, daemon=True)
+        self.name = name
+        self.host = host
+        self.port = port
+        self._authkey = _authkey(authkey)
+        self.funicorn_app = funicorn_app
+        self.lease_timeout = lease_timeout
+        self.lease_wait = lease_wait
+        self.logger = get_logger(colored_network_name(name),
+                                 mode='debug' if debug else 'info')
+        self._tasks = queue.Queue()
+        self._leases = {}
+        self._lock = threading.Lock()
+        self._lease_ids = count()
+        self._conn_ids = count()
+        self._connections = set()
+        self.version = version
+        self.worker_info = WorkerInfo(wrk=None, wrk_id=f'{name}-{port}', pid=None,
+                                      gpu_id=None, ps_status='remote',
+                                      queue=self._tasks,
+                                      ready_event=threading.Event(),
+                                      terminate_event=threading.Event(),
+                                      version=version)
+        self.worker_info.ready_event.set()
+        self.funicorn_app.register_connection(self)
+
+    @property
+    def num_connections(self):
+        return len(self._connections)
+
+    def _lease(self, credits, conn_id):
+        tasks = []
+        try:
+            tasks.append(self._tasks.get(timeout=self.lease_wait))
+            while len(tasks) < credits:
+                tasks.append(self._tasks.get_nowait())
+        except queue.Empty:
+            pass
+        if not tasks:
+            return None, tasks
+        lease = Lease(next(self._lease_ids), tasks,
+                      self.lease_timeout, conn_id)
+        with self._lock:
+            self._leases[lease.lease_id] = lease
+        return lease.lease_id, tasks
+
+    def _complete(self, lease_id, results):
+        with self._lock:
+            lease = self._leases.get(lease_id)
+            if lease is None:
+                # The lease expired and its tasks have been leased again
+                return
+            for request_id, result in results:
+                if lease.tasks.pop(request_id, None) is not None:
+                    self.funicorn_app.result_dict[request_id] = result
+            if not lease.tasks:
+                del self._leases[lease_id]
+
+    def _release(self, condition):
+        '''Put the unfinished tasks of the matching leases back in the queue'''
+        with self._lock:
+            lease_ids = [lease_id for lease_id, lease in self._leases.items()
+                         if condition(lease)]
+            released = [self._leases.pop(lease_id) for lease_id in lease_ids]
+        for lease in released:
+            for task in lease.tasks.values():
+                self._tasks.put(task)
+        return sum(len(lease.tasks) for lease in released)
+
+    def _reap_expired_leases(self):
+        while True:
+            time.sleep(1)
+            now = time.time()
+            num_tasks = self._release(lambda lease: lease.deadline < now)
+            if num_tasks:
+                self.logger.warning(
+                    f'{num_tasks} tasks of expired leases are leased again')
+
+    def _on_connect(self, conn_id):
+        with self._lock:
+            self._connections.add(conn_id)
+            is_first = len(self._connections) == 1
+        if is_first:
+            version = self.version or self.funicorn_app.active_version
+            if version != self.worker_info.version:
+                self.worker_info = self.worker_info._replace(version=version)
+                self.logger.info(f'Remote workers serve model version {version}')
+            self.funicorn_app.add_worker_pool(self.worker_info)
+
+    def _on_disconnect(self, conn_id):
+        with self._lock:
+            self._connections.discard(conn_id)
+            is_last = len(self._connections) == 0
+        self._release(lambda lease: lease.conn_id == conn_id)
+        if is_last:
+            self.funicorn_app.remove_worker_pool(self.worker_info)
+
+    def _handle(self, sock, address):
+        try:
+            sock.settimeout(HANDSHAKE_TIMEOUT)
+            channel = Channel.accept(sock, self._authkey)
+            sock.settimeout(None)
+        except OSError as e:
+            self.logger.warning(f'Rejected connection from {address[0]}: {e}')
+            sock.close()
+            return
+        conn_id = next(self._conn_ids)
+        worker_name = address
+        try:
+            message = channel.recv()
+            if message[0] == 'hello':
+                worker_name = message[1]
+            self.logger.info(f'Remote worker {worker_name} connected')
+            self._on_connect(conn_id)
+            while True:
+                message = channel.recv()
+                if message[0] == 'lease':
+                    lease_id, tasks = self._lease(message[1], conn_id)
+                    channel.send(('tasks', lease_id, tasks))
+                elif message[0] == 'results':
+                    self._complete(message[1], message[2])
+        except AuthenticationError as e:
+            self.logger.error(f'Remote worker {worker_name} disconnected: {e}')
+        except (ConnectionError, OSError, EOFError):
+            self.logger.warning(f'Remote worker {worker_name} disconnected')
+        finally:
+            sock.close()
+            self._on_disconnect(conn_id)
+
+    def run(self):
+        threading.Thread(target=self._reap_expired_leases,
+                         daemon=True).start()
+        server = socket.create_server((self.host, self.port), backlog=128)
+        self.logger.info(
+            f'Remote workers can connect to tcp://{self.host}:{self.port}')
+        while True:
+            sock, address = server.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._handle, args=(sock, address),
+                             daemon=True).start()
+
+
+class RemoteWorker(Worker):
+    '''Worker leasing tasks from a `RemoteWorkerServer` over TCP
+
+    The worker asks for as many tasks as it has credits:
+    `batch_size * prefetch` minus the tasks it already holds.
+    '''
+
+    def __init__(self, model_cls, host, port, prefetch=DEFAULT_PREFETCH, authkey=None,
+                 **kwargs):
+        Worker.__init__(self, model_cls, **kwargs)
+        self.host = host
+        self.port = port
+        self.prefetch = prefetch
+        self._authkey = _authkey(authkey)
+        self._channel = None
+        self._pending = deque()
+        self._lease_ids = {}
+        self._results = {}
+
+    @property
+    def capacity(self):
+        return self.batch_size * self.prefetch
+
+    def _backlog(self):
+        return len(self._pending)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=HANDSHAKE_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self._channel = Channel.connect(sock, self._authkey)
+        except OSError:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        self._channel.send(('hello', f'{socket.gethostname()}-{os.getpid()}'))
+
+    def _reconnect(self):
+        # Leased tasks are given to other workers by the server
+        self._pending.clear()
+        self._lease_ids.clear()
+        self._results = {}
+        self._channel.sock.close()
+        while True:
+            try:
+                self._connect()
+                return
+            except OSError as e:
+                self.logger.warning(
+                    f'Cannot connect to {self.host}:{self.port} ({e}), retrying')
+                time.sleep(RECONNECT_INTERVAL)
+
+    def _lease(self):
+        credits = self.capacity - len(self._pending)
+        self._channel.send(('lease', credits))
+        _, lease_id, tasks = self._channel.recv()
+        for task in tasks:
+            self._lease_ids[task.request_id] = lease_id
+            self._pending.append(task)
+
+    def _recv_request(self):
+        if not self._pending:
+            raise TimeoutError
+        return self._pending.popleft()
+
+    def _send_response(self, request_id, result):
+        lease_id = self._lease_ids.pop(request_id)
+        self._results.setdefault(lease_id, []).append((request_id, result))
+
+    def _flush_results(self):
+        for lease_id, results in self._results.items():
+            self._channel.send(('results', lease_id, results))
+        self._results = {}
+
+    def run_once(self):
+        try:
+            if len(self._pending) < self.batch_size:
+                self._lease()
+            handled = super().run_once()
+            self._flush_results()
+        except (ConnectionError, OSError, EOFError):
+            self.logger.warning('Lost connection to the server')
+            self._reconnect()
+            return 0
+        return handled
+
+    def run(self, *args, **kwargs):
+        self._connect()
+        super().run(*args, **kwargs)
@@ -1,20 +1,24 @@
 from thrift.server import TNonblockingServer
 from thrift.protocol import TBinaryProtocol
 from thrift.transport import TSocket, TTransport
+from thrift.Thrift import TApplicationException
 
 from .FunicornService import Processor
 from .thrift_server import TModelPool
 from ..logger import get_logger
+from ..exceptions import PredictionError
 from ..utils import colored_network_name
+from ..serializers import get_serializer, EncodedResult, JSON_CONTENT_TYPE
 import threading
 import time
-import json
 import uuid
 
 
 class Handler():
-    def __init__(self, funicorn_app, stat, logger):
+    def __init__(self, funicorn_app, stat, logger, preserialize=False):
         self.funicorn_app = funicorn_app
+        # Workers return the JSON string, only utf-8 encoding is left to Thrift
+        self.wire_format = JSON_CONTENT_TYPE if preserialize else None
         self.stat = stat
         self.logger = logger
         self.logger.info('Init Handler!')
@@ -26,13 +30,22 @@ class Handler():
         start_time = time.time()
         assert isinstance(img_bytes, bytes)
         data = self.preprocess(img_bytes)
-        json_result = self.funicorn_app.predict(data)
+        try:
+            json_result = self.funicorn_app.predict(
+                data, wire_format=self.wire_format)
+        except PredictionError as e:
+            self.stat.increment('crashes')
+            raise TApplicationException(
+                TApplicationException.INTERNAL_ERROR, f'Prediction failed: {e}')
         self.stat.increment('total_req')
         if isinstance(json_result, str) or isinstance(json_result, dict):
             ValueError('The result from rpc must be json string')
         self.logger.info(f'process-time: {time.time() - start_time}')
+        self.stat.record_latency(time.time() - start_time)
         self.stat.increment('total_res')
-        return json.dumps(json_result)
+        if isinstance(json_result, EncodedResult):
+            return json_result.body.decode()
+        return get_serializer().dumps(json_result).decode()
 
     def ping(self):
         self.logger.info('Ping!')
@@ -40,7 +53,7 @@ class Handler():
 
 class ThriftAPI(threading.Thread):
     def __init__(self, funicorn_app, host, port, name='RPC', stat=None, threads=40,
-                 timeout=1000, debug=False):
+                 timeout=1000, preserialize=False, debug=False):
         threading.Thread.__init__(self, daemon=True)
         self.name = name
         self.funicorn_app = funicorn_app
@@ -48,6 +61,7 @@ class ThriftAPI(threading.Thread):
         self.port = port
         self.stat = stat
         self.threads = threads
+        self.preserialize = preserialize
         self.debug = debug
         self.logger = get_logger(colored_network_name(
             'RPC'), mode='debug' if debug else 'info')
@@ -76,7 +90,8 @@ class ThriftAPI(threading.Thread):
         return server
 
     def init_handler(self):
-        return Handler(self.funicorn_app, self.stat, self.logger)
+        return Handler(self.funicorn_app, self.stat, self.logger,
+                       preserialize=self.preserialize)
 
     def init_processor(self, handler):
         processor = Processor(handler)
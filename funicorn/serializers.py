@@ -0,0 +1,235 @@
+import base64
+import json
+from collections import namedtuple
+
+import numpy as np
+
+from .utils import ndarray_to_npy_bytes, npy_bytes_to_ndarray, NPY_CONTENT_TYPE
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__all__ = ['Serializer', 'JSONSerializer', 'MsgpackSerializer', 'NpySerializer',
+           'get_serializer', 'negotiate', 'negotiate_content_type', 'loads',
+           'encode_result', 'EncodedResult', 'JSON_CONTENT_TYPE', 'MSGPACK_CONTENT_TYPE']
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+MSGPACK_CONTENT_TYPES = (MSGPACK_CONTENT_TYPE, 'application/x-msgpack')
+
+# A result already serialized by the worker, spliced as is into the response
+EncodedResult = namedtuple('EncodedResult', ['content_type', 'body'])
+
+
+def _ndarray_to_base64(arr):
+    arr = np.ascontiguousarray(arr)
+    return {'__ndarray__': base64.b64encode(arr.data).decode('ascii'),
+            'dtype': arr.dtype.str,
+            'shape': list(arr.shape)}
+
+
+def _restore_ndarray(obj):
+    if '__ndarray__' not in obj:
+        return obj
+    buf = obj['__ndarray__']
+    if isinstance(buf, str):
+        buf = base64.b64decode(buf)
+    return np.frombuffer(buf, dtype=obj['dtype']).reshape(obj['shape'])
+
+
+class Serializer():
+    '''Encode a response payload to bytes of `content_type`'''
+    content_type = None
+
+    def dumps(self, payload):
+        raise NotImplementedError
+
+    def embed(self, payload, key, body):
+        '''Encode the dict `payload` with `key` set to the already encoded `body`'''
+        raise NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    '''JSON with numpy support, through orjson when it is installed
+
+    Arrays are encoded as nested lists, or with `array_format='base64'` as
+    {"__ndarray__": <base64>, "dtype": ..., "shape": [...]} objects.
+    '''
+    content_type = JSON_CONTENT_TYPE
+
+    def __init__(self, array_format='list'):
+        assert array_format in ('list', 'base64')
+        self.array_format = array_format
+        self._options = 0
+        if orjson is not None:
+            self._options = orjson.OPT_NON_STR_KEYS
+            if array_format == 'list':
+                self._options |= orjson.OPT_SERIALIZE_NUMPY
+
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            if self.array_format == 'base64':
+                return _ndarray_to_base64(obj)
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if isinstance(obj, (bytes, bytearray)):
+            return base64.b64encode(obj).decode('ascii')
+        if isinstance(obj, (set, tuple)):
+            return list(obj)
+        raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+    def dumps(self, payload):
+        if orjson is not None:
+            return orjson.dumps(payload, default=self.default, option=self._options)
+        return json.dumps(payload, default=self.default).encode()
+
+    def embed(self, payload, key, body):
+        head = self.dumps(payload)[:-1]
+        separator = b',' if payload else b''
+        return head + separator + self.dumps(key) + b':' + body + b'}'
+
+
+class MsgpackSerializer(Serializer):
+    '''msgpack with arrays as {"__ndarray__": <raw bytes>, "dtype": ..., "shape": [...]}'''
+    content_type = MSGPACK_CONTENT_TYPE
+
+    def __init__(self):
+        import msgpack
+        self._packer = msgpack.Packer(default=self.default, use_bin_type=True)
+
+    @staticmethod
+    def default(obj):
+        if isinstance(obj, np.ndarray):
+            arr = np.ascontiguousarray(obj)
+            return {'__ndarray__': arr.tobytes(), 'dtype': arr.dtype.str,
+                    'shape': list(arr.shape)}
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError(f'Object of type {type(obj).__name__} is not msgpack serializable')
+
+    def dumps(self, payload):
+        return self._packer.pack(payload)
+
+    def embed(self, payload, key, body):
+        parts = [self._packer.pack_map_header(len(payload) + 1)]
+        for item in payload.items():
+            parts.extend(self._packer.pack(obj) for obj in item)
+        parts.extend([self._packer.pack(key), body])
+        return b''.join(parts)
+
+
+class NpySerializer(Serializer):
+    '''Only the `results` of the payload, as one .npy array'''
+    content_type = NPY_CONTENT_TYPE
+
+    def dumps(self, payload):
+        if isinstance(payload, dict):
+            if 'results' not in payload:
+                raise ValueError('Only results can be encoded as an array')
+            payload = payload['results']
+        arr = np.asarray(payload)
+        if arr.dtype.hasobject:
+            raise ValueError('Results cannot be encoded as a single array')
+        return ndarray_to_npy_bytes(arr)
+
+    def embed(self, payload, key, body):
+        return body
+
+
+_SERIALIZERS = {}
+
+
+def get_serializer(content_type=JSON_CONTENT_TYPE):
+    '''Shared serializer instance of `content_type`, None if unsupported'''
+    if content_type in MSGPACK_CONTENT_TYPES:
+        content_type = MSGPACK_CONTENT_TYPE
+    if content_type not in _SERIALIZERS:
+        if content_type == JSON_CONTENT_TYPE:
+            _SERIALIZERS[content_type] = JSONSerializer()
+        elif content_type == MSGPACK_CONTENT_TYPE:
+            try:
+                _SERIALIZERS[content_type] = MsgpackSerializer()
+            except ImportError:
+                return None
+        elif content_type == NPY_CONTENT_TYPE:
+            _SERIALIZERS[content_type] = NpySerializer()
+        else:
+            return None
+    return _SERIALIZERS[content_type]
+
+
+def _parse_accept(accept):
+    media_types = []
+    for idx, item in enumerate(accept.split(',')):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0
+        if media_type and quality > 0:
+            media_types.append((-quality, idx, media_type))
+    return [media_type for _, _, media_type in sorted(media_types)]
+
+
+def negotiate_content_type(accept=None):
+    '''Preferred supported format of an Accept header, JSON by default'''
+    for media_type in _parse_accept(accept or ''):
+        if media_type in ('*/*', 'application/*'):
+            break
+        serializer = get_serializer(media_type)
+        if serializer is not None:
+            return serializer.content_type
+    return JSON_CONTENT_TYPE
+
+
+def encode_result(result, content_type):
+    '''Serialize one result in a worker, or keep it as is if it does not fit the format'''
+    try:
+        return EncodedResult(content_type, get_serializer(content_type).dumps(result))
+    except Exception:
+        # The frontend encodes it, falling back to another format if needed
+        return result
+
+
+def negotiate(payload, accept=None):
+    '''Encode `payload` in the preferred format of an Accept header
+
+    Falls back to JSON when no accepted format is supported, or when the
+    results cannot be encoded in it. Results pre-serialized by a worker are
+    embedded as they are. Returns (body, content_type).
+    '''
+    results = payload.get('results') if isinstance(payload, dict) else None
+    if isinstance(results, EncodedResult):
+        serializer = get_serializer(results.content_type)
+        payload = {key: value for key, value in payload.items() if key != 'results'}
+        return serializer.embed(payload, 'results', results.body), results.content_type
+    for media_type in _parse_accept(accept or ''):
+        if media_type in ('*/*', 'application/*'):
+            break
+        serializer = get_serializer(media_type)
+        if serializer is None:
+            continue
+        if serializer.content_type == JSON_CONTENT_TYPE:
+            break
+        try:
+            return serializer.dumps(payload), serializer.content_type
+        except (TypeError, ValueError):
+            continue
+    return get_serializer(JSON_CONTENT_TYPE).dumps(payload), JSON_CONTENT_TYPE
+
+
+def loads(body, content_type=JSON_CONTENT_TYPE):
+    '''Decode a response body, restoring the arrays encoded by the serializers'''
+    content_type = (content_type or JSON_CONTENT_TYPE).split(';')[0].strip()
+    if content_type == NPY_CONTENT_TYPE:
+        return {'results': npy_bytes_to_ndarray(body)}
+    if content_type in MSGPACK_CONTENT_TYPES:
+        import msgpack
+        return msgpack.unpackb(body, object_hook=_restore_ndarray, raw=False)
+    return json.loads(body, object_hook=_restore_ndarray)
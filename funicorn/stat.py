@@ -1,7 +1,238 @@
 import time
+import math
+import json
 import threading
+import multiprocessing as mp
+from bisect import bisect_left
 from .table import print_table
-from .logger import get_logger
+from .logger import get_logger, AsyncQueueHandler
+from .metrics import LATENCY_BUCKETS
+
+EWMA_TICK_INTERVAL = 5
+EWMA_WINDOWS = (1, 5, 15)
+LATENCY_WINDOW = 60
+LATENCY_QUANTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99, 'p999': 0.999}
+STREAM_CONTENT_TYPE = 'text/event-stream'
+DEFAULT_STREAM_INTERVAL = 0.5
+MIN_STREAM_INTERVAL = 0.1
+# Cumulative counters, rates over the refresh interval are left to the client
+FRAME_KEYS = ('status', 'uptime', 'total_req', 'total_res', 'crashes',
+              'latency_p50', 'latency_p90', 'latency_p99')
+WORKER_FRAME_KEYS = ('wrk_id', 'version', 'queue', 'tasks', 'batches', 'errors',
+                     'busy_time', 'batch_capacity', 'p99_model_time', 'rss_mb')
+
+
+def sse_event(payload):
+    '''`payload` as one server-sent event'''
+    return b'data: ' + json.dumps(payload, separators=(',', ':')).encode() + b'\n\n'
+
+
+class Meter():
+    '''Event rates as 1, 5 and 15 minute EWMAs, like the Unix load average
+
+    Events are counted in the current tick, and the averages are updated
+    every `EWMA_TICK_INTERVAL` seconds when the meter is next touched.
+    '''
+
+    def __init__(self, tick_interval=EWMA_TICK_INTERVAL, windows=EWMA_WINDOWS):
+        self.tick_interval = tick_interval
+        self.windows = windows
+        self._alphas = [1 - math.exp(-tick_interval / (60 * window)) for window in windows]
+        self._rates = [None] * len(windows)
+        self._uncounted = 0
+        self._last_tick = time.time()
+
+    def _tick(self):
+        now = time.time()
+        ticks = int((now - self._last_tick) // self.tick_interval)
+        if ticks <= 0:
+            return
+        instant_rate = self._uncounted / self.tick_interval
+        self._uncounted = 0
+        self._last_tick += ticks * self.tick_interval
+        for idx, alpha in enumerate(self._alphas):
+            rate = self._rates[idx]
+            # The first tick seeds the average, later idle ticks decay it
+            rate = instant_rate if rate is None else rate + alpha * (instant_rate - rate)
+            self._rates[idx] = rate * (1 - alpha) ** (ticks - 1)
+
+    def mark(self, value=1):
+        self._tick()
+        self._uncounted += value
+
+    def rates(self):
+        self._tick()
+        return [round(rate or 0, 2) for rate in self._rates]
+
+
+class QuantileSketch():
+    '''Quantiles within `relative_accuracy` using at most `max_buckets` log-spaced buckets
+
+    Values are counted in buckets growing by a factor `gamma`, as in
+    DDSketch. When there are too many buckets the lowest ones are merged.
+    '''
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.zeros = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value <= 0:
+            self.zeros += 1
+            return
+        idx = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            lowest, second = sorted(self.buckets)[:2]
+            self.buckets[second] += self.buckets.pop(lowest)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.zeros += other.zeros
+        for idx, count in other.buckets.items():
+            self.buckets[idx] = self.buckets.get(idx, 0) + count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0
+        rank = q * (self.count - 1)
+        cumulative = self.zeros
+        if rank < cumulative:
+            return 0
+        for idx in sorted(self.buckets):
+            cumulative += self.buckets[idx]
+            if cumulative > rank:
+                return 2 * self.gamma ** idx / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class WindowedSketch():
+    '''Quantiles of the last `window` to 2 x `window` seconds, in two rotating sketches'''
+
+    def __init__(self, window=LATENCY_WINDOW, **sketch_kwargs):
+        self.window = window
+        self._sketch_kwargs = sketch_kwargs
+        self._previous = QuantileSketch(**sketch_kwargs)
+        self._current = QuantileSketch(**sketch_kwargs)
+        self._rotated_at = time.time()
+
+    def _rotate(self):
+        now = time.time()
+        if now - self._rotated_at < self.window:
+            return
+        # Drop both when nothing was recorded for two windows
+        stale = now - self._rotated_at >= 2 * self.window
+        self._previous = QuantileSketch(**self._sketch_kwargs) if stale else self._current
+        self._current = QuantileSketch(**self._sketch_kwargs)
+        self._rotated_at = now
+
+    def add(self, value):
+        self._rotate()
+        self._current.add(value)
+
+    def snapshot(self):
+        self._rotate()
+        sketch = QuantileSketch(**self._sketch_kwargs)
+        sketch.merge(self._previous)
+        sketch.merge(self._current)
+        return sketch
+
+
+class WorkerStats():
+    '''Counters of a worker process in a shared memory block
+
+    Only the worker writes its block, so updates need no lock, and the
+    parent reads it directly without any IPC round trip. The block holds
+    the FIELDS followed by a histogram of the model time per batch.
+    '''
+    FIELDS = ('started_at', 'batch_capacity', 'batches', 'tasks', 'errors',
+              'busy_time', 'serialize_time', 'last_batch_at', 'rss', 'peak_rss',
+              'task_bytes', 'dropped_logs')
+    BUCKETS = LATENCY_BUCKETS
+
+    def __init__(self, batch_capacity=1):
+        self._offsets = {name: idx for idx, name in enumerate(self.FIELDS)}
+        self._hist_offset = len(self.FIELDS)
+        self.block = mp.RawArray('d', len(self.FIELDS) + len(self.BUCKETS) + 1)
+        self.block[self._offsets['started_at']] = time.time()
+        self.block[self._offsets['batch_capacity']] = batch_capacity
+
+    def __getitem__(self, name):
+        return self.block[self._offsets[name]]
+
+    def _add(self, name, value):
+        self.block[self._offsets[name]] += value
+
+    def start(self):
+        self.block[self._offsets['started_at']] = time.time()
+
+    def record_batch(self, batch_size, model_time, serialize_time=0, errors=0):
+        self._add('batches', 1)
+        self._add('tasks', batch_size)
+        self._add('errors', errors)
+        self._add('busy_time', model_time + serialize_time)
+        self._add('serialize_time', serialize_time)
+        self.block[self._offsets['last_batch_at']] = time.time()
+        self.block[self._hist_offset + bisect_left(self.BUCKETS, model_time)] += 1
+
+    def record_rss(self, rss):
+        self.block[self._offsets['rss']] = rss
+        if rss > self['peak_rss']:
+            self.block[self._offsets['peak_rss']] = rss
+
+    def record_dropped_logs(self, count):
+        self.block[self._offsets['dropped_logs']] = count
+
+    def record_task_size(self, size, alpha=0.1):
+        '''Moving average of the size of the tasks received'''
+        offset = self._offsets['task_bytes']
+        self.block[offset] = size if not self.block[offset] \
+            else (1 - alpha) * self.block[offset] + alpha * size
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the `q` quantile of the model time'''
+        counts = self.block[self._hist_offset:]
+        total = sum(counts)
+        if total == 0:
+            return 0
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        uptime = max(time.time() - self['started_at'], 1e-6)
+        batches, tasks = self['batches'], self['tasks']
+        busy_time = min(self['busy_time'], uptime)
+        return {
+            'uptime': int(uptime),
+            'tasks': int(tasks),
+            'batches': int(batches),
+            'errors': int(self['errors']),
+            'throughput': round(tasks / uptime, 2),
+            'utilization': round(busy_time / uptime, 4),
+            'idle_time': round(uptime - busy_time, 2),
+            'batch_fill': round(tasks / (batches * self['batch_capacity']), 4) if batches else 0,
+            'avg_model_time': round(self['busy_time'] / batches, 4) if batches else 0,
+            'busy_time': round(self['busy_time'], 4),
+            'batch_capacity': int(self['batch_capacity']),
+            'p99_model_time': self.quantile(0.99),
+            'rss_mb': round(self['rss'] / 1024 ** 2, 1),
+            'peak_rss_mb': round(self['peak_rss'] / 1024 ** 2, 1),
+            'dropped_logs': int(self['dropped_logs']),
+        }
+
 
 class Statistic():
     def __init__(self, funicorn_app=None):
@@ -18,6 +249,12 @@ class Statistic():
             'crashes': 0,
         }
         self.lock = threading.Lock()
+        # Current load, as opposed to the lifetime averages
+        self.meters = {'total_req': Meter(), 'total_res': Meter()}
+        self.latency = WindowedSketch()
+        self._frame = None
+        self._frame_at = 0
+        self._frame_lock = threading.Lock()
         self.logger = get_logger(name='Stat', mode='info')
         self.logger.info('Init statistics')
         
@@ -31,6 +268,12 @@ class Statistic():
     def increment(self, name, value=1):
         with self.lock:
             self.stats_info[name] += value
+            if name in self.meters:
+                self.meters[name].mark(value)
+
+    def record_latency(self, seconds):
+        with self.lock:
+            self.latency.add(seconds)
 
     def decrement(self, name, value=1):
         with self.lock:
@@ -43,7 +286,12 @@ class Statistic():
     @property
     def info(self):
         self.update()
-        return self.stats_info
+        workers = self.workers_info()
+        # Log records dropped by the asynchronous handlers of every process
+        dropped_logs = AsyncQueueHandler.dropped + \
+            sum(stats.get('dropped_logs', 0) for stats in workers)
+        return dict(self.stats_info, workers=workers, recycles=self.recycles_info(),
+                    dropped_logs=dropped_logs)
 
     def update(self):
         uptime = int(time.time() - self.start_time)
@@ -51,11 +299,69 @@ class Statistic():
             self.stats_info['uptime'] = uptime
             self.stats_info['avg_req'] = 0 if uptime == 0 else round(self.stats_info['total_req']/uptime, 2)
             self.stats_info['avg_res'] = 0 if uptime == 0 else round(self.stats_info['total_res']/uptime, 2)
+            for name, prefix in [('total_req', 'req_rate'), ('total_res', 'res_rate')]:
+                for window, rate in zip(EWMA_WINDOWS, self.meters[name].rates()):
+                    self.stats_info[f'{prefix}_{window}m'] = rate
+            latency = self.latency.snapshot()
+        # Latencies are reported in milliseconds
+        self.stats_info['avg_latency'] = round(1000 * latency.total / latency.count, 2) \
+            if latency.count else 0
+        for name, q in LATENCY_QUANTILES.items():
+            self.stats_info[f'latency_{name}'] = round(1000 * latency.quantile(q), 2)
+
+    def frame(self):
+        '''Encoded event of the live dashboard
+
+        Built at most once per `MIN_STREAM_INTERVAL` and shared by all the
+        streams, so the cost does not grow with the number of dashboards.
+        '''
+        with self._frame_lock:
+            now = time.time()
+            if self._frame is None or now - self._frame_at >= MIN_STREAM_INTERVAL:
+                self.update()
+                payload = {key: self.stats_info[key] for key in FRAME_KEYS}
+                payload['time'] = round(now, 3)
+                payload['workers'] = [{key: stats.get(key) for key in WORKER_FRAME_KEYS}
+                                      for stats in self.workers_info()]
+                self._frame, self._frame_at = sse_event(payload), now
+            return self._frame
+
+    def stream(self, interval=DEFAULT_STREAM_INTERVAL):
+        '''Endless server-sent events of the statistics, every `interval` seconds'''
+        interval = max(float(interval), MIN_STREAM_INTERVAL)
+        while True:
+            yield self.frame()
+            time.sleep(interval)
+
+    def workers_info(self):
+        if self.funicorn_app is None or not hasattr(self.funicorn_app, 'workers_stats'):
+            return []
+        return self.funicorn_app.workers_stats()
+
+    def recycles_info(self):
+        '''Number of workers recycled per reason'''
+        return dict(getattr(self.funicorn_app, 'recycles', None) or {})
+
+    @property
+    def cli_workers_info(self):
+        rows = [['worker', 'version', 'tasks', 'throughput', 'utilization',
+                 'batch fill', 'avg model time', 'errors', 'rss (MB)']]
+        for stats in self.workers_info():
+            rows.append([stats['wrk_id'], stats['version'], stats['tasks'], stats['throughput'],
+                         stats['utilization'], stats['batch_fill'], stats['avg_model_time'],
+                         stats['errors'], stats['rss_mb']])
+        if len(rows) == 1:
+            rows.append(['-'] * len(rows[0]))
+        return print_table(rows, color=(0, 255, 0))
 
     @property
     def cli_info(self):
         self.update()
-        table = [['status', 'uptime', 'total requests', 'total responses', 'avg latency', 'avg requests', 'avg responses', 'crashes'],
-                 [self.stats_info['status'], self.stats_info['uptime'], self.stats_info['total_req'], self.stats_info['total_res'],
-                  self.stats_info['avg_latency'], self.stats_info['avg_req'], self.stats_info['avg_res'], self.stats_info['crashes']]]
+        info = self.stats_info
+        table = [['status', 'uptime', 'total requests', 'total responses', 'avg latency', 'avg requests', 'avg responses', 'crashes',
+                  'req/s 1m,5m,15m', 'p50,p99 (ms)'],
+                 [info['status'], info['uptime'], info['total_req'], info['total_res'],
+                  info['avg_latency'], info['avg_req'], info['avg_res'], info['crashes'],
+                  f"{info['req_rate_1m']},{info['req_rate_5m']},{info['req_rate_15m']}",
+                  f"{info['latency_p50']},{info['latency_p99']}"]]
         return print_table(table, color=(0, 255, 0))
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from logging.handlers import RotatingFileHandler
+
+__all__ = ['Tracer', 'Trace', 'read_traces', 'STAGES', 'SPAN_NAMES',
+           'TRACE_ID_HEADER']
+
+DEFAULT_TRACE_FILE = 'funicorn-traces.jsonl'
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 3
+TRACE_ID_HEADER = 'X-Trace-Id'
+
+# Indexes of the stage timestamp vector carried by every traced `Task`
+(RECEIVED, SUBMITTED, DISPATCHED, DEQUEUED, BATCH_START, MODEL_END,
+ RESULT_SENT, RESULT_RECEIVED, RESPONDED) = range(9)
+STAGES = ('received', 'submitted', 'dispatched', 'dequeued', 'batch_start',
+          'model_end', 'result_sent', 'result_received', 'responded')
+# Name of the span ending at each stage, from the previous recorded stage
+SPAN_NAMES = (None, 'parse_decode', 'dispatch', 'worker_queue', 'batch_wait',
+              'model', 'worker_encode', 'result_transfer', 'response_encode')
+
+
+def _is_hex(value, lengths=(16, 32)):
+    if not value or len(value) not in lengths:
+        return False
+    try:
+        int(value, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def _new_id(length=16):
+    return uuid.uuid4().hex[:length]
+
+
+def parse_trace_headers(headers):
+    '''(trace_id, parent_span_id, sampled) propagated by the caller
+
+    Supports W3C `traceparent`, Zipkin B3 and a plain `X-Trace-Id`.
+    `sampled` is None when the caller left the decision to us.
+    '''
+    traceparent = headers.get('traceparent')
+    if traceparent:
+        parts = traceparent.strip().split('-')
+        if len(parts) == 4 and _is_hex(parts[1], (32,)) and _is_hex(parts[2], (16,)):
+            try:
+                sampled = bool(int(parts[3], 16) & 1)
+            except ValueError:
+                sampled = None
+            return parts[1].lower(), parts[2].lower(), sampled
+    trace_id = headers.get('x-b3-traceid')
+    if _is_hex(trace_id):
+        sampled = headers.get('x-b3-sampled')
+        sampled = None if sampled is None else sampled.strip() in ('1', 'true', 'd')
+        parent_id = headers.get('x-b3-spanid')
+        return trace_id.lower(), parent_id if _is_hex(parent_id, (16,)) else None, sampled
+    trace_id = headers.get(TRACE_ID_HEADER.lower())
+    if _is_hex(trace_id):
+        # Asking for a trace by id means wanting to read it
+        return trace_id.lower(), None, True
+    return None, None, None
+
+
+class Trace():
+    '''Stage timestamps of one sampled request
+
+    `timestamps` is the vector given to the `Task`: the frontend and the
+    worker fill in the stages they go through, unset ones stay 0.
+    '''
+    __slots__ = ('trace_id', 'parent_id', 'name', 'status_code', 'timestamps')
+
+    def __init__(self, name, trace_id=None, parent_id=None):
+        self.name = name
+        self.trace_id = trace_id or _new_id(32)
+        self.parent_id = parent_id
+        self.status_code = None
+        self.timestamps = [0.0] * len(STAGES)
+        self.timestamps[RECEIVED] = time.time()
+
+    def mark(self, stage, timestamp=None):
+        self.timestamps[stage] = timestamp or time.time()
+
+    def merge(self, timestamps):
+        '''Take the stages recorded by another process'''
+        for stage, timestamp in enumerate(timestamps):
+            if timestamp and not self.timestamps[stage]:
+                self.timestamps[stage] = timestamp
+
+    def durations(self):
+        '''[(span name, start, seconds)] between consecutive recorded stages'''
+        durations = []
+        previous = self.timestamps[RECEIVED]
+        for stage in range(SUBMITTED, len(STAGES)):
+            timestamp = self.timestamps[stage]
+            if not timestamp:
+                continue
+            durations.append((SPAN_NAMES[stage], previous, max(timestamp - previous, 0)))
+            previous = timestamp
+        return durations
+
+    def spans(self, service_name='funicorn'):
+        '''Zipkin v2 spans: the request and one child span per stage'''
+        endpoint = {'serviceName': service_name}
+        start = self.timestamps[RECEIVED]
+        end = self.timestamps[RESPONDED] or max(self.timestamps)
+        root_id = _new_id()
+        root = {'traceId': self.trace_id, 'id': root_id, 'name': self.name,
+                'kind': 'SERVER', 'timestamp': int(start * 1e6),
+                'duration': max(int((end - start) * 1e6), 1),
+                'localEndpoint': endpoint, 'tags': {'http.path': self.name}}
+        if self.parent_id:
+            root['parentId'] = self.parent_id
+        if self.status_code is not None:
+            root['tags']['http.status_code'] = str(self.status_code)
+        spans = [root]
+        for name, span_start, duration in self.durations():
+            spans.append({'traceId': self.trace_id, 'id': _new_id(), 'parentId': root_id,
+                          'name': name, 'timestamp': int(span_start * 1e6),
+                          'duration': max(int(duration * 1e6), 1),
+                          'localEndpoint': endpoint})
+        return spans
+
+
+class Tracer():
+    '''Sample requests and export their traces to a rotating file
+
+    Every line of `path` holds the Zipkin v2 spans of one request, as a JSON
+    list which can be posted as is to a Zipkin collector. A request is traced
+    when its caller propagated a sampled trace id, or with probability
+    `sample_rate` otherwise.
+    '''
+
+    def __init__(self, path=DEFAULT_TRACE_FILE, sample_rate=DEFAULT_SAMPLE_RATE,
+                 max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT,
+                 service_name='funicorn'):
+        self.path = os.path.abspath(path)
+        self.sample_rate = sample_rate
+        self.service_name = service_name
+        self._writer = logging.getLogger(f'funicorn.traces.{self.path}')
+        self._writer.propagate = False
+        self._writer.setLevel(logging.INFO)
+        if not self._writer.handlers:
+            handler = RotatingFileHandler(self.path, maxBytes=max_bytes,
+                                          backupCount=backup_count, delay=True)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._writer.addHandler(handler)
+
+    def start(self, headers, name):
+        '''A `Trace` for a new request, None when it is not sampled'''
+        trace_id, parent_id, sampled = parse_trace_headers(headers)
+        if sampled is None:
+            sampled = random.random() < self.sample_rate
+        if not sampled:
+            return None
+        return Trace(name, trace_id=trace_id, parent_id=parent_id)
+
+    def finish(self, trace, status_code=None):
+        if not trace.timestamps[RESPONDED]:
+            trace.mark(RESPONDED)
+        trace.status_code = status_code
+        self._writer.info(json.dumps(trace.spans(self.service_name)))
+
+
+def read_traces(path=DEFAULT_TRACE_FILE):
+    '''Yield the spans of every exported request, oldest first, rotated files included'''
+    rotated = []
+    idx = 1
+    while os.path.exists(f'{path}.{idx}'):
+        rotated.append(f'{path}.{idx}')
+        idx += 1
+    # `path.1` is the most recently rotated file
+    for file_path in rotated[::-1] + [path]:
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A line cut by a crash while writing
+                    continue
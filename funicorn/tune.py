@@ -0,0 +1,243 @@
+import http.client
+import itertools
+import math
+import socket
+import time
+from collections import namedtuple
+
+from .bench import LoadGenerator, HTTPTarget
+from .logger import get_logger
+from .table import print_table
+
+__all__ = ['Tuner', 'Trial', 'pareto_frontier', 'choose_trial', 'funicorn_command',
+           'DEFAULT_BATCH_SIZES', 'DEFAULT_BATCH_TIMEOUTS', 'DEFAULT_NUM_WORKERS']
+
+DEFAULT_BATCH_SIZES = (1, 4, 16, 64)
+DEFAULT_BATCH_TIMEOUTS = (2, 10, 50)
+DEFAULT_NUM_WORKERS = (1, 2, 4)
+# Trials failing more requests than this are left out of the frontier
+MAX_ERROR_RATE = 0.01
+SERVICE_READY_TIMEOUT = 600
+
+# `batch_timeout` in milliseconds, latencies in milliseconds
+Trial = namedtuple('Trial', ['batch_size', 'batch_timeout', 'num_workers', 'throughput',
+                             'p50', 'p99', 'errors', 'requests'])
+
+
+def _config(trial):
+    return trial.batch_size, trial.batch_timeout, trial.num_workers
+
+
+def _is_valid(trial):
+    total = trial.requests + trial.errors
+    return trial.requests > 0 and trial.errors / total <= MAX_ERROR_RATE
+
+
+def pareto_frontier(trials):
+    '''Trials no other one beats on both throughput and p99 latency, by p99'''
+    frontier = []
+    for trial in sorted(filter(_is_valid, trials), key=lambda t: (t.p99, -t.throughput)):
+        if not frontier or trial.throughput > frontier[-1].throughput:
+            frontier.append(trial)
+    return frontier
+
+
+def choose_trial(frontier, max_p99=None):
+    '''Highest throughput within `max_p99` ms, the lowest p99 if none meets it'''
+    if not frontier:
+        return None
+    if max_p99 is None:
+        return frontier[-1]
+    within = [trial for trial in frontier if trial.p99 <= max_p99]
+    return within[-1] if within else frontier[0]
+
+
+def funicorn_command(trial, model_cls, gpu_devices=None, model_init_kwargs=None):
+    '''`funicorn` command line serving with the configuration of `trial`'''
+    args = ['funicorn', '--model-cls', model_cls, '--num-workers', str(trial.num_workers),
+            '--batch-size', str(trial.batch_size)]
+    if trial.batch_size > 1:
+        args.extend(['--batch-timeout', f'{trial.batch_timeout:g}'])
+    if gpu_devices:
+        args.extend(['--gpu-devices', ','.join(gpu_devices)])
+    args.extend(f'{key}:{value}' for key, value in (model_init_kwargs or {}).items())
+    return ' '.join(args)
+
+
+def _midpoints(values, value, integer):
+    '''Geometric midpoints between `value` and its neighbours in `values`'''
+    values = sorted(set(values))
+    idx = values.index(value)
+    midpoints = []
+    for neighbour in values[max(idx - 1, 0):idx] + values[idx + 1:idx + 2]:
+        midpoint = math.sqrt(max(neighbour, 0.1) * max(value, 0.1))
+        midpoint = int(round(midpoint)) if integer else round(midpoint, 1)
+        if midpoint not in values:
+            midpoints.append(midpoint)
+    return midpoints
+
+
+def _free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class Tuner():
+    '''Search the batching configuration of `model_cls` for throughput and p99 latency
+
+    The model is served in-process behind an asyncio frontend, and every
+    configuration is loaded by a `bench.LoadGenerator` after switching the
+    workers with `Funicorn.reconfigure`. A coarse grid is measured first,
+    then the neighbourhood of the chosen trial on the Pareto frontier is
+    refined with geometric midpoints, `refine_rounds` times.
+    '''
+
+    def __init__(self, model_cls, payloads, model_init_kwargs=None, gpu_devices=None,
+                 connections=32, mode='closed', rate=None, duration=10, warmup=3,
+                 max_p99=None, host='127.0.0.1', debug=False):
+        self.model_cls = model_cls
+        self.payloads = payloads
+        self.model_init_kwargs = model_init_kwargs
+        self.gpu_devices = gpu_devices
+        self.connections = connections
+        self.mode = mode
+        self.rate = rate
+        self.duration = duration
+        self.warmup = warmup
+        self.max_p99 = max_p99
+        self.host = host
+        self.debug = debug
+        self.trials = []
+        self.funicorn_app = None
+        self.port = None
+        self.logger = get_logger('TUNER', mode='debug' if debug else 'info')
+
+    def start(self, batch_size, batch_timeout, num_workers):
+        from .async_http_api import AsyncHttpAPI
+        from .funicorn import Funicorn
+        self.port = _free_port(self.host)
+        self.funicorn_app = Funicorn(self.model_cls, num_workers=num_workers,
+                                     batch_size=batch_size, batch_timeout=batch_timeout,
+                                     gpu_devices=self.gpu_devices,
+                                     model_init_kwargs=self.model_init_kwargs,
+                                     debug=self.debug)
+        AsyncHttpAPI(funicorn_app=self.funicorn_app, host=self.host, port=self.port,
+                     debug=self.debug)
+        self.funicorn_app.serve(run_in_background=True)
+        deadline = time.time() + SERVICE_READY_TIMEOUT
+        while time.time() < deadline:
+            try:
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=1)
+                conn.request('GET', '/api/status')
+                if conn.getresponse().status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.5)
+        raise TimeoutError(f'The service is not up after {SERVICE_READY_TIMEOUT}s')
+
+    def stop(self):
+        if self.funicorn_app is not None:
+            self.funicorn_app.terminate_all_workers()
+
+    def measure(self, batch_size, batch_timeout, num_workers):
+        if self.funicorn_app is None:
+            self.start(batch_size, batch_timeout, num_workers)
+        elif not self.funicorn_app.reconfigure(batch_size, batch_timeout, num_workers):
+            raise RuntimeError(f'Workers cannot start with batch size {batch_size}, '
+                               f'batch timeout {batch_timeout}ms and {num_workers} workers')
+        generator = LoadGenerator(lambda: HTTPTarget(self.host, self.port), self.payloads,
+                                  connections=self.connections, mode=self.mode,
+                                  rate=self.rate, duration=self.duration,
+                                  warmup=self.warmup)
+        result = generator.run()
+        trial = Trial(batch_size, batch_timeout, num_workers, result.throughput,
+                      result.corrected['p50'], result.corrected['p99'], result.errors,
+                      result.requests)
+        self.logger.info(f'batch size {batch_size}, batch timeout {batch_timeout}ms, '
+                         f'{num_workers} workers: {trial.throughput} req/s, '
+                         f'p99 {trial.p99}ms, {trial.errors} errors')
+        self.trials.append(trial)
+        return trial
+
+    def _measure_all(self, configs):
+        measured = {_config(trial) for trial in self.trials}
+        for config in configs:
+            if config not in measured:
+                measured.add(config)
+                self.measure(*config)
+
+    def run(self, batch_sizes=DEFAULT_BATCH_SIZES, batch_timeouts=DEFAULT_BATCH_TIMEOUTS,
+            num_workers=DEFAULT_NUM_WORKERS, refine_rounds=1):
+        '''Measure the grid then refine it, returns the chosen trial'''
+        # The batch timeout does not matter without batching
+        grid = sorted({(size, timeout if size > 1 else 0, workers)
+                       for size, timeout, workers in itertools.product(
+                           batch_sizes, batch_timeouts, num_workers)})
+        self.logger.info(f'Measure {len(grid)} configurations, '
+                         f'about {len(grid) * (self.duration + self.warmup):.0f}s')
+        try:
+            self._measure_all(grid)
+            for _ in range(refine_rounds):
+                if not self._refine():
+                    break
+        finally:
+            self.stop()
+        return self.best
+
+    def _refine(self):
+        '''Measure the midpoints around the chosen trial and its frontier neighbours'''
+        frontier = self.frontier
+        best = self.best
+        if best is None:
+            return False
+        idx = frontier.index(best)
+        configs = []
+        values = list(zip(*[_config(trial) for trial in self.trials]))
+        timeouts = sorted(timeout for timeout in values[1] if timeout > 0)
+        # Batching from a trial without it starts at the median timeout
+        default_timeout = timeouts[len(timeouts) // 2] if timeouts else 10
+        for trial in frontier[max(idx - 1, 0):idx + 2]:
+            size, timeout, workers = _config(trial)
+            configs.extend((value, (timeout or default_timeout) if value > 1 else 0, workers)
+                           for value in _midpoints(values[0], size, integer=True))
+            if size > 1:
+                configs.extend((size, value, workers)
+                               for value in _midpoints(timeouts, timeout, integer=False))
+            configs.extend((size, timeout, value)
+                           for value in _midpoints(values[2], workers, integer=True))
+        measured = {_config(trial) for trial in self.trials}
+        configs = [config for config in dict.fromkeys(configs) if config not in measured]
+        self.logger.info(f'Refine {len(configs)} configurations')
+        self._measure_all(configs)
+        return bool(configs)
+
+    @property
+    def frontier(self):
+        return pareto_frontier(self.trials)
+
+    @property
+    def best(self):
+        return choose_trial(self.frontier, self.max_p99)
+
+    def to_dict(self):
+        best = self.best
+        return {'trials': [trial._asdict() for trial in self.trials],
+                'frontier': [trial._asdict() for trial in self.frontier],
+                'best': best._asdict() if best else None,
+                'max_p99': self.max_p99}
+
+    def table(self):
+        frontier = {_config(trial) for trial in self.frontier}
+        best = self.best
+        rows = [['batch size', 'batch timeout (ms)', 'workers', 'throughput (req/s)',
+                 'p50 (ms)', 'p99 (ms)', 'errors', 'frontier']]
+        for trial in sorted(self.trials, key=lambda t: -t.throughput):
+            mark = '*' if _config(trial) in frontier else ''
+            if best is not None and _config(trial) == _config(best):
+                mark = '* best'
+            rows.append([trial.batch_size, trial.batch_timeout if trial.batch_size > 1 else '-',
+                         trial.num_workers, trial.throughput, trial.p50, trial.p99,
+                         trial.errors, mark])
+        return print_table(rows, color=(0, 255, 0))
@@ -2,13 +2,12 @@ from termcolor import colored
 from inspect import getfullargspec
 import uuid
 import time
-import psutil
-import cv2
 import numpy as np
 import sys
 import importlib
+import itertools
+from collections import deque
 import os
-from PIL import Image
 from io import BytesIO, StringIO
 
 #--------------------- Image Encode/Decode ---------------------#
@@ -16,6 +15,7 @@ from io import BytesIO, StringIO
 
 def img_bytes_to_img_arr(img_bytes):
     '''Convert image bytes to image array'''
+    import cv2
     img_flatten = np.frombuffer(img_bytes, dtype=np.uint8)
     img_arr_decoded = cv2.imdecode(img_flatten, cv2.IMREAD_ANYCOLOR)
     return img_arr_decoded
@@ -23,13 +23,59 @@ def img_bytes_to_img_arr(img_bytes):
 
 def img_arr_to_img_bytes(img_arr, quality=100):
     '''Convert image array to image bytes'''
+    import cv2
     ret, img_flatten = cv2.imencode('.jpg', img_arr, params=[
                                     cv2.IMWRITE_JPEG_QUALITY, quality])
     img_bytes = img_flatten.tobytes()
     return img_bytes
 
 
+#--------------------- Tensor Encode/Decode ---------------------#
+NPY_CONTENT_TYPE = 'application/x-npy'
+RAW_CONTENT_TYPE = 'application/octet-stream'
+# Largest request body (e.g. a tensor) the frontends accept
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+
+def npy_bytes_to_ndarray(buf):
+    '''Map a .npy payload to an ndarray without copying the data'''
+    stream = BytesIO(buf)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+    elif version == (3, 0):
+        # The header is utf-8 (non-ASCII field names), numpy has no public
+        # reader for it, so load a copy
+        return np.load(BytesIO(buf), allow_pickle=False)
+    else:
+        raise ValueError(f'Unsupported .npy format version {version}')
+    if dtype.hasobject:
+        raise ValueError('Object arrays are not supported')
+    count = int(np.prod(shape))
+    arr = np.frombuffer(buf, dtype=dtype, count=count, offset=stream.tell())
+    return arr.reshape(shape, order='F' if fortran_order else 'C')
+
+
+def raw_bytes_to_ndarray(buf, dtype, shape):
+    '''Map a raw C-ordered payload to an ndarray without copying the data'''
+    dtype = np.dtype(dtype)
+    if dtype.hasobject:
+        raise ValueError('Object arrays are not supported')
+    if isinstance(shape, str):
+        shape = tuple(int(dim) for dim in shape.split(',') if dim.strip())
+    return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+
+def ndarray_to_npy_bytes(arr):
+    stream = BytesIO()
+    np.lib.format.write_array(stream, np.asarray(arr), allow_pickle=False)
+    return stream.getvalue()
+
+
 def check_tree_status(parent_pid, including_parent=True):
+    import psutil
     status = {}
     parent = psutil.Process(parent_pid)
     for idx, child in enumerate(parent.children(recursive=True)):
@@ -47,6 +93,7 @@ def check_all_ps_status(list_pid):
 
 
 def check_ps_status(pid):
+    import psutil
     ps = psutil.Process(pid)
     return ps.status()
 
@@ -82,6 +129,18 @@ def split_class_from_path(path):
     return pkg, cls_name
 
 
+def check_deploy_allowed(model_path, deploy_models):
+    '''Raise PermissionError unless /api/deploy may load `model_path`
+
+    Deploying is disabled while `deploy_models` is None. Otherwise the
+    serving model class and the class paths listed in it are allowed.
+    '''
+    if deploy_models is None:
+        raise PermissionError('Deploying model versions is disabled')
+    if model_path is not None and model_path not in deploy_models:
+        raise PermissionError(f'Model class {model_path} is not allowed to be deployed')
+
+
 #------------------- OTHERS ------------------#
 def get_size(obj, seen=None):
     """Recursively finds size of objects"""
@@ -102,3 +161,48 @@ def get_size(obj, seen=None):
     elif hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes, bytearray)):
         size += sum([get_size(i, seen) for i in obj])
     return size
+
+
+SIZE_BUDGET = 1000
+SIZE_MIN_SAMPLE = 8
+CONTAINER_TYPES = (list, tuple, set, frozenset, deque)
+
+
+def get_size_bounded(obj, max_objects=SIZE_BUDGET):
+    """Estimate `get_size` visiting about `max_objects` objects per nesting level
+
+    Containers larger than the remaining budget are sampled with a stride,
+    down to SIZE_MIN_SAMPLE items once the budget is spent: their other
+    items count as the average size of the visited ones. Arrays count their
+    data buffer, even when they are views.
+    """
+    budget = [max_objects]
+    seen = set()
+
+    def _size(obj):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        budget[0] -= 1
+        if isinstance(obj, np.ndarray):
+            return max(sys.getsizeof(obj), obj.nbytes)
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            items, length = obj.items(), len(obj)
+        elif isinstance(obj, CONTAINER_TYPES):
+            items, length = obj, len(obj)
+        elif hasattr(obj, '__dict__'):
+            return size + _size(obj.__dict__)
+        else:
+            return size
+        if not length:
+            return size
+        sampled = 0
+        children_size = 0
+        stride = max(1, length // max(budget[0], SIZE_MIN_SAMPLE))
+        for item in itertools.islice(items, 0, None, stride):
+            children_size += sum(map(_size, item)) if isinstance(obj, dict) else _size(item)
+            sampled += 1
+        return size + children_size * length / sampled
+
+    return int(_size(obj))
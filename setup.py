@@ -31,6 +31,17 @@ setup(
                             'funicorn-restart=funicorn.cli:worker_restart',
                             'funicorn-add=funicorn.cli:add_workers',
                             'funicorn-status=funicorn.cli:status',
+                            'funicorn-trace=funicorn.cli:trace_breakdown',
+                            'funicorn-profile=funicorn.cli:profile',
+                            'funicorn-memory=funicorn.cli:memory',
+                            'funicorn-bench=funicorn.cli:bench',
+                            'funicorn-tune=funicorn.cli:tune',
+                            'funicorn-deploy=funicorn.cli:deploy_version',
+                            'funicorn-shift=funicorn.cli:shift_traffic',
+                            'funicorn-rollback=funicorn.cli:rollback',
+                            'funicorn-release=funicorn.cli:release_version',
+                            'funicorn-worker=funicorn.cli:backend_worker',
+                            'funicorn-remote-worker=funicorn.cli:remote_worker',
                             ],
     }
 )
@@ -0,0 +1,76 @@
+'''Throughput of decoding ~5MB JPEG uploads for a 224x224 model
+
+Compare full-resolution decoding against decoding at a reduced scale
+with PIL draft() and OpenCV IMREAD_REDUCED_*, and the decode pool.
+
+    python test/benchmark/decode_speed_test.py --num-images 50 --num-workers 4
+'''
+import argparse
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from funicorn.decode import ImageDecoder, decode_image
+
+
+def make_upload(width, height, quality):
+    '''A noisy photo-like JPEG, noise keeps the file size realistic'''
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    noise = np.random.randint(0, 64, (height, width, 3)).astype(np.float32)
+    img_arr = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+    stream = BytesIO()
+    Image.fromarray(img_arr).save(stream, format='JPEG', quality=quality)
+    return stream.getvalue()
+
+
+def bench_serial(img_bytes, num_images, **kwargs):
+    start = time.time()
+    for _ in range(num_images):
+        decode_image(img_bytes, **kwargs)
+    return num_images / (time.time() - start)
+
+
+def bench_pool(img_bytes, num_images, **kwargs):
+    decoder = ImageDecoder(**kwargs)
+    decoder.decode(img_bytes)
+    start = time.time()
+    futures = [decoder.submit(img_bytes) for _ in range(num_images)]
+    for future in futures:
+        future.result()
+    rate = num_images / (time.time() - start)
+    decoder.close()
+    return rate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-images', type=int, default=50)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--quality', type=int, default=90)
+    parser.add_argument('--target-size', type=int, default=224)
+    args = parser.parse_args()
+
+    img_bytes = make_upload(args.width, args.height, args.quality)
+    target = args.target_size
+    print(f'Upload: {args.width}x{args.height} JPEG, {len(img_bytes) / 1024 ** 2:.1f}MB')
+    print('| Decoder | Output size | Images/s |')
+    print('|-|-|-|')
+    cases = [('PIL full', dict(backend='pil')),
+             ('PIL draft', dict(backend='pil', target_size=target)),
+             ('cv2 full', dict(backend='cv2')),
+             ('cv2 reduced', dict(backend='cv2', target_size=target))]
+    for name, kwargs in cases:
+        out = decode_image(img_bytes, **kwargs)
+        size = out.size if hasattr(out, 'size') and not isinstance(out, np.ndarray) \
+            else (out.shape[1], out.shape[0])
+        rate = bench_serial(img_bytes, args.num_images, **kwargs)
+        print(f'| {name} | {size[0]}x{size[1]} | {rate:.1f} |')
+    for use_processes in [False, True]:
+        kind = 'processes' if use_processes else 'threads'
+        rate = bench_pool(img_bytes, args.num_images, target_size=target,
+                          num_workers=args.num_workers, use_processes=use_processes)
+        print(f'| pool of {args.num_workers} {kind}, PIL draft | - | {rate:.1f} |')
@@ -0,0 +1,64 @@
+'''Throughput ceiling of task dispatching with a no-op model
+
+Compare the central dispatcher thread (`queue` mode) against frontends
+putting tasks straight into worker queues (`direct` mode).
+
+    python test/benchmark/dispatch_speed_test.py --num-tasks 20000 --num-threads 8
+'''
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from funicorn import Funicorn
+
+
+class NoopModel():
+    def __init__(self):
+        pass
+
+    def predict(self, batch):
+        return [0] * len(batch)
+
+
+def wait_until_dispatched(app):
+    while app.input_queue.qsize() > 0:
+        time.sleep(0.001)
+
+
+def bench(dispatch_mode, num_tasks, num_threads, num_workers, batch_size):
+    app = Funicorn(NoopModel, num_workers=num_workers, batch_size=batch_size,
+                   batch_timeout=1, dispatch_mode=dispatch_mode)
+    app.serve(run_in_background=True)
+    time.sleep(2)
+    per_thread = num_tasks // num_threads
+
+    def submit(_):
+        return [app.predict(1, asynchronous=True) for _ in range(per_thread)]
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        start = time.time()
+        request_ids = [rid for rids in executor.map(submit, range(num_threads))
+                       for rid in rids]
+        if dispatch_mode == 'queue':
+            wait_until_dispatched(app)
+        dispatch_time = time.time() - start
+        list(executor.map(app.get_result, request_ids))
+        total_time = time.time() - start
+    app.terminate_all_workers()
+    return len(request_ids) / dispatch_time, len(request_ids) / total_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-tasks', type=int, default=20000)
+    parser.add_argument('--num-threads', type=int, default=8)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=8)
+    args = parser.parse_args()
+
+    print('| Dispatch mode | Dispatch (tasks/s) | End-to-end (tasks/s) |')
+    print('|-|-|-|')
+    for dispatch_mode in ['queue', 'direct']:
+        dispatch_rate, e2e_rate = bench(dispatch_mode, args.num_tasks, args.num_threads,
+                                        args.num_workers, args.batch_size)
+        print(f'| {dispatch_mode} | {dispatch_rate:.0f} | {e2e_rate:.0f} |')
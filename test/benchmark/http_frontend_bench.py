@@ -0,0 +1,90 @@
+'''Load test of the waitress and asyncio HTTP frontends with a no-op model
+
+Opens `--connections` keep-alive connections, each one sending
+GET /api/predict_url back to back for `--duration` seconds.
+
+    python test/benchmark/http_frontend_bench.py --connections 1000 --duration 10
+'''
+import argparse
+import asyncio
+import resource
+import time
+
+import numpy as np
+
+from funicorn import Funicorn, HttpAPI, AsyncHttpAPI
+
+
+class NoopModel():
+    def __init__(self):
+        pass
+
+    def predict(self, batch):
+        return [0] * len(batch)
+
+
+async def client(host, port, deadline, latencies, errors):
+    request = (f'GET /api/predict_url?url=x HTTP/1.1\r\n'
+               f'Host: {host}:{port}\r\n\r\n').encode()
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        errors.append(1)
+        return
+    try:
+        while time.time() < deadline:
+            start = time.time()
+            writer.write(request)
+            content_length = 0
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError
+                if line.lower().startswith(b'content-length:'):
+                    content_length = int(line.split(b':')[1])
+                if line == b'\r\n':
+                    break
+            await reader.readexactly(content_length)
+            latencies.append(time.time() - start)
+    except (OSError, ConnectionError, asyncio.IncompleteReadError):
+        errors.append(1)
+    finally:
+        writer.close()
+
+
+async def load(host, port, connections, duration):
+    latencies, errors = [], []
+    deadline = time.time() + duration
+    await asyncio.gather(*[client(host, port, deadline, latencies, errors)
+                           for _ in range(connections)])
+    return latencies, errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=16)
+    args = parser.parse_args()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    app = Funicorn(NoopModel, num_workers=args.num_workers,
+                   batch_size=args.batch_size, batch_timeout=2)
+    HttpAPI(funicorn_app=app, host='127.0.0.1', port=18001, name='waitress',
+            fetch_urls=False)
+    AsyncHttpAPI(funicorn_app=app, host='127.0.0.1', port=18002, name='asyncio',
+                 fetch_urls=False)
+    app.serve(run_in_background=True)
+    time.sleep(3)
+
+    print(f'| Frontend | Connections | Requests/s | p50 (ms) | p99 (ms) | Errors |')
+    print('|-|-|-|-|-|-|')
+    for name, port in [('waitress (threads=40)', 18001), ('asyncio', 18002)]:
+        latencies, errors = asyncio.run(
+            load('127.0.0.1', port, args.connections, args.duration))
+        latencies = np.array(latencies) * 1000
+        p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (0, 0)
+        print(f'| {name} | {args.connections} | {len(latencies) / args.duration:.0f} '
+              f'| {p50:.1f} | {p99:.1f} | {len(errors)} |')
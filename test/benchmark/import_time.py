@@ -0,0 +1,73 @@
+'''Import time of the funicorn entry points, measured with `python -X importtime`
+
+Every module is imported in a fresh interpreter `--repeat` times and the
+best cumulative time is kept. With `--check` the script fails when an entry
+point exceeds its budget or loads a dependency it does not use, so that a
+top-level import added by mistake shows up as a regression.
+
+    python test/benchmark/import_time.py --repeat 5 --check
+'''
+import argparse
+import subprocess
+import sys
+
+from funicorn.table import print_table
+
+# Entry point: (budget in ms, heavy modules it must not load)
+TARGETS = {
+    'funicorn': (50, ('numpy', 'flask', 'waitress', 'thrift', 'cv2', 'PIL', 'psutil')),
+    'funicorn.cli': (250, ('numpy', 'flask', 'waitress', 'thrift', 'cv2', 'PIL')),
+    'funicorn.client': (250, ('flask', 'waitress', 'thrift', 'cv2', 'PIL')),
+    'funicorn.funicorn': (250, ('flask', 'waitress', 'thrift', 'cv2', 'PIL', 'asyncio')),
+    'funicorn.bench': (100, ('numpy', 'flask', 'waitress', 'thrift', 'cv2', 'PIL')),
+}
+
+
+def import_time(module):
+    '''(cumulative import time in ms, top-level package names loaded)'''
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True).stderr
+    # A parent package is imported first, on its own line
+    parents = {'.'.join(module.split('.')[:idx + 1]) for idx in range(module.count('.') + 1)}
+    cumulative, packages = 0, set()
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, total, name = line.split('|')
+        if not total.strip().isdigit():
+            continue
+        # Nested imports are indented by two more spaces per level
+        top_level = len(name) - len(name.lstrip()) == 1
+        name = name.strip()
+        packages.add(name.split('.')[0])
+        if top_level and name in parents:
+            cumulative += int(total) / 1000
+    return cumulative, packages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--check', action='store_true',
+                        help='Exit with an error on a budget or forbidden import regression')
+    args = parser.parse_args()
+    rows = [['Module', 'Import time (ms)', 'Budget (ms)', 'Unexpected imports']]
+    failed = False
+    for module, (budget, forbidden) in TARGETS.items():
+        times = []
+        packages = set()
+        for _ in range(args.repeat):
+            cumulative, packages = import_time(module)
+            times.append(cumulative)
+        unexpected = sorted(packages.intersection(forbidden))
+        best = min(times)
+        failed |= best > budget or bool(unexpected)
+        rows.append([module, round(best, 1), budget, ', '.join(unexpected) or '-'])
+    print('\n'.join(print_table(rows)))
+    if args.check and failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 from funicorn import Funicorn
-from funicorn.thriftcorn.rpc_api import ThriftAPI
+from funicorn.rpc.rpc_api import ThriftAPI
+from funicorn.gateway import Gateway
 from funicorn.utils import colored_funicorn_name, colored_network_name
-import random
 from nlpservice.nlpservice import NLPService
 
 
@@ -18,27 +18,20 @@ class NLPThriftApi(ThriftAPI):
 class NLPGateWay(Funicorn):
     '''Customize Funicorn Service to work as waygate'''
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, entries, *args, **kwargs):
         Funicorn.__init__(self, *args, **kwargs)
-        self.entries = [
-            'Kiki-Handler-V1', 
-            'Kiki-Handler-V2'
-        ]
+        # e.g. ['thrift://10.0.0.1:5001', 'thrift://10.0.0.2:5001']
+        self.gateway = Gateway(entries, thrift_service=NLPService)
         self.logger.name = colored_funicorn_name('NLPGateWay')
 
-    def get_entries(self, idx):
-        return self.entries[idx]
-
     def nlp_encode(self, text):
-        '''Distribute text to other entries'''
-
-        # Logic to distribute
-        entry = self.get_entries(random.randint(0, len(self.entries) - 1))
+        '''Send text to the entry owning it, other entries take over on failure'''
+        entry = self.gateway.route(text)
         self.logger.info(f'Send {text} to {entry} and wait the result')
-        # Maybe send to other Funicorn Service Entry
-
-        # Then wait for the result
-        # In this case we return a dummy result
+        result = self.gateway.call(text, 'nlp_encode', text)
         self.logger.info(f'Receive {text} from {entry}')
-        result = text
         return result
+
+    def nlp_encode_all(self, text):
+        '''Ask every healthy entry in parallel'''
+        return self.gateway.scatter_gather('nlp_encode', text)
@@ -0,0 +1,94 @@
+'''Exercise the Redis backend against fakeredis, across forked workers
+
+Checks that tasks are served by several workers, and that an input which
+keeps crashing workers is given up after `max_deliveries` deliveries
+instead of being reclaimed forever. Skipped without `pip install redis fakeredis`.
+
+    python -m pytest test/test_redis_backend.py
+'''
+import multiprocessing as mp
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from funicorn import Funicorn
+from funicorn.backends import get_backend
+from funicorn.exceptions import PredictionError
+from funicorn.funicorn import BackendWorker
+
+HOST = '127.0.0.1'
+POISON = 'poison'
+
+
+class EchoModel():
+    def __init__(self):
+        pass
+
+    def predict(self, batch):
+        if POISON in batch:
+            # A crash no exception handler sees, like a segfault or an OOM kill
+            os._exit(1)
+        return [(os.getpid(), x) for x in batch]
+
+
+def start_fake_redis(port):
+    '''Serve fakeredis on `port`, a free port when 0'''
+    from fakeredis import TcpFakeServer
+    server = TcpFakeServer((HOST, port), server_type='redis')
+    # Connections of the frontend must not keep the script alive
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def supervise(worker, num_workers, stop_event):
+    '''Keep `num_workers` worker processes alive, like a process manager would'''
+    processes = []
+    while not stop_event.is_set():
+        processes = [ps for ps in processes if ps.is_alive()]
+        while len(processes) < num_workers:
+            ps = mp.Process(target=worker.run, args=(len(processes),), daemon=True)
+            ps.start()
+            processes.append(ps)
+        time.sleep(0.2)
+    for ps in processes:
+        ps.terminate()
+
+
+def run(port=0):
+    server = start_fake_redis(port)
+    url = f'redis://{HOST}:{server.server_address[1]}/0'
+    worker = BackendWorker(EchoModel, get_backend(url), reclaim_interval=0.5,
+                           min_idle_time=1, max_deliveries=2)
+    stop_event = threading.Event()
+    threading.Thread(target=supervise, args=(worker, 2, stop_event), daemon=True).start()
+    # Frontend only: tasks and results go through the backend
+    app = Funicorn(None, num_workers=0, backend=get_backend(url))
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(app.predict, range(200)))
+    assert [x for _, x in results] == list(range(200))
+    pids = {pid for pid, _ in results}
+    print(f'200 tasks served by workers {sorted(pids)}')
+
+    start_time = time.time()
+    try:
+        app.predict(POISON)
+    except PredictionError as e:
+        assert e.error_type == 'DeliveryLimitExceeded', e
+        print(f'Poison input failed after {time.time() - start_time:.1f}s: {e}')
+    else:
+        raise AssertionError('The poison input must fail')
+
+    # Workers keep serving after the poison input is given up
+    assert app.predict(1)[1] == 1
+    stop_event.set()
+
+
+def test_redis_backend():
+    pytest.importorskip('redis')
+    pytest.importorskip('fakeredis')
+    run()